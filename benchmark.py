@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""Benchmark the storage frontends with the local storage backend.
+
+A file tree is created in a temporary directory and served by an app
+from create_app with STORAGE = 'local'. Each scenario sends the same
+request in a loop from several threads for some seconds, with one
+test client per thread. The requests do not go through a server or
+the network, so the numbers show the cost of the app and the storage
+layer, including the locks they share between threads.
+
+The results are written as JSON. Compare them with those of an
+earlier run on the same machine to find regressions:
+
+    ./benchmark.py -o before.json
+    ./benchmark.py -o after.json --compare before.json
+"""
+import base64
+import itertools
+import json
+from optparse import OptionParser
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from eudat_http_api import create_app
+
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark'
+AUTH_HEADER = ('Authorization', 'Basic %s'
+               % base64.b64encode('%s:%s' % (USERNAME, PASSWORD)))
+CDMI_VERSION = '1.0.2'
+
+
+class BenchmarkConfig(object):
+    DEBUG = False
+    TESTING = False
+    SECRET_KEY = 'benchmark'
+
+    ACTIVATE_STORAGE_READ = True
+    ACTIVATE_STORAGE_WRITE = True
+    ACTIVATE_CDMI = True
+    ACTIVATE_JSON = True
+    # the html pages link to the registration
+    ACTIVATE_REGISTRATION = True
+    REGISTRATION_WORKERS = 0
+
+    STORAGE = 'local'
+    # set to the temporary directory by main
+    EXPORTEDPATHS = []
+    SQLALCHEMY_DATABASE_URI = None
+    USERS = {USERNAME: PASSWORD}
+
+
+class Scenario(object):
+    """A request that is sent again and again.
+
+    Requests that create an object get a new path every time, and
+    the object is removed after the request, so that the disk does
+    not fill up. The removal is not part of the latency.
+    """
+    def __init__(self, name, path, method='GET', headers=None, data=None,
+                 creates=False):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.headers = [AUTH_HEADER] + (headers or [])
+        self.data = data
+        self.creates = creates
+        self.counter = itertools.count()
+
+    def get_path(self):
+        if self.creates:
+            return '%s/%d' % (self.path, next(self.counter))
+        return self.path
+
+    def cleanup(self, path):
+        # the local storage serves the paths of the file system
+        if self.creates and os.path.exists(path):
+            os.remove(path)
+
+
+def create_tree(root, file_size, listing_sizes):
+    """Create the files and directories the scenarios use."""
+    data = os.urandom(file_size)
+    with open(os.path.join(root, 'file'), 'wb') as f:
+        f.write(data)
+    for size in listing_sizes:
+        directory = os.path.join(root, 'ls_%d' % size)
+        os.mkdir(directory)
+        for i in range(size):
+            open(os.path.join(directory, 'f%07d' % i), 'w').close()
+    os.mkdir(os.path.join(root, 'put'))
+    os.mkdir(os.path.join(root, 'cdmi_put'))
+    return data
+
+
+def get_scenarios(root, data, listing_sizes):
+    size = len(data)
+    cdmi_body = json.dumps({
+        'mimetype': 'application/octet-stream',
+        'valuetransferencoding': 'base64',
+        'value': base64.b64encode(data),
+    })
+
+    scenarios = [
+        Scenario('get', root + '/file'),
+        Scenario('get_range', root + '/file',
+                 headers=[('Range', 'bytes=0-65535')]),
+        Scenario('get_multirange', root + '/file',
+                 headers=[('Range', 'bytes=0-1023,%d-%d,%d-%d' % (
+                     size / 2, size / 2 + 1023, size - 1024, size - 1))]),
+        Scenario('put', root + '/put', method='PUT', data=data,
+                 creates=True),
+        Scenario('cdmi_get', root + '/file',
+                 headers=[('Accept', 'application/cdmi-object'),
+                          ('X-CDMI-Specification-Version', CDMI_VERSION)]),
+        Scenario('cdmi_put', root + '/cdmi_put', method='PUT',
+                 data=cdmi_body, creates=True,
+                 headers=[('Content-Type', 'application/cdmi-object'),
+                          ('X-CDMI-Specification-Version', CDMI_VERSION)]),
+    ]
+    for listing_size in listing_sizes:
+        path = '%s/ls_%d/' % (root, listing_size)
+        scenarios.append(Scenario('ls_%d' % listing_size, path))
+        scenarios.append(Scenario('json_ls_%d' % listing_size, path,
+                                  headers=[('Accept', 'application/json')]))
+    return scenarios
+
+
+def run_scenario(app, scenario, concurrency, duration):
+    """Send scenario from concurrency threads for duration seconds."""
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start_event = threading.Event()
+    deadline = [None]
+
+    def send(client, path):
+        rv = client.open(path, method=scenario.method,
+                         headers=scenario.headers, data=scenario.data,
+                         buffered=True)
+        rv.close()
+        return 200 <= rv.status_code < 300
+
+    def worker(thread_number):
+        client = app.test_client()
+        start_event.wait()
+        while time.time() < deadline[0]:
+            path = scenario.get_path()
+            start = time.time()
+            ok = send(client, path)
+            latencies[thread_number].append(time.time() - start)
+            if not ok:
+                errors[thread_number] += 1
+            scenario.cleanup(path)
+
+    # fills the caches, a failure here means a broken scenario
+    path = scenario.get_path()
+    if not send(app.test_client(), path):
+        raise RuntimeError('%s failed' % scenario.name)
+    scenario.cleanup(path)
+
+    threads = [threading.Thread(target=worker, args=(n,))
+               for n in range(concurrency)]
+    for t in threads:
+        t.start()
+    started = time.time()
+    deadline[0] = started + duration
+    start_event.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - started
+
+    return summarize(sorted(sum(latencies, [])), sum(errors), elapsed)
+
+
+def summarize(latencies, errors, elapsed):
+    """Return throughput and latency in milliseconds of a run."""
+    def percentile(p):
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1,
+                             int(p / 100.0 * len(latencies)))] * 1000
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'mean': (sum(latencies) / len(latencies) * 1000
+                 if latencies else 0.0),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new, threshold):
+    """Print old and new results side by side, return the regressions.
+
+    A result regressed if its throughput dropped or its median
+    latency rose by more than threshold percent. The p99 latency is
+    shown, but too noisy in short runs to judge by.
+    """
+    regressions = []
+    print '%-24s %19s %8s %19s %8s %19s' % (
+        'scenario', 'req/s old/new', 'change', 'p50 ms old/new', 'change',
+        'p99 ms old/new')
+    for key in sorted(new['results']):
+        if key not in old['results']:
+            continue
+        a = old['results'][key]
+        b = new['results'][key]
+        throughput_change = change(a['throughput'], b['throughput'])
+        p50_change = change(a['p50'], b['p50'])
+        regressed = (throughput_change < -threshold or
+                     p50_change > threshold)
+        if regressed:
+            regressions.append(key)
+        print '%-24s %9.1f %9.1f %+7.1f%% %9.1f %9.1f %+7.1f%% ' \
+            '%9.1f %9.1f%s' % (
+                key, a['throughput'], b['throughput'], throughput_change,
+                a['p50'], b['p50'], p50_change, a['p99'], b['p99'],
+                '  REGRESSION' if regressed else '')
+    return regressions
+
+
+def change(old, new):
+    if old == 0:
+        return 0.0
+    return (new - old) * 100.0 / old
+
+
+def parse_list(value, convert=str):
+    return [convert(v) for v in value.split(',') if v]
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-o', '--output', dest='output',
+                      help='Write the results to this JSON file')
+    parser.add_option('--compare', dest='compare',
+                      help='Compare with the results in this JSON file')
+    parser.add_option('--threshold', dest='threshold', type='float',
+                      default=10,
+                      help='Change in percent that counts as regression, '
+                           'default: 10')
+    parser.add_option('-s', '--scenarios', dest='scenarios',
+                      help='Comma separated scenarios to run: get, '
+                           'get_range, get_multirange, put, cdmi_get, '
+                           'cdmi_put, ls_<size>, json_ls_<size>, '
+                           'default: all')
+    parser.add_option('-c', '--concurrency', dest='concurrency',
+                      default='1,4,16',
+                      help='Comma separated numbers of threads, '
+                           'default: 1,4,16')
+    parser.add_option('-d', '--duration', dest='duration', type='float',
+                      default=5,
+                      help='Seconds per scenario and concurrency, '
+                           'default: 5')
+    parser.add_option('--file-size', dest='file_size', type='int',
+                      default=1024 * 1024,
+                      help='Size of the file that is read and written, '
+                           'default: 1 MiB')
+    parser.add_option('--listing-sizes', dest='listing_sizes',
+                      default='10,1000,100000',
+                      help='Comma separated directory sizes to list, '
+                           'default: 10,1000,100000')
+
+    (options, args) = parser.parse_args()
+    concurrency_levels = parse_list(options.concurrency, int)
+    listing_sizes = parse_list(options.listing_sizes, int)
+
+    root = tempfile.mkdtemp(prefix='http_api_benchmark_')
+    try:
+        data = create_tree(root, options.file_size, listing_sizes)
+        BenchmarkConfig.EXPORTEDPATHS = [root]
+        BenchmarkConfig.SQLALCHEMY_DATABASE_URI = \
+            'sqlite:///' + os.path.join(root, 'registration.db')
+        app = create_app(BenchmarkConfig)
+
+        scenarios = get_scenarios(root, data, listing_sizes)
+        if options.scenarios:
+            names = parse_list(options.scenarios)
+            scenarios = [s for s in scenarios if s.name in names]
+
+        results = {
+            'meta': {
+                'revision': get_revision(),
+                'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'duration': options.duration,
+                'file_size': options.file_size,
+            },
+            'results': {},
+        }
+        for scenario in scenarios:
+            for concurrency in concurrency_levels:
+                key = '%s@%d' % (scenario.name, concurrency)
+                result = run_scenario(app, scenario, concurrency,
+                                      options.duration)
+                results['results'][key] = result
+                print '%-24s %8.1f req/s  p50 %7.1fms  p99 %7.1fms  ' \
+                    'errors %d' % (key, result['throughput'], result['p50'],
+                                   result['p99'], result['errors'])
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(root)
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            old_results = json.load(f)
+        print
+        if compare(old_results, results, options.threshold):
+            sys.exit(1)
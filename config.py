@@ -19,9 +19,36 @@ ACTIVATE_CDMI = True
 CDMI_DOMAIN = 'cern.ch'
 CDMI_ENTERPRISE_NUMBER = 20456
 
+# request metrics in the Prometheus text format, served without
+# authentication at METRICS_URL. It hides a storage object at the
+# same path.
+ACTIVATE_METRICS = True
+METRICS_URL = '/metrics'
+
+# sampling profiler: the stacks of running requests are sampled every
+# PROFILER_INTERVAL seconds. The samples of every
+# PROFILER_SAMPLE_RATE-th request and of requests that take at least
+# PROFILER_SLOW_THRESHOLD seconds are written to PROFILER_DIR, 0
+# disables either; only the newest PROFILER_MAX_FILES are kept. The
+# files are in the folded format of flamegraph.pl. Logged in users
+# get the samples of all requests at PROFILER_URL/flamegraph and can
+# sample for some seconds at PROFILER_URL/capture?seconds=10.
+ACTIVATE_PROFILER = False
+PROFILER_INTERVAL = 0.02
+PROFILER_SAMPLE_RATE = 1000
+PROFILER_SLOW_THRESHOLD = 1.0
+PROFILER_DIR = '/tmp/http_profiles'
+PROFILER_MAX_FILES = 100
+PROFILER_URL = '/profiler'
+PROFILER_MAX_CAPTURE = 60
+
 # json frontend settings
 ACTIVATE_JSON = False
 
+# html frontend settings
+# number of entries on one page of a directory listing
+LISTING_PAGE_SIZE = 1000
+
 ############################
 # STORAGE BACKEND SETTINGS
 
@@ -31,6 +58,24 @@ STORAGE = 'irods'  # local, irods, dmlite
 HOST = '127.0.0.1'
 PORT = 8080
 
+# gevent_server.py: the address to listen on, HOST and PORT above
+# are those of the development server in run.py
+SERVER_HOST = '0.0.0.0'
+SERVER_PORT = 5000
+# number of worker processes, 0 for one per core
+SERVER_WORKERS = 0
+# connections the kernel queues while all workers are busy
+SERVER_BACKLOG = 1024
+# seconds an idle keep-alive connection is kept open, 0 disables
+# keep-alive
+SERVER_KEEPALIVE = 60
+# seconds workers get to finish their requests on reload and stop
+SERVER_GRACEFUL_TIMEOUT = 30
+# serve HTTPS with this key and certificate, SSL_CACERTS is optional
+SSL_KEY = None
+SSL_CERT = None
+SSL_CACERTS = None
+
 # in case of a proxy (e.g. for SSL and/or x509 client certs),
 # specify the proxy coordinates (where this app can redirect to)
 # leave it empty, then the app generates relative links
@@ -50,6 +95,56 @@ RODSZONE = 'tempZone'
 # dmlite storage settings
 ## none for now
 
+# storage connection pool settings (irods, dmlite)
+# maximum number of open connections in total and per user
+STORAGE_POOL_SIZE = 50
+STORAGE_POOL_USER_SIZE = 10
+# close connections that have been idle for so many seconds
+STORAGE_POOL_IDLE_TIMEOUT = 300
+# how long a request waits for a connection if the pool is exhausted
+STORAGE_POOL_WAIT_TIMEOUT = 5
+# with gevent_server.py, blocking storage calls run in a pool of so
+# many native threads, so that slow iRODS or dmlite calls do not stop
+# the other requests. 0 runs them in the request greenlet.
+STORAGE_IO_THREADS = 20
+
+# multi-range reads: ranges that overlap or are at most so many bytes
+# apart are read from the storage at once
+RANGE_MERGE_GAP = 65536
+# read the next part of a file in a thread while the current part is
+# sent. Not used with STORAGE_IO_THREADS under gevent.
+RANGE_READ_AHEAD = False
+
+# checksum that is computed while files are written and stored in
+# their user metadata: md5, sha256 or adler32
+CHECKSUM_ALGORITHM = 'md5'
+
+# how many seconds the results of stat and user metadata lookups are
+# cached. Changes made through this process are seen at once, changes
+# made directly in the storage after at most so many seconds.
+# set to 0 to disable the cache
+METADATA_CACHE_TTL = 5
+
+# outgoing HTTP requests (remote copies, registration, handles)
+# connections kept open per host, shared by all threads
+HTTP_CLIENT_POOL_SIZE = 10
+# how often a failed idempotent request is retried, and the wait
+# in seconds before the first retry, doubled for each further one
+HTTP_CLIENT_RETRIES = 3
+HTTP_CLIENT_BACKOFF = 0.5
+# seconds to wait for a connection or for data from the server
+HTTP_CLIENT_TIMEOUT = 60
+
+############################
+# AUTHENTICATION SETTINGS  #
+############################
+
+# how many seconds a successful username/password check is cached
+# set to 0 to check with the storage backend on every request
+AUTH_CACHE_TTL = 60
+# how many seconds a failed check is cached
+AUTH_CACHE_NEGATIVE_TTL = 5
+
 ############################
 # REGISTRATION SETTINGS    #
 ############################
@@ -59,6 +154,31 @@ ACTIVATE_REGISTRATION = True
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'http.db')
 REQUESTS_PER_PAGE = 5
 
+# registration requests are queued in the database and run by
+# worker threads. Workers of several processes and hosts can share
+# the queue, see run_workers.py. Set to 0 to run no workers in the
+# web frontend.
+REGISTRATION_WORKERS = 5
+# seconds a worker keeps a request before others may take it over;
+# it is renewed while the worker is alive
+REGISTRATION_LEASE_TIME = 300
+# how often a failed workflow step is tried, and the wait in seconds
+# before the first retry, doubled for each further one
+REGISTRATION_MAX_ATTEMPTS = 3
+REGISTRATION_RETRY_BACKOFF = 30
+# seconds idle workers wait before they look for requests queued
+# by other processes
+REGISTRATION_POLL_INTERVAL = 2
+# status changes of the workers are collected and written to the
+# database in one transaction every this many seconds
+REGISTRATION_STATUS_INTERVAL = 0.5
+
+# the credentials of queued requests are encrypted with this key.
+# Requests are refused while it is not set. It must be a key of its
+# own, made by Fernet.generate_key() of the cryptography package, see
+# README.md. All processes that share the queue need the same key.
+REGISTRATION_CREDENTIALS_KEY = None
+
 # the destination host for file registering requests.
 # this should be an fqdn of the (or a) machine where the http-api
 # storage runs on.
@@ -87,6 +207,18 @@ IRODS_REPLICATION_DESTINATION = '/%s/replicated/' % RODSZONE
 HANDLE_URI = 'http://localhost:5000'
 HANDLE_USER = 'user'
 HANDLE_PASS = 'pass'
+# resolved handles are cached as long as their ttl allows, but at
+# most this many seconds
+PID_CACHE_TTL = 300
+# how many seconds a handle that does not exist is cached
+PID_CACHE_NEGATIVE_TTL = 30
+# downloads by PID without a local copy are redirected to a replica
+# on another site. The sites are probed with a HEAD request at most
+# every REPLICA_PROBE_INTERVAL seconds to measure their latency, 0
+# disables probing. A site whose probe failed is skipped for
+# REPLICA_FAILURE_COOLDOWN seconds.
+REPLICA_PROBE_INTERVAL = 300
+REPLICA_FAILURE_COOLDOWN = 60
 HANDLE_PREFIX = '666'
 
 # this is where handles are written to
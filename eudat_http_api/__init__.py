@@ -1,6 +1,10 @@
 from flask import Flask
 from flask_bootstrap import Bootstrap
 
+from eudat_http_api.httpsession import configure_session_from
+from eudat_http_api import metrics
+from eudat_http_api import profiler
+
 
 def create_app(config_name):
     app = Flask(__name__)
@@ -16,6 +20,14 @@ def create_app(config_name):
         file_handler.setLevel(logging.WARNING)
         app.logger.addHandler(file_handler)
 
+    configure_session_from(app.config)
+
+    if app.config.get('ACTIVATE_METRICS', True):
+        metrics.init_app(app)
+
+    if app.config.get('ACTIVATE_PROFILER', False):
+        profiler.init_app(app)
+
     with app.app_context():
         # the app context is needed to switch the storage
         # backend based on the config parameter.
@@ -39,6 +51,7 @@ def create_app(config_name):
             from eudat_http_api.registration import models
             models.db.app = app
             models.db.init_app(app)
+            models.configure_engine(app)
 
         from eudat_http_api.auth.auth import login_manager
         login_manager.init_app(app)
@@ -7,8 +7,11 @@ from flask import Response
 
 from flask.ext.login import LoginManager
 from eudat_http_api.auth.common import AuthException
+from eudat_http_api.auth.common import AuthMethod
 from eudat_http_api.auth.common import UserInfo
+from eudat_http_api.auth.common import auth_cache
 from eudat_http_api.http_storage import storage
+from eudat_http_api.metrics import metrics
 
 
 login_manager = LoginManager()
@@ -28,16 +31,40 @@ def check_auth(auth_info):
 
   Contact the auth-service to check the
   credentials.
+
+  Results for username/password are cached by the auth hash
+  for AUTH_CACHE_TTL seconds, failures for AUTH_CACHE_NEGATIVE_TTL
+  seconds. Certificate authentication is not cached, because
+  the verification result is not part of the auth hash.
   """
 
     current_app.logger.debug('auth.check_auth with auth_info:')
     current_app.logger.debug(auth_info)
+
+    cacheable = auth_info.method == AuthMethod.Pass
+    if cacheable:
+        auth_hash = auth_info.get_auth_hash()
+        cached = auth_cache.get(auth_hash)
+        if cached is not None:
+            current_app.logger.debug('auth result from the cache')
+            return cached
+
     try:
-        return storage.authenticate(auth_info)
+        with metrics.timer('auth_duration_seconds'):
+            authenticated = storage.authenticate(auth_info)
     except storage.StorageException as e:
         raise AuthException('Internal server error: %s'
                             % (e.msg))
 
+    if cacheable:
+        if authenticated:
+            ttl = current_app.config.get('AUTH_CACHE_TTL', 60)
+        else:
+            ttl = current_app.config.get('AUTH_CACHE_NEGATIVE_TTL', 5)
+        auth_cache.set(auth_hash, authenticated, ttl)
+
+    return authenticated
+
 
 @login_manager.request_loader
 def load_user(request):
@@ -4,6 +4,8 @@ from __future__ import with_statement
 
 import hashlib
 
+from eudat_http_api.cache import Cache
+
 
 class AuthException(Exception):
     def __init__(self, msg):
@@ -17,6 +19,20 @@ class AuthMethod(object):
     NoAuth, Pass, Gsi = range(3)
 
 
+# results of successful and failed password checks by auth hash,
+# see auth.check_auth
+auth_cache = Cache(max_size=10000)
+
+
+def invalidate_auth(auth_info):
+    """Forget the cached authentication result of a user.
+
+    Called when the storage rejects credentials that were
+    accepted before, e.g. after a password change.
+    """
+    auth_cache.delete(auth_info.get_auth_hash())
+
+
 class UserInfo(object):
     """Object holding all auth/authz-relevant info.
 
@@ -37,6 +53,7 @@ class UserInfo(object):
     userverifiedok = None
     client_address = None
     auth_hash = None
+    authenticated = None
 
     def __init__(self, check_auth_func):
         self.check_auth_func = check_auth_func
@@ -83,13 +100,19 @@ class UserInfo(object):
     def get_auth_hash(self):
         auth_hash = "anonymous"
         if self.method == AuthMethod.Pass:
-            auth_hash = hashlib.sha1(self.username + self.password).hexdigest()
+            # separate the fields, so that user 'ab' with password 'c'
+            # does not get the same hash as user 'a' with password 'bc'
+            auth_hash = hashlib.sha1('%s:%s' % (self.username,
+                                                self.password)).hexdigest()
         elif self.method == AuthMethod.Gsi:
             auth_hash = hashlib.sha1(self.userdn).hexdigest()
         return auth_hash
 
     def is_authenticated(self):
-        return self.check_auth_func(self)
+        # flask-login asks more than once per request
+        if self.authenticated is None:
+            self.authenticated = self.check_auth_func(self)
+        return self.authenticated
 
     def is_active(self):
         return self.is_authenticated()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from collections import OrderedDict
+import sys
+from threading import Event, Lock
+import time
+
+
+_missing = object()
+
+
+class _Call(object):
+    """A computation of get_or_compute that other threads wait for."""
+    def __init__(self):
+        self.done = Event()
+        self.value = None
+        self.exc_info = None
+
+
+class Cache(object):
+    """Thread-safe LRU cache with expiring entries.
+
+    Holds at most max_size entries. When it is full, the least
+    recently used entry is dropped.
+    Each entry expires after ttl seconds, which can be given per
+    entry in set(). A ttl of 0 or less means the value is not
+    stored at all.
+
+    The counters in stats count hits and misses of get() and
+    get_or_compute().
+    """
+
+    def __init__(self, max_size=1000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+        self.mutex = Lock()
+        # running computations of get_or_compute by key
+        self.calls = dict()
+
+    def _get(self, key, default):
+        try:
+            expires, value = self.entries.pop(key)
+        except KeyError:
+            self.stats['misses'] += 1
+            return default
+
+        if expires < time.time():
+            self.stats['misses'] += 1
+            return default
+
+        # re-insert to mark it as most recently used
+        self.entries[key] = (expires, value)
+        self.stats['hits'] += 1
+        return value
+
+    def get(self, key, default=None):
+        with self.mutex:
+            return self._get(key, default)
+
+    def get_or_compute(self, key, compute):
+        """Return the value of key, call compute() if it is not cached.
+
+        compute returns (value, ttl), the value is stored for ttl
+        seconds. If several threads miss the same key at the same
+        time, only the first one calls compute, the others wait for
+        its result. An exception of compute is raised in all of them
+        and nothing is stored.
+        """
+        with self.mutex:
+            value = self._get(key, _missing)
+            if value is not _missing:
+                return value
+            call = self.calls.get(key, None)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.value
+
+        try:
+            call.value, ttl = compute()
+            self.set(key, call.value, ttl)
+        except Exception:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self.mutex:
+                del self.calls[key]
+            call.done.set()
+        return call.value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+
+        with self.mutex:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.mutex:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.mutex:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
@@ -1,25 +1,82 @@
 # -*- coding: utf-8 -*-
 
 from flask import json
-import requests
+
+from eudat_http_api.httpsession import get_session
+
+
+class ResponseBodyStream(object):
+    """File-like view of the body of a streamed requests response.
+
+    Only one chunk of the body is held in memory at a time.
+    requests sends it as request body with a Content-Length if len
+    is set, and with chunked transfer encoding otherwise. len is the
+    Content-Length of the response, unless the body is content-encoded
+    and decoded by iter_content().
+    """
+    def __init__(self, response, chunk_size=4194304):
+        self.chunks = response.iter_content(chunk_size)
+        self.chunk = ''
+        self.offset = 0
+        self.len = None
+        if response.headers.get('content-encoding',
+                                'identity') == 'identity':
+            content_length = response.headers.get('content-length')
+            if content_length is not None:
+                self.len = int(content_length)
+
+    def __iter__(self):
+        if self.offset < len(self.chunk):
+            yield self.chunk[self.offset:]
+            self.chunk, self.offset = '', 0
+        for chunk in self.chunks:
+            if chunk:
+                yield chunk
+
+    def read(self, size=-1):
+        """Read at most size bytes, less at the end of a chunk.
+
+        Returns '' only at the end of the body.
+        """
+        if size < 0:
+            return ''.join(self)
+
+        while self.offset >= len(self.chunk):
+            try:
+                self.chunk, self.offset = next(self.chunks), 0
+            except StopIteration:
+                return ''
+
+        data = self.chunk[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
 
 
 class CDMIClient:
-    def __init__(self, auth):
+    """Client for a CDMI or plain HTTP storage.
+
+    All clients share one session, and with it the open connections,
+    unless a session is given.
+    """
+    def __init__(self, auth, session=None):
         self.auth = auth
+        if session is None:
+            session = get_session()
+        self.session = session
 
     def cdmi_head(self, url):
         headers = {
             'Accept': 'application/cdmi-object',
             'X-CDMI-Specification-Version': '1.0.2',
         }
-        r = requests.head(url, headers=headers, auth=self.auth)
+        r = self.session.head(url, headers=headers, auth=self.auth)
         return r
 
     def get(self, url, stream=False):
         headers = {}
 
-        r = requests.get(url, headers=headers, auth=self.auth, stream=stream)
+        r = self.session.get(url, headers=headers, auth=self.auth,
+                             stream=stream)
 
         return r
 
@@ -29,7 +86,8 @@ class CDMIClient:
             'X-CDMI-Specification-Version': '1.0.2',
         }
 
-        r = requests.get(url, headers=headers, auth=self.auth, stream=stream)
+        r = self.session.get(url, headers=headers, auth=self.auth,
+                             stream=stream)
 
         return r
 
@@ -38,8 +96,8 @@ class CDMIClient:
         if headers is not None:
             rheaders.update(headers)
 
-        return requests.put(url, headers=rheaders,
-                            data=data, auth=self.auth)
+        return self.session.put(url, headers=rheaders,
+                                data=data, auth=self.auth)
 
     def cdmi_put(self, url, data):
         cdmi_headers = {
@@ -51,8 +109,8 @@ class CDMIClient:
             'value': data,
         })
 
-        return requests.put(url, headers=cdmi_headers,
-                            data=cdmi_data, auth=self.auth)
+        return self.session.put(url, headers=cdmi_headers,
+                                data=cdmi_data, auth=self.auth)
 
     def cdmi_copy(self, url, src_url):
         cdmi_headers = {
@@ -65,8 +123,8 @@ class CDMIClient:
             'copy': src_url,
         })
 
-        return requests.put(url, headers=cdmi_headers,
-                            data=cdmi_data, auth=self.auth)
+        return self.session.put(url, headers=cdmi_headers,
+                                data=cdmi_data, auth=self.auth)
 
     def cdmi_delete(self, url):
         headers = {
@@ -74,6 +132,6 @@ class CDMIClient:
             'X-CDMI-Specification-Version': '1.0.2',
         }
 
-        r = requests.delete(url, headers=headers, auth=self.auth)
+        r = self.session.delete(url, headers=headers, auth=self.auth)
 
         return r
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import binascii
+import hashlib
+import zlib
+
+
+# the user metadata field that holds the checksum of an object
+METADATA_KEY = 'checksum'
+
+
+class UnknownAlgorithmException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+class _Adler32(object):
+    """hashlib-like wrapper around zlib.adler32."""
+    def __init__(self):
+        self.value = 1
+
+    def update(self, data):
+        self.value = zlib.adler32(data, self.value)
+
+    def hexdigest(self):
+        return '%08x' % (self.value & 0xffffffff)
+
+
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'adler32': _Adler32,
+}
+
+
+class Checksum(object):
+    """Incrementally computed checksum of a data stream.
+
+    The value is written as '<algorithm>:<hex digest>', e.g.
+    'md5:d41d8cd98f00b204e9800998ecf8427e', so it can be read back
+    without knowing which algorithm was configured at the time.
+    """
+    def __init__(self, algorithm='md5'):
+        if algorithm not in ALGORITHMS:
+            raise UnknownAlgorithmException(
+                'unknown checksum algorithm: %s' % algorithm)
+        self.algorithm = algorithm
+        self._hash = ALGORITHMS[algorithm]()
+
+    def update(self, data):
+        self._hash.update(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+    def value(self):
+        return '%s:%s' % (self.algorithm, self.hexdigest())
+
+    def wrap(self, gen):
+        """Pass the chunks of gen through and add them to the checksum."""
+        for chunk in gen:
+            self.update(chunk)
+            yield chunk
+
+
+def parse_checksum(value):
+    """Split a checksum value into algorithm and hex digest."""
+    algorithm, sep, digest = value.partition(':')
+    if not sep or algorithm not in ALGORITHMS:
+        raise UnknownAlgorithmException(
+            'not a checksum value: %s' % value)
+    return algorithm, digest
+
+
+# names of the algorithms in Digest and Want-Digest headers, RFC 3230
+DIGEST_NAMES = {
+    'md5': 'MD5',
+    'sha256': 'SHA-256',
+    'adler32': 'ADLER32',
+}
+
+
+def make_digest_header(value):
+    """Return the Digest header for a checksum value.
+
+    MD5 and SHA-256 digests are base64 encoded, ADLER32 is hex.
+    """
+    algorithm, digest = parse_checksum(value)
+    if algorithm != 'adler32':
+        digest = base64.b64encode(binascii.a2b_hex(digest))
+    return '%s=%s' % (DIGEST_NAMES[algorithm], digest)
+
+
+def parse_want_digest(header):
+    """Return the preferred algorithm of a Want-Digest header.
+
+    Returns None if none of the algorithms is supported.
+    """
+    algorithms = dict((name.lower(), algorithm)
+                      for algorithm, name in DIGEST_NAMES.iteritems())
+    best, best_q = None, 0.0
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                continue
+        algorithm = algorithms.get(name.strip().lower(), None)
+        if algorithm is not None and q > best_q:
+            best, best_q = algorithm, q
+    return best
@@ -1,8 +1,11 @@
-from requests import get, post
+from collections import namedtuple
+from cStringIO import StringIO
 import json
 import requests
 from urlparse import urlparse
-from BeautifulSoup import BeautifulStoneSoup
+from xml.etree import cElementTree as ElementTree
+
+from eudat_http_api.httpsession import get_session
 
 
 def create_uri(base_uri, prefix, suffix=''):
@@ -22,6 +25,42 @@ def extract_prefix_suffix(url):
     return tokenized[-2], tokenized[-1]
 
 
+# an entry of a 10320/LOC value. weight is between 0 and 1, a
+# location with weight 0 is not used for resolution. view is None
+# if the location has no view attribute.
+Location = namedtuple('Location', ['href', 'weight', 'view'])
+
+
+def parse_locations(loc):
+    """Return the Locations of the XML in a 10320/LOC value.
+
+    The XML is parsed incrementally with expat, the location elements
+    are dropped once their attributes are read. Entries without href
+    are skipped. If the XML is broken, the locations before the error
+    are returned.
+    """
+    if isinstance(loc, unicode):
+        loc = loc.encode('utf-8')
+
+    locations = []
+    try:
+        for _, elem in ElementTree.iterparse(StringIO(loc)):
+            if elem.tag != 'location':
+                continue
+            href = elem.get('href')
+            if href:
+                try:
+                    weight = float(elem.get('weight', 1))
+                except ValueError:
+                    weight = 1.0
+                locations.append(Location(href, weight, elem.get('view')))
+            elem.clear()
+    except SyntaxError:
+        # ParseError is a SyntaxError
+        pass
+    return locations
+
+
 def rename_key_in_dictionary(dictionary, old_name, new_name):
     if dictionary.has_key(old_name):
         dictionary[new_name] = dictionary.pop(old_name)
@@ -41,13 +80,22 @@ class HandleRecord(object):
     CHECKSUM_TYPE_NAME = 'CHECKSUM'
     LOC = '10320/LOC'
 
+    TTL_STR = 'ttl'
+
     def __init__(self):
 
         self.content = list()
+        # parsed 10320/LOC value, see get_locations
+        self._locations = None
+        # seconds the record may be cached, the smallest ttl of its
+        # values. None if the service does not send ttls.
+        self.ttl = None
 
     def add_value(self, entry_type, data):
         self.content.append({self.TYPE_STR: entry_type,
                              self.DATA_STR: data})
+        if entry_type == self.LOC:
+            self._locations = None
 
     def add_url(self, url):
         self.add_value(entry_type=self.URL_TYPE_NAME, data=url)
@@ -72,23 +120,40 @@ class HandleRecord(object):
         return self.get_data_with_property_value(self.TYPE_STR,
                                                  self.CHECKSUM_TYPE_NAME)
 
+    def get_locations(self):
+        """Returns the entries of the 10320/LOC field as Locations.
+
+        The field is parsed once, from_json does it when the record
+        is read.
+        """
+        if self._locations is None:
+            loc = self.get_data_with_property_value(self.TYPE_STR, self.LOC)
+            if loc and isinstance(loc, basestring):
+                self._locations = parse_locations(loc)
+            else:
+                self._locations = []
+        return self._locations
+
+    def get_weighted_locations(self):
+        """Returns the URL and the 10320/LOC entries as Locations.
+
+        The URL has weight 1, unless it is in 10320/LOC as well.
+        """
+        locations = list(self.get_locations())
+        url = self.get_url_value()
+        if url and url not in [l.href for l in locations]:
+            locations.insert(0, Location(url, 1.0, None))
+        return locations
+
     def get_all_locations(self):
         """Returns list of all locations found in Handle record
 
-        Locations can be found at two places URL and 10320/LOC field. The
-        later field has to be parsed.
+        Locations can be found at two places URL and 10320/LOC field.
+        The URL comes first.
 
         """
-        locations = [self.get_url_value()]
-
-        loc = self.get_data_with_property_value(self.TYPE_STR, self.LOC)
-        if not loc:
-            return locations
-
-        soup = BeautifulStoneSoup(loc)
-        for l in soup.findAll('location'):
-            locations.append(l['href'])
-        return locations
+        return [self.get_url_value()] + \
+            [l.href for l in self.get_locations()]
 
     def as_epic_json_array(self):
         cpy = list(self.content)
@@ -114,17 +179,23 @@ class HandleRecord(object):
             data_field_name = HandleRecord.EPIC_DATA_STR
 
         h = HandleRecord()
+        ttls = []
         for entry in json_array:
             h.add_value(entry[h.TYPE_STR], entry[data_field_name])
+            if isinstance(entry.get(h.TTL_STR, None), (int, long)):
+                ttls.append(entry[h.TTL_STR])
+        if ttls:
+            h.ttl = min(ttls)
+        h.get_locations()
 
         return h
 
 
     @staticmethod
-    def get_handle_with_values(url, checksum=0):
+    def get_handle_with_values(url, checksum=None):
         h = HandleRecord()
         h.add_url(url)
-        if checksum != 0:
+        if checksum:
             h.add_checksum(checksum)
 
         return h
@@ -136,11 +207,17 @@ class EpicClient(object):
     SARA_BASE_URI = 'https://epic.sara.nl/v2/handles/'
     HANDLE_BASE_URI = 'http://hdl.handle.net/api/handles/'
 
-    def __init__(self, base_uri, credentials, debug=False):
-        """Initialize object with connection parameters."""
+    def __init__(self, base_uri, credentials, debug=False, session=None):
+        """Initialize object with connection parameters.
+
+        Uses the shared HTTP session if no session is given.
+        """
         self.accept_format = 'application/json'
         self.debug = debug
         self.credentials = credentials
+        if session is None:
+            session = get_session()
+        self.session = session
         if base_uri[-1] == '/':
             self.base_uri = base_uri[:-1]
         else:
@@ -164,13 +241,7 @@ class EpicClient(object):
         Returns handle record
 
         """
-        headers = {'Accept': self.accept_format}
-
-        response = get(url=create_uri(base_uri=self.base_uri, prefix=prefix,
-                                      suffix=suffix),
-                       headers=headers,
-                       auth=self.credentials,
-                       allow_redirects=False)
+        response = self.retrieve_handle_response(prefix, suffix)
 
         if response is None:
             return None
@@ -182,6 +253,21 @@ class EpicClient(object):
 
         return HandleRecord.from_json(response.json())
 
+    def retrieve_handle_response(self, prefix, suffix=''):
+        """GET a handle, return the response of the PID service.
+
+        For callers that need to tell a missing handle (404) from
+        other errors.
+        """
+        headers = {'Accept': self.accept_format}
+
+        return self.session.get(
+            url=create_uri(base_uri=self.base_uri, prefix=prefix,
+                           suffix=suffix),
+            headers=headers,
+            auth=self.credentials,
+            allow_redirects=False)
+
     def create_new(self, prefix, handle_record):
         """Create new handle
 
@@ -199,10 +285,10 @@ class EpicClient(object):
         record_uri = create_uri(base_uri=self.base_uri,
                                 prefix=prefix, suffix='')
         self._debug_msg('createNew', 'URI = %s' % record_uri)
-        response = post(url=record_uri,
-                        headers=headers,
-                        data=handle_record.as_epic_json_array(),
-                        auth=self.credentials)
+        response = self.session.post(url=record_uri,
+                                     headers=headers,
+                                     data=handle_record.as_epic_json_array(),
+                                     auth=self.credentials)
 
         if response is None:
             return None
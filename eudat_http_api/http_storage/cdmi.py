@@ -2,17 +2,20 @@
 
 from __future__ import with_statement
 
-from base64 import b64encode  # , b64decode
 from collections import deque
 from functools import partial
 from functools import wraps
-#from ijson.backends.yajl2 import parse
-from ijson.backends.python import parse
+from ijson import JSONError, IncompleteJSONError
+try:
+    from ijson.backends import yajl2 as ijson_backend
+except ImportError:
+    from ijson.backends import python as ijson_backend
 from inspect import isgenerator
 from itertools import islice
 from itertools import ifilter
 import re
 import requests
+from StringIO import StringIO
 
 from urlparse import urlparse
 
@@ -28,10 +31,12 @@ from flask import stream_with_context
 from flask.ext.login import login_required
 
 from eudat_http_api import metadata
+from eudat_http_api.checksum import parse_checksum
 from eudat_http_api.http_storage import common
 from eudat_http_api.http_storage import storage
 from eudat_http_api.http_storage.common import get_config_parameter
 from eudat_http_api.http_storage.common import create_hex_object_id
+from eudat_http_api.httpsession import get_session
 
 
 CDMI_VERSION = '1.0.2'
@@ -394,7 +399,12 @@ def put_file_obj(path):
         StreamWrapper(request.environ['wsgi.input'])
     request.shallow = False
 
-    cdmi_json, value_gen = _parse_cdmi_msg_body_fields(request.stream)
+    try:
+        cdmi_json, value_gen = _parse_cdmi_msg_body_fields(
+            common.get_request_stream(request))
+    except MalformedMsgBodyException as e:
+        return e.msg, 400
+
     if 'copy' in cdmi_json:
         value_uri = '%s' % cdmi_json['copy']
         value_path = urlparse(value_uri).path
@@ -414,8 +424,18 @@ def put_file_obj(path):
         stream = _get_value_stream(value_uri, auth)
         value_gen = common.stream_generator(stream)
 
+    if value_gen is None:
+        value_gen = iter([])
+
+    # the checksum is computed while the data is written, so the
+    # data does not have to be read again
+    checksum = common.create_checksum()
+    value_gen = checksum.wrap(value_gen)
+
     try:
         storage.write(path, value_gen)
+    except MalformedMsgBodyException as e:
+        return e.msg, 400
     except storage.RedirectException as e:
         return redirect(e.location, code=e.redir_code)
     except storage.NotFoundException as e:
@@ -434,6 +454,7 @@ def put_file_obj(path):
     hex_obj_id = create_hex_object_id()
     try:
         storage.set_user_metadata(path, {'objectID': hex_obj_id})
+        storage.set_checksum(path, checksum.value())
     except storage.StorageException:
         current_app.logger.debug('setting an objectID failed on: %s' % path)
 
@@ -483,10 +504,15 @@ def copy_file_obj(srcpath, path, force=False):
     except storage.MalformedPathException as e:
         return e.msg, 400
 
-    # store the CDMI Object ID
+    # store the CDMI Object ID, and keep the checksum of the source
+    # if it is known
     hex_obj_id = create_hex_object_id()
     try:
         storage.set_user_metadata(path, {'objectID': hex_obj_id})
+        value = metadata.get_checksum(
+            srcpath, get_config_parameter('CHECKSUM_ALGORITHM', 'md5'))
+        if value is not None:
+            storage.set_checksum(path, value)
     except storage.StorageException:
         current_app.logger.debug('setting an objectID failed on: %s' % path)
 
@@ -553,45 +579,220 @@ def _parse_cdmi_msg_body_fields(handle, buffer_size=4194304):
      valuerange and value fields shall appear last and
      in that order."
 
-     FIXIT: this first implementation is only partial,
-     to accomodate requests that fit in one buffer_size.
-
+    The body is only read up to the start of the value. The
+    generator reads and decodes the rest of the value while it
+    is consumed (see _CdmiBodyReader), so the value is never
+    held in memory as a whole.
     """
-    parser = parse(handle)
+    reader = _CdmiBodyReader(handle, buffer_size)
+    data_json = reader.read_fields()
 
-    data_json = dict()
     value_gen = None
-
-    for prefix, event, value in parser:
-        if value == 'value':
-            def make_value_gen(val, encoding, buffer_size=4 * 1024):
-                """ This function works with the current ijson.
-
-                ijson itself should be modified so that it can return
-                an iterator. Then this function will become simpler,
-                but will be used to apply any special encoding.
-                """
-                acc = 0
-                out = None
-                while out != '':
-                    out = val[acc:acc + buffer_size]
-                    acc += buffer_size
-                    yield out
-
-            pre, eve, val = next(parser)
-            value_gen = make_value_gen(
-                val,
-                data_json.get('valuetransferencoding', None)
-            )
-            break
-        if prefix != '':
-            data_json[prefix] = value
+    if reader.value_follows:
+        value_gen = reader.value_generator(
+            data_json.get('valuetransferencoding', None))
 
     return data_json, value_gen
 
 
+class _CdmiBodyReader(object):
+    """Incremental reader for CDMI request bodies.
+
+    read_fields() scans the body until the top-level value field
+    starts and parses everything before it with ijson (using the
+    yajl2 C backend if it is installed). value_generator() then
+    decodes the JSON string of the value chunk by chunk, and the
+    base64 encoding if the valuetransferencoding says so.
+    """
+
+    def __init__(self, handle, buffer_size):
+        self.handle = handle
+        self.buffer_size = buffer_size
+        self.buf = ''
+        self.pos = 0
+        self.value_follows = False
+
+    def read_fields(self):
+        depth = 0
+        in_string = False
+        escape = False
+        expect_key = False
+        string_start = None
+        key = None
+        key_start = None
+
+        i = 0
+        while True:
+            if i >= len(self.buf):
+                data = self.handle.read(self.buffer_size)
+                if not data:
+                    break
+                self.buf += data
+
+            c = self.buf[i]
+            if in_string:
+                if escape:
+                    escape = False
+                elif c == '\\':
+                    escape = True
+                elif c == '"':
+                    in_string = False
+                    if depth == 1 and expect_key:
+                        key = self.buf[string_start + 1:i]
+                        key_start = string_start
+                        expect_key = False
+            elif c == '"':
+                if depth == 1 and key == 'value' and not expect_key:
+                    # the value field starts here
+                    self.value_follows = True
+                    self.pos = i + 1
+                    fields = self.buf[:key_start].rstrip().rstrip(',')
+                    return self._parse_fields('%s}' % fields)
+                in_string = True
+                string_start = i
+            elif c in '{[':
+                depth += 1
+                if depth == 1:
+                    expect_key = True
+            elif c in '}]':
+                depth -= 1
+            elif c == ',' and depth == 1:
+                expect_key = True
+                key = None
+            elif depth == 1 and key == 'value' and c not in ' \t\r\n:':
+                # the value is not a string, nothing to stream
+                key = None
+            i += 1
+
+        return self._parse_fields(self.buf)
+
+    def _parse_fields(self, fields_json):
+        try:
+            fields = next(ijson_backend.items(StringIO(fields_json), ''))
+        except (StopIteration, JSONError, IncompleteJSONError) as e:
+            raise MalformedMsgBodyException(
+                'Could not parse the message body: %s' % e)
+
+        if not isinstance(fields, dict):
+            raise MalformedMsgBodyException(
+                'The message body is not a JSON object')
+        return fields
+
+    def value_generator(self, encoding):
+        string_decoder = _JsonStringDecoder()
+        base64_decoder = None
+        if encoding == 'base64':
+            base64_decoder = common.Base64StreamDecoder()
+
+        data = self.buf[self.pos:]
+        self.buf = ''
+        try:
+            while True:
+                if data:
+                    value, done = string_decoder.decode(data)
+                    if base64_decoder is not None:
+                        value = base64_decoder.decode(value)
+                    if value:
+                        yield value
+                    if done:
+                        break
+
+                data = self.handle.read(self.buffer_size)
+                if not data:
+                    raise MalformedMsgBodyException(
+                        'The value field is not terminated')
+
+            if base64_decoder is not None:
+                base64_decoder.flush()
+        except ValueError as e:
+            raise MalformedMsgBodyException(
+                'Could not decode the value field: %s' % e)
+
+
+class _JsonStringDecoder(object):
+    """Decode the content of a JSON string that arrives in pieces.
+
+    decode() returns the decoded data (UTF-8 encoded) and whether
+    the closing quote has been reached. An escape sequence that is
+    cut off at the end of a piece is kept for the next call.
+    """
+
+    escapes = {
+        '"': '"',
+        '\\': '\\',
+        '/': '/',
+        'b': '\b',
+        'f': '\f',
+        'n': '\n',
+        'r': '\r',
+        't': '\t',
+    }
+
+    def __init__(self):
+        self.pending = ''
+        self.high_surrogate = None
+
+    def decode(self, data):
+        if self.pending:
+            data = self.pending + data
+            self.pending = ''
+
+        out = []
+        i = 0
+        n = len(data)
+        quote = data.find('"')
+        while i < n:
+            if quote != -1 and quote < i:
+                # the last quote was part of an escape sequence
+                quote = data.find('"', i)
+            backslash = data.find('\\', i, quote if quote != -1 else n)
+            if backslash == -1:
+                if quote == -1:
+                    out.append(data[i:])
+                    break
+                out.append(data[i:quote])
+                return ''.join(out), True
+
+            out.append(data[i:backslash])
+            if backslash + 1 >= n:
+                self.pending = data[backslash:]
+                break
+
+            c = data[backslash + 1]
+            if c == 'u':
+                if backslash + 6 > n:
+                    self.pending = data[backslash:]
+                    break
+                out.append(self._decode_unicode(
+                    data[backslash + 2:backslash + 6]))
+                i = backslash + 6
+            else:
+                try:
+                    out.append(self.escapes[c])
+                except KeyError:
+                    raise ValueError('Invalid escape sequence: \\%s' % c)
+                i = backslash + 2
+
+        return ''.join(out), False
+
+    def _decode_unicode(self, hex_digits):
+        try:
+            char = unichr(int(hex_digits, 16))
+        except ValueError:
+            raise ValueError('Invalid escape sequence: \\u%s' % hex_digits)
+
+        if u'\ud800' <= char < u'\udc00':
+            self.high_surrogate = char
+            return ''
+        if self.high_surrogate is not None:
+            if u'\udc00' <= char < u'\ue000':
+                char = self.high_surrogate + char
+            self.high_surrogate = None
+        return char.encode('utf-8')
+
+
 def _get_value_stream(uri, auth):
-    response = requests.get(uri, stream=True, auth=auth)
+    response = get_session().get(uri, stream=True, auth=auth)
     if response.status_code > 299:
         print response.status_code
         raise NotAuthorizedException('not authorized at the source')
@@ -639,8 +840,15 @@ def get_dir_obj(path):
     except MalformedArgumentValueException as e:
         return e.msg, 400
 
+    # let the storage return only the requested children
+    offset, limit = 0, None
+    if 'children' in cdmi_filters:
+        range_start, range_end = cdmi_filters['children']
+        offset, limit = range_start, max(0, range_end - range_start)
+        cdmi_filters['children'] = (0, None)
+
     try:
-        dir_gen = storage.ls(path)
+        dir_gen = storage.ls(path, offset, limit)
     except storage.NotFoundException as e:
         return e.msg, 404
     except storage.NotAuthorizedException as e:
@@ -755,9 +963,14 @@ def _get_cdmi_json_generator(path, obj_type, **data):
         yield flask_json.dumps('%s-%s' % (range_start, range_end))
 
     def wrap_json_string(gen):
+        # chunks are not aligned to 3 bytes, so they cannot be
+        # encoded one by one
+        encoder = common.Base64StreamEncoder()
         yield '"'
         for part in gen:
-            yield b64encode(part)
+            for encoded in encoder.encode(part):
+                yield encoded
+        yield encoder.flush()
         yield '"'
 
     def json_list_gen(iterable, func):
@@ -778,6 +991,26 @@ def _get_cdmi_json_generator(path, obj_type, **data):
                 return obj_id
         return None
 
+    def get_metadata(metadata_filter=None):
+        user_meta = dict((key, value) for key, value
+                         in meta['user_metadata'].iteritems()
+                         if key != storage.CHECKSUM_STAMP_KEY)
+        if obj_type == 'object':
+            # only computed if it is asked for, see _get_checksum_headers
+            # in noncdmi
+            algorithm = get_config_parameter('CHECKSUM_ALGORITHM', 'md5')
+            try:
+                if metadata_filter == 'cdmi_hash':
+                    value = storage.checksum(path, algorithm)
+                else:
+                    value = metadata.get_checksum(path, algorithm)
+            except storage.StorageException:
+                value = None
+            if value is not None:
+                user_meta['cdmi_value_hash'] = algorithm.upper()
+                user_meta['cdmi_hash'] = parse_checksum(value)[1]
+        return user_meta
+
     yield ('objectType', lambda x=None: 'application/cdmi-%s' % obj_type)
     yield ('objectID', lambda x=None: get_hex_object_id_or_none(meta))
     yield ('objectName', lambda x=None: obj_name)
@@ -789,7 +1022,7 @@ def _get_cdmi_json_generator(path, obj_type, **data):
            % ('dataobject' if obj_type == 'object' else obj_type))
     yield ('completionStatus', lambda x=None: 'Complete')
     #'percentComplete': '%s',  # optional
-    yield ('metadata', lambda x=None: meta['user_metadata'])
+    yield ('metadata', get_metadata)
     #'exports': {},  # optional
     #'snapshots': [],  # optional
     if obj_type == 'container':
@@ -12,6 +12,8 @@ import struct
 
 from flask import current_app
 
+from eudat_http_api.checksum import Checksum
+
 
 def get_config_parameter(param_name, default_value=None):
     return current_app.config.get(param_name, default_value)
@@ -100,11 +102,83 @@ class StreamWrapper(object):
         return rv
 
 
+def get_request_stream(request):
+    """Return the body of a request as a stream.
+
+    werkzeug gives an empty request.stream if there is no
+    Content-Length. For chunked requests, wsgi.input is returned
+    instead. The WSGI server has to decode the chunks and end
+    the stream (e.g. gevent, or mod_wsgi with WSGIChunkedRequest).
+    """
+    if (request.content_length is None and
+            'chunked' in request.headers.get('Transfer-Encoding',
+                                             '').lower()):
+        return request.environ['wsgi.input']
+    return request.stream
+
+
 def stream_generator(handle, buffer_size=41943040):
     for data in iter(partial(handle.read, buffer_size), ''):
         yield data
 
 
+class Base64StreamDecoder(object):
+    """Decode base64 data that arrives in arbitrary pieces.
+
+    Only complete groups of 4 characters are decoded, the rest is
+    kept for the next call. Whitespace is ignored.
+    Raises ValueError for malformed input.
+    """
+    def __init__(self):
+        self.rest = ''
+
+    def decode(self, data):
+        data = self.rest + data.translate(None, ' \t\r\n')
+        cut = len(data) - len(data) % 4
+        self.rest = data[cut:]
+        try:
+            return binascii.a2b_base64(data[:cut])
+        except binascii.Error as e:
+            raise ValueError('Malformed base64 data: %s' % e)
+
+    def flush(self):
+        if self.rest:
+            raise ValueError('Malformed base64 data: incomplete input')
+        return ''
+
+
+class Base64StreamEncoder(object):
+    """Encode data that arrives in arbitrary pieces as base64.
+
+    Only complete groups of 3 bytes are encoded, the rest is
+    kept for the next call, so padding only appears in flush().
+    The input is sliced with buffer() and never copied.
+    """
+    def __init__(self):
+        self.rest = ''
+
+    def encode(self, data):
+        """Return a generator of the encoded pieces of data."""
+        offset = 0
+        if self.rest:
+            offset = min(3 - len(self.rest), len(data))
+            self.rest += data[:offset]
+            if len(self.rest) < 3:
+                return
+            yield binascii.b2a_base64(self.rest)[:-1]
+
+        cut = len(data) - (len(data) - offset) % 3
+        self.rest = data[cut:]
+        if cut > offset:
+            yield binascii.b2a_base64(buffer(data, offset, cut - offset))[:-1]
+
+    def flush(self):
+        rest, self.rest = self.rest, ''
+        if rest:
+            return binascii.b2a_base64(rest)[:-1]
+        return ''
+
+
 def create_object_id_no_ctx(enterprise_number, local_id_length=8):
     """ Facility function that works without an application context."""
     # I agree that the following is ugly and quite probably not as fast
@@ -152,6 +226,11 @@ def create_hex_object_id(local_id_length=8):
     return hex_obj_id
 
 
+def create_checksum():
+    """Return a Checksum with the configured CHECKSUM_ALGORITHM."""
+    return Checksum(get_config_parameter('CHECKSUM_ALGORITHM', 'md5'))
+
+
 def unpack_object_id(obj_id):
     local_id_length = len(obj_id - 8)
     parts = struct.unpack('!cxhccH%ds' % local_id_length, obj_id)
@@ -6,10 +6,12 @@ import errno
 from functools import partial
 from functools import wraps
 from itertools import imap
+from itertools import islice
 import os
 import pydmlite
 
 from eudat_http_api.http_storage import common
+from eudat_http_api.http_storage.common import get_config_parameter
 from eudat_http_api.http_storage.storage_common import *
 
 
@@ -57,7 +59,12 @@ class DmliteConnection(Connection):
         return True
 
 
-connection_pool = ConnectionPool(DmliteConnection)
+connection_pool = ConnectionPool(
+    DmliteConnection,
+    max_pool_size=get_config_parameter('STORAGE_POOL_SIZE', 50),
+    max_user_pool_size=get_config_parameter('STORAGE_POOL_USER_SIZE', 10),
+    idle_timeout=get_config_parameter('STORAGE_POOL_IDLE_TIMEOUT', 300),
+    wait_timeout=get_config_parameter('STORAGE_POOL_WAIT_TIMEOUT', 5))
 
 
 @get_connection(connection_pool)
@@ -134,6 +141,86 @@ def set_user_metadata(path, user_metadata, conn=None):
         xstat.setString(key, value)
 
 
+# checksum types of the legacy csumtype field of the catalog
+LEGACY_CHECKSUM_TYPES = {
+    'md5': 'MD',
+    'adler32': 'AD',
+}
+
+
+def _get_native_checksum(xstat, algorithm):
+    """Return the checksum of the catalog entry, if it has one.
+
+    dmlite keeps checksums as 'checksum.<algorithm>' extended
+    attributes and updates them itself, older catalogs in csumtype
+    and csumvalue.
+    """
+    key = 'checksum.%s' % algorithm
+    if xstat.hasField(key):
+        return '%s:%s' % (algorithm, xstat.getString(key))
+    if (xstat.csumvalue and
+            LEGACY_CHECKSUM_TYPES.get(algorithm, None) == xstat.csumtype):
+        return '%s:%s' % (algorithm, xstat.csumvalue)
+    return None
+
+
+@get_connection(connection_pool)
+@path_to_ascii
+def checksum(path, algorithm='md5', compute=True, conn=None):
+    """Return the checksum of a file as '<algorithm>:<hex digest>'.
+
+    Uses the checksum of the catalog if there is one. Otherwise it
+    is computed from the file and stored in the catalog, unless
+    compute is False or the file is in a disk pool, which cannot be
+    read through this interface.
+    """
+    catalog = conn.stack.getCatalog()
+    try:
+        xstat = catalog.extendedStat(path, True)
+    except pydmlite.DmException as e:
+        raise NotFoundException('File not found')
+
+    if xstat.stat.isDir():
+        raise IsDirException('This is a directory')
+
+    value = _get_native_checksum(xstat, algorithm)
+    if value is not None or not compute or path.startswith('/dpm'):
+        return value
+
+    iohandler = conn.stack.getIODriver().createIOHandler(path, os.O_RDONLY,
+                                                         None)
+    value = compute_checksum(read_stream_generator(iohandler,
+                                                   iohandler.fstat().st_size,
+                                                   [], _read, _seek, _close),
+                             algorithm)
+    _store_checksum(catalog, path, xstat, value)
+    invalidate_metadata(path)
+    return value
+
+
+def _store_checksum(catalog, path, xstat, value):
+    algorithm, digest = parse_checksum(value)
+    xstat.setString('checksum.%s' % algorithm, digest)
+    try:
+        catalog.updateExtendedAttributes(path, xstat)
+    except pydmlite.DmException as e:
+        current_app.logger.debug('storing the checksum failed on: %s'
+                                 % path)
+
+
+@get_connection(connection_pool)
+@path_to_ascii
+def set_checksum(path, value, conn=None):
+    """Store the checksum of a file in the catalog, see checksum()."""
+    catalog = conn.stack.getCatalog()
+    try:
+        xstat = catalog.extendedStat(path, True)
+    except pydmlite.DmException as e:
+        raise NotFoundException('File not found')
+
+    _store_checksum(catalog, path, xstat, value)
+
+
 @get_connection(connection_pool)
 @path_to_ascii
 def read(path, range_list=None, query=None, conn=None):
@@ -227,13 +314,15 @@ def write(path, stream_gen, conn=None):
 
 @get_connection(connection_pool)
 @path_to_ascii
-def ls(path, conn=None):
+def ls(path, offset=0, limit=None, token=None, conn=None):
     catalog = conn.stack.getCatalog()
 
+    last_name = _get_token_name(token)
     dir_handle = catalog.openDir(path)
 
     def list_generator(catalog, dir_handle):
-        for xstat in iter(partial(catalog.readDirx, dir_handle), None):
+        for xstat in _read_dir(catalog, dir_handle, offset, limit,
+                               last_name):
             if xstat.stat.isDir():
                 yield StorageDir(xstat.name, os.path.join(path, xstat.name))
             else:
@@ -244,6 +333,77 @@ def ls(path, conn=None):
     return gen
 
 
+@get_connection(connection_pool)
+@path_to_ascii
+def ls_with_stat(path, metadata=None, offset=0, limit=None, token=None,
+                 conn=None):
+    """Return a generator of (StorageObject, stat() dict) pairs.
+
+    readDirx already returns the extended stat of every entry,
+    so no further catalog calls are needed.
+    """
+    catalog = conn.stack.getCatalog()
+
+    last_name = _get_token_name(token)
+    dir_handle = catalog.openDir(path)
+    base = path
+    if len(base) > 1:
+        base = base.rstrip('/')
+
+    def list_generator(catalog, dir_handle):
+        for xstat in _read_dir(catalog, dir_handle, offset, limit,
+                               last_name):
+            obj_path = os.path.join(path, xstat.name)
+            obj_info = {
+                'base': base,
+                'name': xstat.name,
+            }
+            if xstat.stat.isDir():
+                obj_info['type'] = DIR
+                obj_info['children'] = xstat.stat.st_size
+                obj = StorageDir(xstat.name, obj_path)
+            else:
+                obj_info['type'] = FILE
+                obj_info['size'] = xstat.stat.st_size
+                obj = StorageFile(xstat.name, obj_path,
+                                  size=xstat.stat.st_size)
+
+            if metadata is not None:
+                obj_info['user_metadata'] = dict(
+                    (key, xstat.getElement(key).extract())
+                    for key in xstat.getKeys())
+
+            yield obj, obj_info
+
+    gen = list_generator(catalog, dir_handle)
+    return gen
+
+
+def _get_token_name(token):
+    if token is None:
+        return None
+    return parse_ls_token(token)[1]
+
+
+def _read_dir(catalog, dir_handle, offset, limit, last_name):
+    """Return a generator of the extended stats of a directory part.
+
+    dmlite cannot seek in directories, so the entries before the
+    part are read and skipped. The part starts offset entries after
+    last_name, which relies on the catalog returning the entries in
+    the same order every time.
+    """
+    entries = iter(partial(catalog.readDirx, dir_handle), None)
+    if last_name is not None:
+        for xstat in entries:
+            if xstat.name == last_name:
+                break
+
+    if limit is None:
+        return islice(entries, offset, None)
+    return islice(entries, offset, offset + limit)
+
+
 @get_connection(connection_pool)
 @path_to_ascii
 def mkdir(path, conn=None):
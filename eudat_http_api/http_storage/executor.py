@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from functools import wraps
+import sys
+import thread
+import time
+
+from flask import copy_current_request_context, current_app, \
+    has_app_context, has_request_context
+
+from eudat_http_api.profiler import follow_request
+
+
+# the gevent thread pool and the thread of the gevent hub, see
+# configure_executor
+_pool = None
+_hub_thread = None
+
+
+def configure_executor(size):
+    """Run blocking storage calls in a pool of size native threads.
+
+    Must be called in the thread that runs the gevent hub, before
+    the server starts. The iRODS and dmlite bindings are C
+    extensions that gevent cannot switch away from; in the pool they
+    only block their own thread, and the hub can serve other
+    requests meanwhile. size 0 runs the calls directly again.
+    """
+    global _pool, _hub_thread
+    _hub_thread = thread.get_ident()
+    if size <= 0:
+        _pool = None
+        return
+
+    from gevent.threadpool import ThreadPool
+    _pool = ThreadPool(size)
+
+
+def configure_executor_from(config):
+    configure_executor(config.get('STORAGE_IO_THREADS', 20))
+
+
+def in_hub():
+    """True if this thread runs the gevent hub of the server."""
+    return _hub_thread is not None and thread.get_ident() == _hub_thread
+
+
+def is_offloading():
+    """True if run_blocking hands calls of this thread to the pool."""
+    return _pool is not None and in_hub()
+
+
+def cooperative_sleep(seconds):
+    """Sleep without keeping the other greenlets of the hub waiting."""
+    if in_hub():
+        import gevent
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def _with_context(func):
+    """Make func run with the Flask context of the caller."""
+    if has_request_context():
+        return copy_current_request_context(func)
+    if has_app_context():
+        app = current_app._get_current_object()
+
+        @wraps(func)
+        def with_app_context(*args, **kwargs):
+            with app.app_context():
+                return func(*args, **kwargs)
+        return with_app_context
+    return func
+
+
+def run_blocking(func, *args, **kwargs):
+    """Call func(*args, **kwargs), in the pool if there is one.
+
+    Only the calling greenlet waits for the result, exceptions are
+    raised in it. Calls from other threads, including the pool
+    itself, run directly.
+    """
+    if not is_offloading():
+        return func(*args, **kwargs)
+
+    # exceptions are handed back as values, gevent would log each
+    # one that is raised in the pool as an error
+    def call():
+        try:
+            return func(*args, **kwargs), None
+        except Exception:
+            return None, sys.exc_info()
+
+    result, exc_info = _pool.apply(_with_context(follow_request(call)))
+    if exc_info is not None:
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return result
+
+
+def offload(func):
+    """Return a function that calls func through run_blocking."""
+    @wraps(func)
+    def offloaded(*args, **kwargs):
+        return run_blocking(func, *args, **kwargs)
+    return offloaded
@@ -2,6 +2,8 @@
 
 from __future__ import with_statement
 
+import base64
+import binascii
 import os
 
 from flask import current_app
@@ -11,6 +13,7 @@ from irods import *
 from eudat_http_api.auth.common import AuthMethod, AuthException
 from eudat_http_api.http_storage import common
 from eudat_http_api.http_storage.common import get_config_parameter
+from eudat_http_api.http_storage.executor import run_blocking
 
 from eudat_http_api.http_storage.storage_common import *
 
@@ -120,7 +123,12 @@ class IrodsConnection(Connection):
         return is_valid
 
 
-connection_pool = ConnectionPool(IrodsConnection)
+connection_pool = ConnectionPool(
+    IrodsConnection,
+    max_pool_size=get_config_parameter('STORAGE_POOL_SIZE', 50),
+    max_user_pool_size=get_config_parameter('STORAGE_POOL_USER_SIZE', 10),
+    idle_timeout=get_config_parameter('STORAGE_POOL_IDLE_TIMEOUT', 300),
+    wait_timeout=get_config_parameter('STORAGE_POOL_WAIT_TIMEOUT', 5))
 
 
 def authenticate(auth, conn=None):
@@ -247,6 +255,14 @@ def _get_user_metadata(conn, obj_handle, path, user_metadata):
     # drop the 'unit' value along the way
     user_meta = dict((key, val) for key, val, unit in irods_user_metadata)
 
+    return _filter_user_metadata(user_meta, user_metadata)
+
+
+def _filter_user_metadata(user_meta, user_metadata):
+    """Return the entries of user_meta whose keys are in user_metadata.
+
+    If user_metadata is not iterable, user_meta is returned.
+    """
     try:
         # select only the keys that were asked for
         # a combination of:
@@ -292,6 +308,123 @@ def _set_user_metadata(conn, obj_handle, user_metadata):
         obj_handle.addUserMetadata(key, val)
 
 
+def _replace_user_metadata(obj_handle, user_metadata):
+    """Set user metadata entries, removing the old values of the keys.
+
+    addUserMetadata adds another value to a key that exists already.
+    """
+    for key, val, unit in obj_handle.getUserMetadata():
+        if key in user_metadata:
+            obj_handle.rmUserMetadata(key, val, unit)
+    _set_user_metadata(None, obj_handle, user_metadata)
+
+
+def _get_catalog_checksum(catalog_value, algorithm):
+    """Convert the checksum in the iCAT into our format, if it fits.
+
+    iRODS stores md5 checksums as hex, and sha256 checksums as
+    'sha2:' and the base64 encoded digest.
+    """
+    if not catalog_value:
+        return None
+    if catalog_value.startswith('sha2:'):
+        if algorithm != 'sha256':
+            return None
+        digest = base64.b64decode(catalog_value[len('sha2:'):])
+        return 'sha256:%s' % binascii.b2a_hex(digest)
+    if algorithm == 'md5' and len(catalog_value) == 32:
+        return 'md5:%s' % catalog_value
+    return None
+
+
+def _get_data_object_info(conn, path):
+    """Return size, modify time and catalog checksum of a data object.
+
+    Raises IsDirException for collections, NotFoundException if
+    there is nothing at path, and MalformedPathException for names
+    that cannot be quoted in the query.
+    """
+    coll_name, data_name = common.split_path(path)
+    conditions = {COL_COLL_NAME: '= %s' % quote_query_value(coll_name),
+                  COL_DATA_NAME: '= %s' % quote_query_value(data_name)}
+    rows = list(_gen_query(conn,
+                           [COL_DATA_SIZE, COL_D_MODIFY_TIME,
+                            COL_D_DATA_CHECKSUM],
+                           conditions, limit=1))
+    if not rows:
+        if int(irodsCollection(conn, path).getId()) >= 0:
+            raise IsDirException('Path is a directory')
+        raise NotFoundException('Path does not exist or is not a file')
+    return rows[0]
+
+
+@get_connection(connection_pool)
+def checksum(path, algorithm='md5', compute=True, conn=None):
+    """Return the checksum of a file as '<algorithm>:<hex digest>'.
+
+    Uses the checksum of the iCAT if it has the requested algorithm.
+    Otherwise the checksum is cached in the user metadata together
+    with the size and modify time of the object. If neither is
+    there, it is computed from the file, or None is returned if
+    compute is False. Only checksums of CHECKSUM_ALGORITHM are
+    cached, see is_stored_algorithm.
+    """
+
+    if conn is None:
+        return None
+
+    size, modify_time, catalog_value = _get_data_object_info(conn, path)
+    value = _get_catalog_checksum(catalog_value, algorithm)
+    if value is not None:
+        return value
+
+    stamp = make_checksum_stamp(size, modify_time)
+    file_handle = _open(conn, path, 'r')
+    if not file_handle:
+        raise NotFoundException('Path does not exist or is not a file')
+    user_meta = dict((key, val) for key, val, unit
+                     in file_handle.getUserMetadata())
+    value = get_cached_checksum(user_meta, algorithm, stamp)
+    if value is not None or not compute:
+        _close(file_handle)
+        return value
+
+    # read_stream_generator closes the file handle, so open another
+    # one to store the result
+    file_size = int(size)
+    value = compute_checksum(read_stream_generator(file_handle, file_size,
+                                                   [], _read, _seek,
+                                                   _close),
+                             algorithm)
+    if not is_stored_algorithm(algorithm):
+        return value
+
+    meta_handle = _open(conn, path, 'r')
+    if meta_handle:
+        _replace_user_metadata(meta_handle,
+                               make_checksum_metadata(value, stamp))
+        _close(meta_handle)
+        invalidate_metadata(path)
+    return value
+
+
+@get_connection(connection_pool)
+def set_checksum(path, value, conn=None):
+    """Store the checksum of a file as it is now, see checksum()."""
+
+    if conn is None:
+        return None
+
+    size, modify_time, _ = _get_data_object_info(conn, path)
+    file_handle = _open(conn, path, 'r')
+    if not file_handle:
+        raise NotFoundException('Path does not exist or is not a file')
+    _replace_user_metadata(file_handle,
+                           make_checksum_metadata(
+                               value, make_checksum_stamp(size, modify_time)))
+    _close(file_handle)
+
+
 @get_connection(connection_pool)
 def read(path, arg_range_list=None, query=None, conn=None):
     """Read a file from the backend storage.
@@ -354,36 +487,117 @@ def read(path, arg_range_list=None, query=None, conn=None):
     return gen, file_size, content_len, num_ordered_range_list
 
 
-@get_connection(connection_pool)
+@get_connection(connection_pool, offload_call=False)
 def write(path, stream_gen, force=False, conn=None):
-    """Write a file from an input stream."""
+    """Write a file from an input stream.
+
+    The input stream is read in the calling greenlet, only the
+    storage calls run in the storage thread pool.
+    """
 
     if conn is None:
         return None
 
     if not force:
-        _check_conflict(conn, path)
+        run_blocking(_check_conflict, conn, path)
 
-    file_handle = _open(conn, path, 'w')
+    file_handle = run_blocking(_open, conn, path, 'w')
     if not file_handle:
         raise NotFoundException('Path does not exist or is not a file')
 
     bytes_written = 0
     for chunk in stream_gen:
-        bytes_written += file_handle.write(chunk)
+        bytes_written += run_blocking(_write, file_handle, chunk)
 
-    _close(file_handle)
+    run_blocking(_close, file_handle)
 
     return bytes_written
 
 
 @get_connection(connection_pool)
-def ls(path, conn=None):
-    """Return a generator of a directory listing."""
+def ls(path, offset=0, limit=None, token=None, conn=None):
+    """Return a generator of a directory listing.
+
+    Sub-collections come first, then data objects, each sorted by
+    name. offset, limit and token select a part of the listing,
+    see _list_collection.
+    """
 
     if conn is None:
         return None
 
+    coll_name = _open_collection(conn, path)
+    rows = _list_collection(conn, coll_name, offset, limit, token)
+
+    def list_generator():
+        for row in rows:
+            obj_type, name = row[0], row[1]
+            if obj_type == DIR:
+                yield StorageDir(name, os.path.join(path, name))
+            else:
+                yield StorageFile(name, os.path.join(path, name),
+                                  size=row[2])
+
+    gen = list_generator()
+    return gen
+
+
+@get_connection(connection_pool)
+def ls_with_stat(path, metadata=None, offset=0, limit=None, token=None,
+                 conn=None):
+    """Return a generator of (StorageObject, stat() dict) pairs.
+
+    The listing is read with GenQuery like in ls(), plus one query
+    each for the user metadata of sub-collections and data objects,
+    instead of opening every object for stat().
+    The 'children' of sub-collections are not counted and are None.
+    """
+
+    if conn is None:
+        return None
+
+    coll_name = _open_collection(conn, path)
+    rows = _list_collection(conn, coll_name, offset, limit, token)
+
+    def list_generator(rows):
+        coll_meta, data_meta = {}, {}
+        if metadata is not None:
+            rows = list(rows)
+            # for a part of the listing, only read the metadata of its rows
+            coll_meta, data_meta = _get_listing_metadata(
+                conn, coll_name, rows if limit is not None else None)
+
+        for row in rows:
+            obj_type, name = row[0], row[1]
+            obj_path = os.path.join(path, name)
+            obj_info = {
+                'base': coll_name,
+                'name': name,
+                'type': obj_type,
+            }
+            if obj_type == DIR:
+                obj_info['children'] = None
+                obj_info['ID'] = row[2]
+                obj = StorageDir(name, obj_path)
+                user_meta = coll_meta.get(name, {})
+            else:
+                obj_info['size'] = row[2]
+                obj = StorageFile(name, obj_path, size=row[2])
+                user_meta = data_meta.get(name, {})
+
+            if metadata is not None:
+                obj_info['user_metadata'] = _filter_user_metadata(user_meta,
+                                                                  metadata)
+            yield obj, obj_info
+
+    return list_generator(rows)
+
+
+def _open_collection(conn, path):
+    """Check that path is a collection and return its name.
+
+    The name is the path without trailing slash.
+    """
     coll = irodsCollection(conn)
     coll.openCollection(path)
 
@@ -399,14 +613,219 @@ def ls(path, conn=None):
     if int(coll.getId()) < 0:
         raise NotFoundException('Path does not exist')
 
-    def list_generator(collection):
-        for sub in collection.getSubCollections():
-            yield StorageDir(sub, os.path.join(path, sub))
-        for name, resc in collection.getObjects():
-            yield StorageFile(name, os.path.join(path, name), resc)
+    if len(path) > 1:
+        return path.rstrip('/')
+    return path
 
-    gen = list_generator(coll)
-    return gen
+
+def _list_collection(conn, coll_name, offset=0, limit=None, token=None):
+    """Return a generator of the rows of a collection listing.
+
+    Rows are (DIR, name, coll_id) for sub-collections and
+    (FILE, name, size) for data objects. Sub-collections come first,
+    then data objects, each sorted by name, so that a token of
+    make_ls_token() becomes a condition on the name.
+    offset and limit are handed to GenQuery, so that only the rows
+    of the requested part are read from the catalog.
+
+    The token and the names are checked before the generator is
+    returned, so that a MalformedTokenException or
+    MalformedPathException is raised before the response starts.
+    """
+    token_type, token_name = None, None
+    if token is not None:
+        token_type, token_name = parse_ls_token(token)
+
+    coll_conditions = None
+    if token_type != FILE:
+        coll_conditions = {COL_COLL_PARENT_NAME:
+                           '= %s' % quote_query_value(coll_name)}
+        if token_type == DIR:
+            coll_conditions[COL_COLL_NAME] = '> %s' % _quote_token(
+                os.path.join(coll_name, token_name))
+        elif coll_name == '/':
+            # the root collection is its own parent
+            coll_conditions[COL_COLL_NAME] = "<> '/'"
+
+    data_conditions = {COL_COLL_NAME: '= %s' % quote_query_value(coll_name)}
+    if token_type == FILE:
+        data_conditions[COL_DATA_NAME] = '> %s' % _quote_token(token_name)
+
+    return _gen_collection_rows(conn, offset, limit, coll_conditions,
+                                data_conditions)
+
+
+def _quote_token(value):
+    """quote_query_value() for the name of a token from the client."""
+    try:
+        return quote_query_value(value)
+    except MalformedPathException:
+        raise MalformedTokenException('Malformed continuation token')
+
+
+def _gen_collection_rows(conn, offset, limit, coll_conditions,
+                         data_conditions):
+    """The generator of _list_collection, with the query conditions.
+
+    Sub-collections are skipped if coll_conditions is None.
+    """
+    if coll_conditions is not None:
+        coll_count = 0
+        for sub_path, coll_id in _gen_query(conn,
+                                            [COL_COLL_NAME, COL_COLL_ID],
+                                            coll_conditions,
+                                            order_by=COL_COLL_NAME,
+                                            offset=offset, limit=limit):
+            coll_count += 1
+            yield DIR, os.path.basename(sub_path), coll_id
+
+        if limit is not None:
+            limit -= coll_count
+            if limit <= 0:
+                return
+
+        if coll_count > 0:
+            offset = 0
+        elif offset > 0:
+            # the offset is behind the last sub-collection
+            offset = max(0, offset - _gen_query_count(conn, COL_COLL_ID,
+                                                      coll_conditions))
+
+    # without the replica columns, there is one row per data object
+    for name, size in _gen_query(conn,
+                                 [COL_DATA_NAME, COL_DATA_SIZE],
+                                 data_conditions,
+                                 order_by=COL_DATA_NAME,
+                                 offset=offset, limit=limit):
+        yield FILE, name, int(size)
+
+
+def _get_listing_metadata(conn, coll_name, rows=None):
+    """Return the user metadata of the entries of a collection.
+
+    Returns two dicts of names to user metadata, one for the
+    sub-collections and one for the data objects.
+    If rows of _list_collection() are given, only their metadata
+    is read.
+    """
+    coll_conditions = {COL_COLL_PARENT_NAME:
+                       '= %s' % quote_query_value(coll_name)}
+    data_conditions = {COL_COLL_NAME: '= %s' % quote_query_value(coll_name)}
+    read_colls, read_data = True, True
+    if rows is not None:
+        coll_paths = [os.path.join(coll_name, row[1])
+                      for row in rows if row[0] == DIR]
+        data_names = [row[1] for row in rows if row[0] == FILE]
+        _add_in_condition(coll_conditions, COL_COLL_NAME, coll_paths)
+        _add_in_condition(data_conditions, COL_DATA_NAME, data_names)
+        read_colls, read_data = bool(coll_paths), bool(data_names)
+
+    coll_meta = {}
+    if read_colls:
+        for key, val, sub_path in _gen_query(
+                conn,
+                [COL_META_COLL_ATTR_NAME, COL_META_COLL_ATTR_VALUE,
+                 COL_COLL_NAME],
+                coll_conditions):
+            coll_meta.setdefault(os.path.basename(sub_path), {})[key] = val
+
+    data_meta = {}
+    if read_data:
+        for key, val, name in _gen_query(
+                conn,
+                [COL_META_DATA_ATTR_NAME, COL_META_DATA_ATTR_VALUE,
+                 COL_DATA_NAME],
+                data_conditions):
+            data_meta.setdefault(name, {})[key] = val
+
+    return coll_meta, data_meta
+
+
+def _add_in_condition(conditions, column, values):
+    """Restrict column of conditions to values, if they can be quoted.
+
+    Otherwise the condition is left out, the query reads the rows of
+    all names and the caller ignores the ones it does not need.
+    """
+    try:
+        conditions[column] = 'in (%s)' % ', '.join(quote_query_value(value)
+                                                   for value in values)
+    except MalformedPathException:
+        pass
+
+
+def _make_gen_query(columns, conditions, options={}):
+    select_inp = inxIvalPair_t()
+    for column in columns:
+        select_inp.addInxIval(column, options.get(column, 0))
+
+    cond_inp = inxValPair_t()
+    for column, condition in conditions.iteritems():
+        cond_inp.addInxVal(column, condition)
+
+    query = genQueryInp_t()
+    query.setSelectInp(select_inp)
+    query.setSqlCondInp(cond_inp)
+    query.continueInx = 0
+    return query
+
+
+def _gen_query(conn, columns, conditions, order_by=None, offset=0,
+               limit=None):
+    """Run a GenQuery and return a generator of the result rows.
+
+    columns is a list of COL_* constants to select, conditions a
+    dict of COL_* constants to SQL conditions like "= 'value'".
+    The rows are sorted by the column order_by, start at row
+    offset and are at most limit. They are fetched from the catalog
+    in pages of up to MAX_SQL_ROWS.
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    options = {}
+    if order_by is not None:
+        options[order_by] = ORDER_BY
+    query = _make_gen_query(columns, conditions, options)
+    query.rowOffset = offset
+    query.maxRows = MAX_SQL_ROWS
+    if limit is not None:
+        query.maxRows = min(limit, MAX_SQL_ROWS)
+
+    try:
+        while True:
+            query_out = rcGenQuery(conn, query)
+            # None means CAT_NO_ROWS_FOUND
+            if query_out is None:
+                return
+            query.continueInx = query_out.continueInx
+
+            values = [query_out.getSqlResultByInx(column).getValues()
+                      for column in columns]
+            for row in zip(*values):
+                if limit is not None:
+                    if limit <= 0:
+                        return
+                    limit -= 1
+                yield row
+
+            if query.continueInx == 0:
+                return
+    finally:
+        # close the statement in the catalog if rows are left
+        if query.continueInx != 0:
+            query.maxRows = 0
+            rcGenQuery(conn, query)
+
+
+def _gen_query_count(conn, column, conditions):
+    """Return the number of rows matching conditions."""
+    query = _make_gen_query([column], conditions, {column: SELECT_COUNT})
+    query.maxRows = 1
+    query_out = rcGenQuery(conn, query)
+    if query_out is None:
+        return 0
+    return int(query_out.getSqlResultByInx(column).getValues()[0])
 
 
 @get_connection(connection_pool)
@@ -39,21 +39,26 @@ def _safe_stat(path, user_metadata):
 
 
 def _create_dirlist_gen(dir_gen, path):
-    """Returns a list with the directory entries."""
+    """Returns a list with the directory entries.
+
+    dir_gen yields (StorageObject, stat() dict) pairs,
+    see storage.ls_with_stat.
+    """
     nav_links = [storage.StorageDir('.', path),
                  storage.StorageDir('..', common.split_path(path)[0])]
+    nav_links = imap(lambda x: (x, _safe_stat(x.path, True)), nav_links)
 
-    return imap(lambda x: (x.name, flask_json.dumps(
-                           {'name': x.name,
-                            'path': x.path,
-                            'metadata': _safe_stat(x.path, True)
-                            })),
+    return imap(lambda (x, obj_info): (x.name, flask_json.dumps(
+                                       {'name': x.name,
+                                        'path': x.path,
+                                        'metadata': obj_info
+                                        })),
                 chain(nav_links, dir_gen))
 
 
 def get_dir_obj(path):
     try:
-        dir_gen = storage.ls(path)
+        dir_gen = storage.ls_with_stat(path, True)
     except storage.NotFoundException as e:
         return e.msg, 404
     except storage.NotAuthorizedException as e:
@@ -2,6 +2,7 @@
 
 from __future__ import with_statement
 
+from bisect import bisect_right
 import errno
 from functools import wraps
 from itertools import imap
@@ -13,6 +14,7 @@ import xattr
 from flask import current_app
 
 from eudat_http_api.auth.common import AuthMethod, AuthException
+from eudat_http_api.cache import Cache
 from eudat_http_api.http_storage.common import get_config_parameter
 from eudat_http_api.http_storage.storage_common import *
 
@@ -95,14 +97,19 @@ def stat(path, metadata=None):
     For the future, there should be a standard what
     stat() returns.
     """
-    obj_info = dict()
-
     try:
         stat_result = os.stat(path)
     except (IOError, OSError) as e:
         current_app.logger.debug(e)
         raise NotFoundException('Path does not exist or is not a file')
 
+    return _get_obj_info(path, stat_result, metadata)
+
+
+def _get_obj_info(path, stat_result, metadata):
+    """Return the stat() dict for the result of os.stat(path)."""
+    obj_info = dict()
+
     if sys_stat.S_ISDIR(stat_result.st_mode):
         obj_info['type'] = DIR
         try:
@@ -115,14 +122,17 @@ def stat(path, metadata=None):
         obj_info['size'] = stat_result.st_size
 
     if metadata is not None:
-        user_metadata = get_user_metadata(path, metadata)
-        obj_info['user_metadata'] = user_metadata
+        obj_info['user_metadata'] = _get_user_metadata(path)
 
     return obj_info
 
 
 @check_path
 def get_user_metadata(path, user_metadata=None):
+    return _get_user_metadata(path)
+
+
+def _get_user_metadata(path):
     meta = dict(xattr.xattr(path))
     meta_clean = dict()
     for key, value in meta.iteritems():
@@ -140,6 +150,63 @@ def set_user_metadata(path, user_metadata):
         raise StorageException('object not modifiable or not found')
 
 
+def _stat_file(path):
+    try:
+        stat_result = os.stat(path)
+    except (IOError, OSError):
+        raise NotFoundException('Path does not exist or is not a file')
+    if sys_stat.S_ISDIR(stat_result.st_mode):
+        raise IsDirException('Path is a directory')
+    return stat_result
+
+
+def _get_checksum_stamp(stat_result):
+    return make_checksum_stamp(stat_result.st_size,
+                               repr(stat_result.st_mtime))
+
+
+@check_path
+def checksum(path, algorithm='md5', compute=True):
+    """Return the checksum of a file as '<algorithm>:<hex digest>'.
+
+    The checksum is cached in the user metadata, together with the
+    size and mtime of the file it was computed for. If there is no
+    valid cached value, it is computed from the file, or None is
+    returned if compute is False. Only checksums of
+    CHECKSUM_ALGORITHM are cached, see is_stored_algorithm.
+    """
+    stat_result = _stat_file(path)
+    stamp = _get_checksum_stamp(stat_result)
+    value = get_cached_checksum(_get_user_metadata(path), algorithm, stamp)
+    if value is not None or not compute:
+        return value
+
+    try:
+        file_handle = _open(path, 'rb')
+    except IOError:
+        raise NotFoundException('Path does not exist or is not a file')
+    value = compute_checksum(FileRangeStream(file_handle,
+                                             stat_result.st_size, 0,
+                                             stat_result.st_size),
+                             algorithm)
+    if not is_stored_algorithm(algorithm):
+        return value
+
+    try:
+        set_user_metadata(path, make_checksum_metadata(value, stamp))
+    except StorageException:
+        current_app.logger.debug('caching the checksum failed on: %s' % path)
+    invalidate_metadata(path)
+    return value
+
+
+@check_path
+def set_checksum(path, value):
+    """Store the checksum of a file as it is now, see checksum()."""
+    stamp = _get_checksum_stamp(_stat_file(path))
+    set_user_metadata(path, make_checksum_metadata(value, stamp))
+
+
 @check_path
 def read(path, arg_range_list=None, query=None):
     """Read a file from the backend storage.
@@ -151,6 +218,9 @@ def read(path, arg_range_list=None, query=None):
     ranges concatenated.
     If a range exceeds the size of the object, the
     bytestream goes until the object end.
+
+    Without ranges or with a single range, the bytestream is a
+    FileRangeStream, which frontends can pass to wsgi.file_wrapper.
     """
 
     range_list = []
@@ -177,9 +247,17 @@ def read(path, arg_range_list=None, query=None):
     else:
         content_len = file_size
 
-    gen = read_stream_generator(file_handle, file_size,
-                                ordered_range_list,
-                                _read, _seek, _close)
+    # full reads and single ranges can be served from the file
+    # descriptor directly, see FileRangeStream
+    if len(ordered_range_list) > 1:
+        gen = read_stream_generator(file_handle, file_size,
+                                    ordered_range_list,
+                                    _read, _seek, _close)
+    elif ordered_range_list:
+        gen = FileRangeStream(file_handle, file_size,
+                              ordered_range_list[0][0], content_len)
+    else:
+        gen = FileRangeStream(file_handle, file_size, 0, file_size)
 
     # return the range list without START and END constants
     def replace_length_constants(x, y, file_size):
@@ -214,9 +292,52 @@ def write(path, stream_gen):
         _handle_oserror(path, e)
 
 
+# sorted directory listings by path, with the mtime of the directory
+# when they were read. Used to continue listings, see _list_names.
+listing_cache = Cache(max_size=100)
+
+
+def _list_names(path, offset=0, limit=None, token=None):
+    """Return a part of the sorted names in a directory.
+
+    The first page of a listing reads the directory. Following
+    pages (with an offset or token) use the names cached from
+    before, as long as the mtime of the directory is unchanged.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+        cached = None
+        if offset or token is not None:
+            cached = listing_cache.get(path)
+
+        if cached is not None and cached[0] == mtime:
+            names = cached[1]
+        else:
+            names = sorted(os.listdir(path))
+            listing_cache.set(path, (mtime, names))
+    except IOError as e:
+        _handle_oserror(path, e)
+    except OSError as e:
+        _handle_oserror(path, e)
+
+    start = offset
+    if token is not None:
+        _, last_name = parse_ls_token(token)
+        start += bisect_right(names, last_name)
+
+    if limit is None:
+        return names[start:]
+    return names[start:start + limit]
+
+
 @check_path
-def ls(path):
-    """Return a generator of a directory listing."""
+def ls(path, offset=0, limit=None, token=None):
+    """Return a generator of a directory listing.
+
+    The listing is sorted by name. It starts offset entries after
+    the object that token was made for (see make_ls_token), or
+    after the start, and has at most limit entries.
+    """
 
     def get_obj_type(path):
         basedir, name = os.path.split(path)
@@ -225,13 +346,38 @@ def ls(path):
         else:
             return StorageDir(name, path)
 
-    try:
-        return (imap(lambda x: get_obj_type(os.path.join(path, x)),
-                     os.listdir(path)))
-    except IOError as e:
-        _handle_oserror(path, e)
-    except OSError as e:
-        _handle_oserror(path, e)
+    return (imap(lambda x: get_obj_type(os.path.join(path, x)),
+                 _list_names(path, offset, limit, token)))
+
+
+@check_path
+def ls_with_stat(path, metadata=None, offset=0, limit=None, token=None):
+    """Return a generator of (StorageObject, stat() dict) pairs.
+
+    Lists the directory once and stats the entries from the listing,
+    instead of checking every path again in stat().
+    Entries that vanish during the listing have an empty dict.
+    offset, limit and token select a part of the listing like in ls().
+    """
+    names = _list_names(path, offset, limit, token)
+
+    def list_generator(names):
+        for name in names:
+            obj_path = os.path.join(path, name)
+            try:
+                stat_result = os.stat(obj_path)
+            except OSError:
+                yield StorageDir(name, obj_path), dict()
+                continue
+
+            obj_info = _get_obj_info(obj_path, stat_result, metadata)
+            if obj_info['type'] == DIR:
+                yield StorageDir(name, obj_path), obj_info
+            else:
+                yield (StorageFile(name, obj_path, size=obj_info['size']),
+                       obj_info)
+
+    return list_generator(names)
 
 
 @check_path
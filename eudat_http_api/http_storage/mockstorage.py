@@ -3,6 +3,8 @@
 from __future__ import with_statement
 
 from itertools import chain
+from itertools import dropwhile
+from itertools import islice
 import re
 
 from eudat_http_api.http_storage.storage_common import *
@@ -62,6 +64,17 @@ def set_user_metadata(path, user_metadata):
     pass
 
 
+def checksum(path, algorithm='md5', compute=True):
+    gen, _, _, _ = read(path)
+    if not compute:
+        return None
+    return compute_checksum(gen, algorithm)
+
+
+def set_checksum(path, value):
+    pass
+
+
 def read(path, range_list=[]):
     if path == '/testfile':
         def gen():
@@ -106,7 +119,19 @@ def write(path, stream_gen):
         raise NotFoundException('Path does not exist or is not a file')
 
 
-def ls(path):
+def ls(path, offset=0, limit=None, token=None):
+    entries = _ls(path)
+    if token is not None:
+        last_name = parse_ls_token(token)[1]
+        entries = dropwhile(lambda x: x.name != last_name, entries)
+        offset += 1
+
+    if limit is None:
+        return islice(entries, offset, None)
+    return islice(entries, offset, offset + limit)
+
+
+def _ls(path):
     if path == '/testfile':
         raise IsFileException('Path is not a directory')
     elif path == '/testfolder/testfile':
@@ -123,6 +148,11 @@ def ls(path):
         raise NotFoundException('Path does not exist or is not a file')
 
 
+def ls_with_stat(path, metadata=None, offset=0, limit=None, token=None):
+    for obj in ls(path, offset, limit, token):
+        yield obj, stat(obj.path, metadata)
+
+
 def mkdir(path):
     if path == '/testfile':
         raise ConflictException('Path exists')
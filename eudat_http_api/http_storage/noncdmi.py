@@ -12,8 +12,11 @@ from flask import render_template
 from flask import request
 from flask import Response
 from flask import stream_with_context
-from itertools import tee
+from werkzeug.wsgi import wrap_file
 
+from eudat_http_api import metadata
+from eudat_http_api.checksum import make_digest_header
+from eudat_http_api.checksum import parse_checksum, parse_want_digest
 from eudat_http_api.http_storage import common
 from eudat_http_api.http_storage import storage
 from eudat_http_api.http_storage.common import create_hex_object_id
@@ -90,6 +93,7 @@ def get_file_obj(path):
         return e.msg, 400
 
     response_headers = {'Content-Length': content_len}
+    response_headers.update(_get_checksum_headers(path))
     # do not send the content-length to enable
     # transfer-encoding chunked -- do not use chunked to let it
     # work with ROOT, no effect on mem usage anyway
@@ -114,6 +118,17 @@ def get_file_obj(path):
         response_headers['Content-Type'] = ('multipart/byteranges; boundary=%s'
                                             % multipart_frontier)
 
+    # let the WSGI server send local files itself (e.g. with sendfile)
+    # instead of pushing every chunk through the interpreter. Servers
+    # without wsgi.file_wrapper get werkzeug's FileWrapper, which
+    # must read as much at once as the storage does, not 8 KB.
+    if not multipart and hasattr(stream_gen, 'fileno'):
+        return Response(wrap_file(request.environ, stream_gen,
+                                  buffer_size=stream_gen.buffer_size),
+                        headers=response_headers,
+                        status=response_status,
+                        direct_passthrough=True)
+
     def wrap_multipart_stream_gen(stream_gen, delim, file_size):
         multipart = False
         for segment_size, segment_start, segment_end, data in stream_gen:
@@ -143,27 +158,97 @@ def get_file_obj(path):
                     status=response_status)
 
 
+def _get_checksum_headers(path):
+    """Return the ETag and Digest headers of a file.
+
+    Only checksums that the storage knows already are used, so that
+    the file is not read twice. They come from the metadata cache,
+    like the results of stat. If the client asks for a Digest with
+    Want-Digest, it is computed if needed.
+    """
+    algorithm = common.get_config_parameter('CHECKSUM_ALGORITHM', 'md5')
+    wanted = parse_want_digest(request.headers.get('Want-Digest', ''))
+
+    headers = {}
+    try:
+        value = metadata.get_checksum(path, algorithm)
+        if value is not None:
+            headers['ETag'] = '"%s"' % parse_checksum(value)[1]
+            headers['Digest'] = make_digest_header(value)
+        if wanted is not None and (wanted != algorithm or value is None):
+            value = storage.checksum(path, wanted, compute=True)
+            headers['Digest'] = make_digest_header(value)
+    except storage.StorageException as e:
+        current_app.logger.debug('no checksum for %s: %s' % (path, e))
+
+    return headers
+
+
+class ListingPage(object):
+    """Iterate over one page of a directory listing.
+
+    dir_gen may hold one entry more than page_size. If it does,
+    next_token is set to the token of the next page once the
+    page has been iterated.
+    """
+    def __init__(self, dir_gen, page_size):
+        self.dir_gen = dir_gen
+        self.page_size = page_size
+        self.next_token = None
+
+    def __iter__(self):
+        last = None
+        for i, obj in enumerate(self.dir_gen):
+            if i == self.page_size:
+                self.next_token = storage.make_ls_token(last)
+                break
+            last = obj
+            yield obj
+
+
+def _stream_template(template_name, **context):
+    """Render a template as a stream of chunks.
+
+    Flask 0.10 has no stream_template, so this does the same as
+    render_template() without joining the output.
+    """
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    stream = template.stream(context)
+    stream.enable_buffering(100)
+    return stream
+
+
 def get_dir_obj(path):
+    """Get a directory listing as HTML.
+
+    The listing is rendered and sent while it is read from the
+    storage, in pages of LISTING_PAGE_SIZE entries. The token
+    argument selects the page.
+    """
+    page_size = common.get_config_parameter('LISTING_PAGE_SIZE', 1000)
     try:
-        dir_gen = storage.ls(path)
+        dir_gen = storage.ls(path, limit=page_size + 1,
+                             token=request.args.get('token', None))
     except storage.NotFoundException as e:
         return e.msg, 404
     except storage.NotAuthorizedException as e:
         return e.msg, 403
+    except storage.MalformedTokenException as e:
+        return e.msg, 400
     except storage.StorageException as e:
         return e.msg, 500
     except storage.MalformedPathException as e:
         return e.msg, 400
 
-    dirlist, filelist = tee(dir_gen)
-
-    return render_template(
+    stream = _stream_template(
         'html/dirlisting.html',
-        dirlist=dirlist,
-        filelist=filelist,
+        listing=ListingPage(dir_gen, page_size),
+        continued='token' in request.args,
         path=path,
         path_links=common.create_path_links(path),
         parent_path=common.add_trailing_slash(common.split_path(path)[0]))
+    return Response(stream_with_context(stream))
 
 
 def put_file_obj(path):
@@ -180,7 +265,10 @@ def put_file_obj(path):
         common.StreamWrapper(request.environ['wsgi.input'])
     request.shallow = False
 
-    value_gen = common.stream_generator(request.stream)
+    # computed while the data is written, see put_file_obj in cdmi
+    checksum = common.create_checksum()
+    value_gen = checksum.wrap(
+        common.stream_generator(common.get_request_stream(request)))
 
     bytes_written = 0
     try:
@@ -202,6 +290,7 @@ def put_file_obj(path):
     hex_obj_id = create_hex_object_id()
     try:
         storage.set_user_metadata(path, {'objectID': hex_obj_id})
+        storage.set_checksum(path, checksum.value())
     except storage.StorageException:
         current_app.logger.debug('setting an objectID failed on: %s' % path)
 
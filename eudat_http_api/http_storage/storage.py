@@ -22,3 +22,13 @@ elif get_config_parameter('STORAGE') == 'dmlite':
 else:
     raise NotImplementedError('%s does not exist'
                               % get_config_parameter('STORAGE'))
+
+# changes made through this process must not leave stale entries
+# in the metadata cache, see metadata.py
+write = invalidates_metadata()(write)
+mkdir = invalidates_metadata()(mkdir)
+rm = invalidates_metadata()(rm)
+rmdir = invalidates_metadata()(rmdir)
+set_user_metadata = invalidates_metadata()(set_user_metadata)
+set_checksum = invalidates_metadata()(set_checksum)
+copy = invalidates_metadata(path_arg=1)(copy)
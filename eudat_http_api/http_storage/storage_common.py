@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
 from functools import partial
 from functools import wraps
 from inspect import isgenerator
-from Queue import Queue, Empty, Full
-from threading import Lock
+import os
+from Queue import Full, Queue
+import sys
+from threading import Condition, Event, Lock, Thread
+import time
 
 from flask import current_app
 from flask import request
 
+from eudat_http_api.auth.common import invalidate_auth
+from eudat_http_api.cache import Cache
+from eudat_http_api.checksum import Checksum, METADATA_KEY as CHECKSUM_KEY
+from eudat_http_api.checksum import parse_checksum, UnknownAlgorithmException
+from eudat_http_api.http_storage.executor import cooperative_sleep, \
+    in_hub, is_offloading, offload, run_blocking
+from eudat_http_api.metrics import metrics
+
 START = 'file-start'
 END = 'file-end'
 BACKWARDS = 'file-back'
@@ -56,6 +69,7 @@ class StorageFile(StorageObject):
 
 class Connection(object):
     auth_hash = None
+    last_used = None
 
     def __init__(self):
         pass
@@ -70,19 +84,59 @@ class Connection(object):
         pass
 
 
+# seconds between two looks at the pool of a request that waits for a
+# connection in the gevent hub
+HUB_WAIT_INTERVAL = 0.01
+
+
 class ConnectionPool(object):
-    pool = {}
-    max_pool_size = 10
-    mutex = None
-    #used_connections = set()
+    """Pool of storage connections, kept separately per user.
+
+    The pool holds at most max_pool_size connections in total
+    (idle and checked out) and at most max_user_pool_size for a
+    single user (auth hash).
+
+    get_connection() returns an idle connection of the user if
+    there is a valid one. Otherwise it creates a new connection
+    right away, as long as both limits allow it. When the pool is
+    full, idle connections of other users are closed to make room.
+    Only if all connections are checked out, it waits up to
+    wait_timeout seconds for one to be released.
+
+    Idle connections that have not been used for idle_timeout
+    seconds are closed.
+
+    The counters in stats count pool hits, misses (newly created
+    connections), waits and evictions.
+    """
+    max_pool_size = None
+    max_user_pool_size = None
+    idle_timeout = None
+    wait_timeout = None
     conn_constructor = None
 
-    def __init__(self, conn_type, max_pool_size=10):
+    def __init__(self, conn_type, max_pool_size=50, max_user_pool_size=10,
+                 idle_timeout=300, wait_timeout=5):
         current_app.logger.debug(
             'created the ConnectionPool')
         self.max_pool_size = max_pool_size
+        self.max_user_pool_size = max_user_pool_size
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
         self.conn_constructor = conn_type
-        self.mutex = Lock()
+
+        # auth_hash -> list of idle connections, most recently used last
+        self.idle = {}
+        # auth_hash -> number of open connections (idle and checked out)
+        self.user_count = {}
+        self.total_count = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'evictions': 0,
+        }
+        self.cond = Condition(Lock())
 
     def __del__(self):
         # Connections are destroyed automatically on
@@ -90,24 +144,68 @@ class ConnectionPool(object):
         pass
 
     def get_connection(self, auth_info):
-        user_pool = self.__get_user_pool(auth_info.get_auth_hash())
-
-        try:
-            current_app.logger.debug('user pool size = %d' % user_pool.qsize())
-            conn = user_pool.get(block=True, timeout=5)
-            current_app.logger.debug(
-                'got a storage connection from the pool. now = %d-1'
-                % (user_pool.qsize() + 1))
-            if not self.__connection_is_valid:
-                current_app.logger.debug('found a bad storage connection')
-                self.__destroy_connection(conn)
-                conn = self.__create_connection(auth_info)
+        auth_hash = auth_info.get_auth_hash()
+        deadline = time.time() + self.wait_timeout
+
+        while True:
+            conn = None
+            create = False
+            # closed after the lock is released, disconnect() blocks
+            evicted = []
+            try:
+                with self.cond:
+                    self.__evict_expired(evicted)
+                    user_idle = self.idle.get(auth_hash)
+                    if user_idle:
+                        conn = user_idle.pop()
+                    elif self.__reserve(auth_hash, evicted):
+                        create = True
+                    elif evicted:
+                        # close them before waiting, then look again
+                        continue
+                    else:
+                        timeout = deadline - time.time()
+                        if timeout <= 0:
+                            current_app.logger.error(
+                                'no storage connection available')
+                            raise InternalException(
+                                'No storage connection available')
+                        current_app.logger.debug('waiting for a connection')
+                        self.stats['waits'] += 1
+                        self.__wait(timeout)
+                        continue
+            finally:
+                self.__disconnect_evicted(evicted)
+
+            if create:
+                return run_blocking(self.__create_connection, auth_info)
+
+            if self.__connection_is_valid(conn):
+                with self.cond:
+                    self.stats['hits'] += 1
+                return conn
+
+            current_app.logger.debug('found a bad storage connection')
+            self.__destroy_connection(conn)
 
-        except Empty:
-            current_app.logger.debug('pool was empty')
-            conn = self.__create_connection(auth_info)
+    def __wait(self, timeout):
+        """Wait for a connection to be released.
+
+        Must be called with the lock held. In the gevent hub, the
+        connections are held by other greenlets of the same thread,
+        which must run to release them. Releases of other threads
+        cannot wake the hub, so it looks again every
+        HUB_WAIT_INTERVAL seconds.
+        """
+        if not in_hub():
+            self.cond.wait(timeout)
+            return
 
-        return conn
+        self.cond.release()
+        try:
+            cooperative_sleep(min(timeout, HUB_WAIT_INTERVAL))
+        finally:
+            self.cond.acquire()
 
     def __connection_is_valid(self, conn):
         if conn is None:
@@ -117,77 +215,177 @@ class ConnectionPool(object):
         return conn.is_valid()
 
     def release_connection(self, conn):
-        user_pool = self.__get_user_pool(conn.auth_hash)
-
         if not self.__connection_is_valid(conn):
             current_app.logger.debug(
                 'found a bad storage connection in release()')
             self.__destroy_connection(conn)
             return
 
-        try:
-            current_app.logger.debug(
-                'putting back a storage connection. now = %d+1'
-                % user_pool.qsize())
-            user_pool.put(conn, block=False)
-        except Full:
-            current_app.logger.debug('pool was full')
-            self.__destroy_connection(conn)
+        with self.cond:
+            conn.last_used = time.time()
+            self.idle.setdefault(conn.auth_hash, []).append(conn)
+            # all users wait on the same condition, only some of the
+            # waiters can use this connection
+            self.cond.notify_all()
+
+    def get_stats(self):
+        """Return the counters together with the current pool size."""
+        with self.cond:
+            stats = dict(self.stats)
+            stats['open'] = self.total_count
+            stats['idle'] = sum(map(len, self.idle.itervalues()))
+        return stats
+
+    def __reserve(self, auth_hash, evicted):
+        """Reserve a slot for a new connection.
+
+        Must be called with the lock held. An idle connection that is
+        evicted for the slot is added to evicted.
+        """
+        if self.user_count.get(auth_hash, 0) >= self.max_user_pool_size:
+            return False
 
-    def __get_user_pool(self, auth_hash):
-        user_pool = None
-        self.mutex.acquire()
-        try:
-            user_pool = self.pool[auth_hash]
-            current_app.logger.debug('got an existing userpool')
-        except KeyError:
-            self.pool[auth_hash] = Queue(self.max_pool_size)
-            user_pool = self.pool[auth_hash]
-            current_app.logger.debug('made a new userpool')
-        finally:
-            self.mutex.release()
+        if self.total_count >= self.max_pool_size:
+            if not self.__evict_oldest(evicted):
+                return False
+
+        self.user_count[auth_hash] = self.user_count.get(auth_hash, 0) + 1
+        self.total_count += 1
+        return True
+
+    def __unreserve(self, auth_hash):
+        """Free the slot of a connection. Must be called with the lock held.
+        """
+        self.user_count[auth_hash] -= 1
+        if self.user_count[auth_hash] <= 0:
+            del self.user_count[auth_hash]
+        self.total_count -= 1
+        self.cond.notify_all()
+
+    def __evict_expired(self, evicted):
+        """Evict idle connections that timed out.
+
+        Must be called with the lock held. The connections are added
+        to evicted, to be closed with __disconnect_evicted().
+        """
+        expiry = time.time() - self.idle_timeout
+        for auth_hash, user_idle in self.idle.items():
+            while user_idle and user_idle[0].last_used < expiry:
+                self.__evict(user_idle.pop(0), evicted)
+            if not user_idle:
+                del self.idle[auth_hash]
+
+    def __evict_oldest(self, evicted):
+        """Evict the longest unused idle connection of any user.
+
+        Must be called with the lock held. The connection is added to
+        evicted, to be closed with __disconnect_evicted().
+        Returns False if there is no idle connection.
+        """
+        oldest = None
+        for user_idle in self.idle.itervalues():
+            if user_idle and (oldest is None or
+                              user_idle[0].last_used < oldest[0].last_used):
+                oldest = user_idle
+        if oldest is None:
+            return False
+
+        self.__evict(oldest.pop(0), evicted)
+        return True
 
-        return user_pool
+    def __evict(self, conn, evicted):
+        self.stats['evictions'] += 1
+        self.__unreserve(conn.auth_hash)
+        evicted.append(conn)
+
+    def __disconnect_evicted(self, evicted):
+        """Close evicted connections. Must be called without the lock.
+
+        Like __destroy_connection, the disconnect runs in the pool of
+        the executor, so that it does not block the gevent hub.
+        """
+        for conn in evicted:
+            current_app.logger.debug('evicted an idle storage connection')
+            try:
+                run_blocking(conn.disconnect)
+            except Exception as e:
+                current_app.logger.debug('disconnect failed: %s' % e)
 
     def __create_connection(self, auth_info):
-        c = self.conn_constructor()
-        c.auth_hash = auth_info.get_auth_hash()
-        if c.connect(auth_info):
-            return c
-        else:
-            return None
+        """Create a connection in a slot reserved before."""
+        auth_hash = auth_info.get_auth_hash()
+        c = None
+        try:
+            c = self.conn_constructor()
+            c.auth_hash = auth_hash
+            if not c.connect(auth_info):
+                c = None
+        except:
+            # e.g. the storage cannot be reached, the slot must not
+            # stay reserved for a connection that does not exist
+            c = None
+            raise
+        finally:
+            with self.cond:
+                if c is None:
+                    self.__unreserve(auth_hash)
+                else:
+                    self.stats['misses'] += 1
+
+        return c
 
     def __destroy_connection(self, conn):
         current_app.logger.debug('Disconnected a storage connection')
-        conn.disconnect()
+        with self.cond:
+            self.__unreserve(conn.auth_hash)
+        run_blocking(conn.disconnect)
 
 
-def get_connection(connection_pool):
+def get_connection(connection_pool, offload_call=True):
+    """Call the decorated function with a connection of the pool.
+
+    The backend calls block, so the function and the generators it
+    returns run through run_blocking. Functions that read the request
+    body must run in the calling greenlet, they are decorated with
+    offload_call=False and use run_blocking for their own storage
+    calls. Waiting for a connection and releasing it do not take a
+    thread of the pool: the requests that hold the connections may
+    need one to get to the release.
+    """
     def use_connection_pool(f):
         @wraps(f)
         def decorated(*args, **kwargs):
             auth = _get_authentication()
-            conn = connection_pool.get_connection(auth)
+            with metrics.timer('storage_pool_wait_duration_seconds'):
+                conn = connection_pool.get_connection(auth)
             if conn is None:
+                invalidate_auth(auth)
                 raise NotAuthorizedException('Invalid credentials')
 
             kwargs.update({'conn': conn.connection})
             try:
-                res = f(*args, **kwargs)
+                with metrics.timer('storage_call_duration_seconds',
+                                   call=f.__name__):
+                    if offload_call:
+                        res = run_blocking(f, *args, **kwargs)
+                    else:
+                        res = f(*args, **kwargs)
             except:
                 connection_pool.release_connection(conn)
                 raise
 
             if isgenerator(res):
                 current_app.logger.debug('typical ls() case encountered')
-                return wrap_generator(res, connection_pool, conn)
+                return wrap_generator(res, connection_pool, conn,
+                                      f.__name__)
             elif isinstance(res, tuple):
                 current_app.logger.debug('typical read() case encountered')
                 if not any(map(isgenerator, res)):
                     connection_pool.release_connection(conn)
                     return res
                 else:  # generator is in the result tuple
-                    wrapped_res = [wrap_generator(i, connection_pool, conn)
+                    wrapped_res = [wrap_generator(i, connection_pool, conn,
+                                                  f.__name__)
                                    if isgenerator(i) else i
                                    for i in res]
                     return wrapped_res
@@ -200,10 +398,69 @@ def get_connection(connection_pool):
     return use_connection_pool
 
 
-def wrap_generator(gen, connection_pool, conn):
-    for i in gen:
-        yield i
-    connection_pool.release_connection(conn)
+def wrap_generator(gen, connection_pool, conn, call=None):
+    # release the connection also if the generator is not consumed
+    # until the end, e.g. when the client goes away during a download.
+    # Otherwise it would be counted as open in the pool forever.
+    # gen is closed first, so it is done with the connection.
+    # Only the time spent in gen is recorded, not the time the
+    # consumer takes between two items.
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = run_blocking(next, gen)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        run_blocking(gen.close)
+        connection_pool.release_connection(conn)
+        if call is not None:
+            metrics.observe('storage_stream_duration_seconds', elapsed,
+                            call=call)
+
+
+# stat() and get_user_metadata() results by path, see metadata.py
+metadata_cache = Cache(max_size=10000)
+
+
+def get_metadata_cache_key(path):
+    """Return the cache key of a path, without trailing slash."""
+    if len(path) > 1:
+        return path.rstrip('/')
+    return path
+
+
+def invalidate_metadata(path):
+    """Forget the cached metadata of a path and its parent.
+
+    The parent is included because its number of children
+    changes when an object is created or deleted.
+    """
+    key = get_metadata_cache_key(path)
+    metadata_cache.delete(key)
+    metadata_cache.delete(os.path.dirname(key))
+
+
+def invalidates_metadata(path_arg=0):
+    """Invalidate the metadata of the path argument after the call.
+
+    It is invalidated even if the call fails, because the object
+    might have been modified partly.
+    """
+    def invalidate_after_call(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            try:
+                return f(*args, **kwargs)
+            finally:
+                invalidate_metadata(args[path_arg])
+        return decorated
+    return invalidate_after_call
 
 
 def _get_authentication():
@@ -288,6 +545,14 @@ class MalformedPathException(StorageException):
         return repr(self.msg)
 
 
+class MalformedTokenException(StorageException):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
 class CopyException(StorageException):
     def __init__(self, msg):
         self.msg = msg
@@ -304,6 +569,40 @@ class NotImplementedException(StorageException):
         return repr(self.msg)
 
 
+def make_ls_token(obj):
+    """Return the token to continue a listing after obj.
+
+    The token is opaque for clients. Backends get the type and
+    name of obj back from parse_ls_token().
+    """
+    return urlsafe_b64encode('%s:%s' % (obj.objtype, obj.name))
+
+
+def parse_ls_token(token):
+    """Return the (objtype, name) tuple of a token of make_ls_token()."""
+    try:
+        objtype, name = urlsafe_b64decode(str(token)).split(':', 1)
+    except (TypeError, ValueError, binascii.Error, UnicodeError):
+        raise MalformedTokenException('Malformed continuation token')
+
+    if objtype not in (DIR, FILE):
+        raise MalformedTokenException('Malformed continuation token')
+    return objtype, name
+
+
+def quote_query_value(value):
+    """Return value as a string literal for a catalog query condition.
+
+    Catalog queries like the GenQuery of iRODS have no escape for a
+    quote within a literal, so a value with a single quote would end
+    the literal early and change the condition. Such values are
+    rejected with MalformedPathException.
+    """
+    if "'" in value:
+        raise MalformedPathException('Quotes are not supported in names')
+    return "'%s'" % value
+
+
 def adjust_range_size(x, y, file_size):
     '''Adjust from range representation of the CDMI layer.
 
@@ -350,6 +649,42 @@ def get_range_size(x, y, file_size):
     return y - x + 1  # http expects the last byte included
 
 
+def plan_range_reads(ordered_range_list, file_size, max_gap=0,
+                     max_span=4194304):
+    """Group sorted ranges into spans that are read at once.
+
+    Returns a list of (span_start, span_end, segments) tuples, where
+    segments holds the (segment_start, segment_end) tuples of the
+    ranges in the span. All ends include the last byte.
+
+    A range joins the span before it if they overlap or if at most
+    max_gap bytes lie between them, as long as the span stays within
+    max_span bytes. A range larger than max_span is a span of its own.
+    """
+    spans = []
+    for start, end in ordered_range_list:
+        if start == START:
+            start = 0
+
+        segment_end = end
+        if end == END:
+            segment_end = file_size - 1
+        read_end = min(segment_end, file_size - 1)
+
+        if spans:
+            span_start, span_end, segments = spans[-1]
+            new_span_end = max(span_end, read_end)
+            if (start <= span_end + 1 + max_gap and
+                    new_span_end - span_start + 1 <= max_span):
+                segments.append((start, segment_end))
+                spans[-1] = (span_start, new_span_end, segments)
+                continue
+
+        spans.append((start, read_end, [(start, segment_end)]))
+
+    return spans
+
+
 def read_stream_generator(file_handle, file_size,
                           ordered_range_list, read_func,
                           seek_func, close_func,
@@ -363,12 +698,13 @@ def read_stream_generator(file_handle, file_size,
 
     In case of no range requests, the whole file is read.
 
-    With range requests, we seek the range, and then deliver
-    the bytestream in buffer_size chunks. To stop at the end
-    of the range, the make the last buffer smaller.
-    This might become a performance issue, as we can have very
-    small chunks. Also we deliver differently sized chunks to
-    the frontend, and I'm not sure how they take it.
+    With range requests, the ranges are grouped into spans by
+    plan_range_reads(), with a gap of RANGE_MERGE_GAP bytes.
+    Each span is read with one seek and one read, and the ranges
+    are cut out of it, so overlapping and close ranges are read only
+    once. The seek is left out if the span starts where the last
+    one ended. Ranges larger than buffer_size are delivered in
+    buffer_size chunks.
 
     The special values START and END represent the start and end
     of the file to allow for range requests that only specify
@@ -385,48 +721,188 @@ def read_stream_generator(file_handle, file_size,
      segment_end,     absolute position of the end in the file
      segment_data     data in this chunk
     )
+
+    With RANGE_READ_AHEAD, the storage is read in a thread one chunk
+    ahead of the consumer, see read_ahead().
+
+    Under gevent, the reads run in the storage thread pool (see
+    executor.py) and the generator gives way to other greenlets
+    while it waits. Read-ahead is not used then, its queue would
+    block the hub.
     """
-    multipart = False
-    delimiter = False
-    if len(ordered_range_list) > 1:
-        multipart = True
-
-    if not ordered_range_list:
-        for data in iter(partial(read_func, file_handle, buffer_size), ''):
-            yield delimiter, 0, file_size, data
-    else:
-        for start, end in ordered_range_list:
-            if start == START:
-                start = 0
-
-            segment_start = start
-            segment_end = end
-
-            seek_func(file_handle, segment_start)
-
-            if end == END:
-                segment_end = file_size - 1
-
-            # http expects the last byte included
-            range_size = segment_end - segment_start + 1
-            range_size_acc = 0
-            range_buffer_size = buffer_size
-
-            if multipart:
-                delimiter = range_size
-
-            while range_size_acc < range_size:
-                if (range_size - range_size_acc) < range_buffer_size:
-                    range_buffer_size = (range_size - range_size_acc)
-
-                data = read_func(file_handle, range_buffer_size)
-                if data == '':
-                    break
-                yield delimiter, segment_start, segment_end, data
+    gen = _read_ranges(file_handle, file_size, ordered_range_list,
+                       offload(read_func), offload(seek_func),
+                       offload(close_func), buffer_size,
+                       current_app.config.get('RANGE_MERGE_GAP', 65536))
+    if (current_app.config.get('RANGE_READ_AHEAD', False) and
+            not is_offloading()):
+        return read_ahead(gen)
+    return gen
+
+
+def _read_ranges(file_handle, file_size, ordered_range_list, read_func,
+                 seek_func, close_func, buffer_size, max_gap):
+    multipart = len(ordered_range_list) > 1
+
+    try:
+        if not ordered_range_list:
+            for data in iter(partial(read_func, file_handle, buffer_size),
+                             ''):
+                yield False, 0, file_size, data
+            return
+
+        position = None
+        for span_start, span_end, segments in plan_range_reads(
+                ordered_range_list, file_size, max_gap, buffer_size):
+            if position != span_start:
+                seek_func(file_handle, span_start)
+            position = span_start
+            span_size = span_end - span_start + 1
+
+            if span_size > buffer_size:
+                # a single large range, deliver it in chunks
+                segment_start, segment_end = segments[0]
                 delimiter = False
-                range_size_acc += range_buffer_size
+                if multipart:
+                    delimiter = segment_end - segment_start + 1
+                for data in _read_chunks(file_handle, read_func,
+                                         span_size, buffer_size):
+                    position += len(data)
+                    yield delimiter, segment_start, segment_end, data
+                    delimiter = False
+                continue
+
+            span_data = ''.join(_read_chunks(file_handle, read_func,
+                                             span_size, buffer_size))
+            position += len(span_data)
+            for segment_start, segment_end in segments:
+                data = span_data[segment_start - span_start:
+                                 segment_end - span_start + 1]
+                if not data:
+                    continue
+                delimiter = False
+                if multipart:
+                    delimiter = segment_end - segment_start + 1
+                yield delimiter, segment_start, segment_end, data
+    finally:
+        close_func(file_handle)
+
+
+def _read_chunks(file_handle, read_func, size, buffer_size):
+    """Read size bytes in chunks of at most buffer_size."""
+    while size > 0:
+        data = read_func(file_handle, min(size, buffer_size))
+        if data == '':
+            return
+        size -= len(data)
+        yield data
 
-    close_func(file_handle)
+
+def read_ahead(gen, queue_size=1):
+    """Run a generator in a thread, up to queue_size items ahead.
+
+    Used to read the next part of a file from the storage while the
+    current part is sent to the client. Exceptions of gen are raised
+    to the consumer. If the consumer stops early, gen is closed in
+    its thread before this generator finishes, so the storage
+    connection is not used any more once it is released.
+    """
+    items = Queue(maxsize=queue_size)
+    stop = Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in gen:
+                if not put((None, item)):
+                    return
+            put((None, done))
+        except Exception:
+            put((sys.exc_info(), None))
+        finally:
+            gen.close()
+
+    thread = Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            exc_info, item = items.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+class FileRangeStream(object):
+    """A single byte range of an open local file.
+
+    Iterating over it yields the same tuples as read_stream_generator,
+    so it can stand in for the generator returned by read().
+
+    It also behaves like a read-only file that ends at the end of the
+    range. This lets frontends hand it to the WSGI server through
+    wsgi.file_wrapper: servers that support it send the data with
+    sendfile() from fileno() (starting at the current offset and
+    stopping after Content-Length bytes), all others fall back to
+    read(), which never goes past the range.
+    """
+
+    def __init__(self, file_handle, file_size, start, length,
+                 buffer_size=4194304):
+        self.file_handle = file_handle
+        self.file_size = file_size
+        self.start = start
+        self.length = max(length, 0)
+        self.buffer_size = buffer_size
+        self.remaining = self.length
+
+        self.file_handle.seek(self.start)
+
+    def __iter__(self):
+        if self.length == self.file_size:
+            segment_start, segment_end = 0, self.file_size
+        else:
+            segment_start = self.start
+            segment_end = self.start + self.length - 1
+
+        for data in iter(partial(self.read, self.buffer_size), ''):
+            yield False, segment_start, segment_end, data
+
+        self.close()
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.file_handle.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file_handle.fileno()
+
+    def tell(self):
+        return self.file_handle.tell()
+
+    def close(self):
+        self.file_handle.close()
 
 
 def simple_read_stream_generator(file_handle, file_size,
@@ -440,3 +916,54 @@ def simple_read_stream_generator(file_handle, file_size,
             yield data
 
     close_func(file_handle)
+
+
+# the user metadata field that holds the size and modification time
+# of the file the cached checksum was computed for
+CHECKSUM_STAMP_KEY = 'checksum_stamp'
+
+
+def make_checksum_stamp(size, mtime):
+    return '%s:%s' % (size, mtime)
+
+
+def get_cached_checksum(user_meta, algorithm, stamp):
+    """Return the checksum cached in user_meta, or None.
+
+    The cached value is only used if it has the right algorithm
+    and was computed for the file as it is now (see
+    make_checksum_stamp).
+    """
+    value = user_meta.get(CHECKSUM_KEY, None)
+    if value is None or user_meta.get(CHECKSUM_STAMP_KEY, None) != stamp:
+        return None
+    try:
+        cached_algorithm, _ = parse_checksum(value)
+    except UnknownAlgorithmException:
+        return None
+    if cached_algorithm != algorithm:
+        return None
+    return value
+
+
+def is_stored_algorithm(algorithm):
+    """Return if checksums of algorithm are kept in the user metadata.
+
+    There is one checksum field, it holds the checksum of
+    CHECKSUM_ALGORITHM that is computed on upload. Checksums of other
+    algorithms, e.g. for Want-Digest, are computed when asked for and
+    not stored, so that they do not replace it.
+    """
+    return algorithm == current_app.config.get('CHECKSUM_ALGORITHM', 'md5')
+
+
+def make_checksum_metadata(value, stamp):
+    return {CHECKSUM_KEY: value, CHECKSUM_STAMP_KEY: stamp}
+
+
+def compute_checksum(read_gen, algorithm):
+    """Compute a checksum from the generator returned by read()."""
+    checksum = Checksum(algorithm)
+    for _, _, _, data in read_gen:
+        checksum.update(data)
+    return checksum.value()
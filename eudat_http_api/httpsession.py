@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import RequestsCookieJar
+
+
+# methods that can be sent again without changing the result
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+# answers of proxies and overloaded servers that are worth a retry
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+
+class DiscardingCookieJar(RequestsCookieJar):
+    """A cookie jar that stays empty, whatever is put into it."""
+    def set_cookie(self, cookie, *args, **kwargs):
+        pass
+
+
+class RetrySession(requests.Session):
+    """A requests session with a sized connection pool and retries.
+
+    Connections to a host are kept open and reused by all requests
+    that go through the session. Idempotent requests are sent again
+    after connection errors and 502/503/504 answers, waiting
+    backoff, 2 * backoff, 4 * backoff, ... seconds in between.
+    Requests with a streamed body cannot be sent twice and are
+    never retried.
+
+    The session holds no credentials, pass them with every request.
+    Cookies are not kept either: a cookie that a server sets for the
+    credentials of one user must not be sent with the requests of
+    another. The connection pool is thread-safe, so one session can
+    be shared by all worker threads.
+    """
+    def __init__(self, pool_size=10, retries=3, backoff=0.5, timeout=60):
+        super(RetrySession, self).__init__()
+        self.cookies = DiscardingCookieJar()
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        for prefix in ['http://', 'https://']:
+            self.mount(prefix, HTTPAdapter(pool_connections=pool_size,
+                                           pool_maxsize=pool_size))
+
+    def _can_retry(self, method, data):
+        return (method.upper() in IDEMPOTENT_METHODS and
+                (data is None or isinstance(data, basestring)))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        retries = 0
+        if self._can_retry(method, kwargs.get('data')):
+            retries = self.retries
+
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = super(RetrySession, self).request(method, url,
+                                                             **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                continue
+
+            if (response.status_code not in RETRY_STATUS_CODES or
+                    attempt == retries):
+                return response
+            response.close()
+
+
+_session = None
+_session_args = dict()
+_session_lock = Lock()
+
+
+def configure_session(**kwargs):
+    """Set the arguments of RetrySession for the shared session.
+
+    A shared session that exists already is replaced.
+    """
+    global _session
+    with _session_lock:
+        _session_args.clear()
+        _session_args.update(kwargs)
+        _session = None
+
+
+def get_session():
+    """Return the session that is shared by all HTTP clients."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = RetrySession(**_session_args)
+        return _session
+
+
+def configure_session_from(config):
+    """Configure the shared session from the HTTP_CLIENT_* settings."""
+    configure_session(
+        pool_size=config.get('HTTP_CLIENT_POOL_SIZE', 10),
+        retries=config.get('HTTP_CLIENT_RETRIES', 3),
+        backoff=config.get('HTTP_CLIENT_BACKOFF', 0.5),
+        timeout=config.get('HTTP_CLIENT_TIMEOUT', 60))
@@ -2,19 +2,79 @@
 
 from __future__ import with_statement
 
+import time
+
 from flask import current_app
 
 from eudat_http_api.http_storage import storage
+from eudat_http_api.http_storage import storage_common
+from eudat_http_api.http_storage.common import get_config_parameter
+from eudat_http_api.http_storage.storage_common import get_metadata_cache_key
+from eudat_http_api.http_storage.storage_common import metadata_cache
 
 
 def stat(identifier, user_metadata=None):
     current_app.logger.debug('called the metadata service')
-    return storage.stat(identifier, user_metadata)
+    return _cached_call(storage.stat, 'stat', identifier, user_metadata)
 
 
 def get_user_metadata(identifier, user_metadata=None):
-    return storage.get_user_metadata(identifier, user_metadata)
+    return _cached_call(storage.get_user_metadata, 'user_metadata',
+                        identifier, user_metadata)
+
+
+def get_checksum(identifier, algorithm):
+    """Return the stored checksum of a file, or None.
+
+    The checksum is never computed here, see storage.checksum.
+    """
+    return _cached_call(_get_stored_checksum, 'checksum', identifier,
+                        algorithm)
+
+
+def _get_stored_checksum(identifier, algorithm):
+    return storage.checksum(identifier, algorithm, compute=False)
 
 
 def set_user_metadata(identifier, user_metadata):
     return storage.set_user_metadata(identifier, user_metadata)
+
+
+def _cached_call(func, name, identifier, user_metadata):
+    """Call func(identifier, user_metadata) through the metadata cache.
+
+    Results are cached for METADATA_CACHE_TTL seconds per user,
+    NotFoundExceptions as well. The entries of one path are kept
+    together so that storage.py can invalidate them at once when
+    the path is modified.
+
+    The returned dicts are shared, callers must not modify them.
+    """
+    ttl = get_config_parameter('METADATA_CACHE_TTL', 5)
+    if ttl <= 0:
+        return func(identifier, user_metadata)
+
+    metadata_key = user_metadata
+    if isinstance(metadata_key, list):
+        metadata_key = tuple(metadata_key)
+    auth = storage_common._get_authentication()
+    entry_key = (auth.get_auth_hash(), name, metadata_key)
+    path_key = get_metadata_cache_key(identifier)
+
+    # the entries dict is replaced, never modified, so that concurrent
+    # requests can read it without locking
+    entries = metadata_cache.get(path_key, {})
+    expires, result = entries.get(entry_key, (0, None))
+    if expires < time.time():
+        try:
+            result = func(identifier, user_metadata)
+        except storage.NotFoundException as e:
+            result = e
+
+        entries = dict(entries)
+        entries[entry_key] = (time.time() + ttl, result)
+        metadata_cache.set(path_key, entries, ttl)
+
+    if isinstance(result, storage.NotFoundException):
+        raise result
+    return result
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock
+import time
+
+from flask import request
+from flask import Response
+
+
+# upper bounds in seconds of the buckets of all duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                    5.0, 10.0, 30.0, 60.0)
+
+# the metrics that are recorded, name -> (type, help)
+METRICS = {
+    'http_request_duration_seconds': (
+        'histogram', 'Time from the start of a request until the last '
+        'byte of the response was sent.'),
+    'http_request_size_bytes_total': (
+        'counter', 'Bytes read from request bodies.'),
+    'http_response_size_bytes_total': (
+        'counter', 'Bytes sent in response bodies.'),
+    'storage_call_duration_seconds': (
+        'histogram', 'Time spent in storage backend calls, without '
+        'waiting for a connection.'),
+    'storage_stream_duration_seconds': (
+        'histogram', 'Time spent in the storage backend while streaming '
+        'the result of a call, e.g. the chunks of a read.'),
+    'storage_pool_wait_duration_seconds': (
+        'histogram', 'Time spent waiting for a storage connection.'),
+    'auth_duration_seconds': (
+        'histogram', 'Time the storage backend takes to check '
+        'credentials, cached results are not included.'),
+}
+
+# request methods that get their own label value, others are 'other'
+KNOWN_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'POST', 'DELETE',
+                           'OPTIONS'])
+
+# environ key of the endpoint of a request, see record_endpoint
+ENDPOINT_KEY = 'eudat_http_api.endpoint'
+
+
+class Histogram(object):
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Counters and histograms, rendered in the Prometheus text format.
+
+    Every metric is a set of series that differ in their labels,
+    e.g. one latency histogram per endpoint. Recording a value takes
+    a lock and a dict lookup, so it can be done on every request.
+
+    The values are kept per process. With several server workers,
+    each one reports its own requests.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        # (name, labels) -> value or Histogram, labels is a sorted
+        # tuple of (label, value)
+        self.counters = dict()
+        self.histograms = dict()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the time the with block takes, also if it raises."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self):
+        with self.lock:
+            counters = sorted(self.counters.iteritems())
+            histograms = sorted(
+                (key, (list(h.counts), h.sum, h.count))
+                for key, h in self.histograms.iteritems())
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                metric_type, help_text = METRICS.get(name, ('untyped', ''))
+                lines.append('# HELP %s %s' % (name, help_text))
+                lines.append('# TYPE %s %s' % (name, metric_type))
+
+        for (name, labels), value in counters:
+            describe(name)
+            lines.append('%s%s %s' % (name, format_labels(labels),
+                                      format_value(value)))
+
+        for (name, labels), (counts, total, count) in histograms:
+            describe(name)
+            cumulative = 0
+            bounds = [format_value(b) for b in DURATION_BUCKETS] + ['+Inf']
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', bound),)),
+                    cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                          format_value(total)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels),
+                                            count))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (label, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+
+
+class CountingInput(object):
+    """Count the bytes read from a wsgi.input stream."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.size += len(data)
+        return data
+
+    def readline(self, *args):
+        line = self.stream.readline(*args)
+        self.size += len(line)
+        return line
+
+    def readlines(self, *args):
+        lines = self.stream.readlines(*args)
+        self.size += sum(map(len, lines))
+        return lines
+
+    def __iter__(self):
+        for line in self.stream:
+            self.size += len(line)
+            yield line
+
+
+def is_file_wrapper(environ, response):
+    """Return if response was made by the wsgi.file_wrapper of environ.
+
+    The server sends such responses itself, e.g. with sendfile, but
+    only if it gets back its own object. Middlewares must not wrap
+    them, see call_on_close.
+    """
+    wrapper = environ.get('wsgi.file_wrapper', None)
+    return isinstance(wrapper, type) and isinstance(response, wrapper)
+
+
+def call_on_close(response, callback):
+    """Call callback after the server closed response."""
+    close = getattr(response, 'close', None)
+
+    def closing():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+    response.close = closing
+    return response
+
+
+class MetricsMiddleware(object):
+    """Record latency and bytes in and out of every request.
+
+    The latency includes sending a streamed response, so it is only
+    recorded when the server closes the response. Responses of
+    wsgi.file_wrapper are passed on unchanged, their size is taken
+    from the Content-Length. Requests are labelled with their
+    endpoint, which includes the blueprint. Requests that match no
+    route have the endpoint 'none'.
+    """
+    def __init__(self, app, registry=metrics):
+        self.app = app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        request_body = CountingInput(environ['wsgi.input'])
+        environ['wsgi.input'] = request_body
+        status = ['500']
+        content_length = [0]
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            for name, value in headers:
+                if name.lower() == 'content-length' and value.isdigit():
+                    content_length[0] = int(value)
+            return start_response(status_line, headers, exc_info)
+
+        def record(response_size):
+            endpoint = environ.get(ENDPOINT_KEY) or 'none'
+            method = environ.get('REQUEST_METHOD', '')
+            if method not in KNOWN_METHODS:
+                method = 'other'
+            self.registry.observe('http_request_duration_seconds',
+                                  time.time() - start, endpoint=endpoint,
+                                  method=method, status=status[0])
+            self.registry.inc('http_request_size_bytes_total',
+                              request_body.size, endpoint=endpoint)
+            self.registry.inc('http_response_size_bytes_total',
+                              response_size, endpoint=endpoint)
+
+        try:
+            response = self.app(environ, recording_start_response)
+        except:
+            record(0)
+            raise
+        if is_file_wrapper(environ, response):
+            return call_on_close(response,
+                                 lambda: record(content_length[0]))
+        return RecordingResponse(response, record)
+
+
+class RecordingResponse(object):
+    """Count the bytes of a WSGI response, report them on close."""
+    def __init__(self, response, on_close):
+        self.response = response
+        self.on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.response:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            self.on_close(self.size)
+
+
+def record_endpoint():
+    """Tell the middleware the endpoint of the current request."""
+    request.environ[ENDPOINT_KEY] = request.endpoint
+
+
+def show_metrics():
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Record metrics of all requests of app and serve them.
+
+    They are served at METRICS_URL, without authentication.
+    """
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app)
+    app.before_request(record_endpoint)
+    app.add_url_rule(app.config.get('METRICS_URL', '/metrics'), 'metrics',
+                     show_metrics)
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import atexit
+from collections import defaultdict
+from functools import wraps
+import itertools
+import logging
+import os
+import re
+import sys
+import thread
+import threading
+import time
+
+from flask import abort
+from flask import current_app
+from flask import request
+from flask import Response
+from flask.ext.login import login_required
+
+from eudat_http_api.metrics import call_on_close, is_file_wrapper
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProfiledRequest(object):
+    """The stack samples taken while a request was running."""
+    def __init__(self, environ):
+        self.method = environ.get('REQUEST_METHOD', '')
+        self.path = environ.get('PATH_INFO', '')
+        self.start = time.time()
+        # folded stack -> number of samples
+        self.samples = defaultdict(int)
+
+
+class StackSampler(object):
+    """Sample the stacks of all threads every interval seconds.
+
+    A sampling profiler: the requests run at full speed, a
+    background thread looks at what they are doing. Frames of
+    requests are registered with track(), every sample of a stack
+    that contains such a frame is added to the samples of its
+    request. This also works with gevent, where all requests run in
+    the same thread: only the greenlet that is running shows up in
+    the stack of its thread.
+
+    The samples are wall clock samples, a request that waits for the
+    storage is sampled like one that computes.
+    """
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.lock = threading.Lock()
+        # id of a frame -> the ProfiledRequest it runs for
+        self.owners = dict()
+        # samples of all threads, see capture
+        self.captures = []
+        # samples of all requests since the start
+        self.aggregate = defaultdict(int)
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            sampler_thread, self.thread = self.thread, None
+        if sampler_thread is not None:
+            sampler_thread.join()
+
+    def run(self):
+        sampler_thread = thread.get_ident()
+        while self.thread is not None:
+            time.sleep(self.interval)
+            try:
+                self.sample(sampler_thread)
+            except Exception:
+                logger.error('taking a stack sample failed', exc_info=True)
+
+    def track(self, frame, owner):
+        """Add the samples of stacks that contain frame to owner.
+
+        frame must be untracked before it returns.
+        """
+        with self.lock:
+            self.owners[id(frame)] = owner
+
+    def untrack(self, frame):
+        with self.lock:
+            self.owners.pop(id(frame), None)
+
+    def find_owner(self, frame):
+        """Return the request that frame or one of its callers runs for."""
+        with self.lock:
+            while frame is not None:
+                owner = self.owners.get(id(frame))
+                if owner is not None:
+                    return owner
+                frame = frame.f_back
+        return None
+
+    def sample(self, sampler_thread=None):
+        """Take one sample of all threads but sampler_thread."""
+        if sampler_thread is None:
+            sampler_thread = thread.get_ident()
+        frames = sys._current_frames()
+        with self.lock:
+            if not self.owners and not self.captures:
+                return
+            for thread_id, frame in frames.iteritems():
+                if thread_id == sampler_thread:
+                    continue
+                owner = None
+                names = []
+                while frame is not None:
+                    if owner is None:
+                        owner = self.owners.get(id(frame))
+                    names.append(get_frame_name(frame))
+                    frame = frame.f_back
+                stack = ';'.join(reversed(names))
+
+                if owner is not None:
+                    owner.samples[stack] += 1
+                    self.aggregate[stack] += 1
+                for samples in self.captures:
+                    samples[stack] += 1
+
+    def capture(self, seconds, sleep=time.sleep):
+        """Return the samples of all threads during the next seconds."""
+        samples = defaultdict(int)
+        with self.lock:
+            self.captures.append(samples)
+        try:
+            sleep(seconds)
+        finally:
+            with self.lock:
+                self.captures.remove(samples)
+        return samples
+
+    def get_aggregate(self):
+        with self.lock:
+            return dict(self.aggregate)
+
+
+def get_frame_name(frame):
+    return '%s.%s' % (frame.f_globals.get('__name__', '?'),
+                      frame.f_code.co_name)
+
+
+def format_folded(samples):
+    """Return samples in the folded format of flamegraph.pl.
+
+    One line per stack, the frames from the outermost separated by
+    semicolons, then the number of samples.
+    """
+    return ''.join('%s %d\n' % (stack, count)
+                   for stack, count in sorted(samples.iteritems()))
+
+
+# the sampler of this process, see init_app
+sampler = None
+_sampler_lock = threading.Lock()
+
+
+def get_sampler(interval):
+    global sampler
+    with _sampler_lock:
+        if sampler is None:
+            sampler = StackSampler(interval)
+            sampler.start()
+            atexit.register(sampler.stop)
+        return sampler
+
+
+def follow_request(func):
+    """Attribute the samples of func to the current request.
+
+    For functions that the request hands to another thread, like
+    the storage calls in executor.run_blocking.
+    """
+    current_sampler = sampler
+    if current_sampler is None:
+        return func
+    owner = current_sampler.find_owner(sys._getframe(1))
+    if owner is None:
+        return func
+
+    @wraps(func)
+    def followed(*args, **kwargs):
+        frame = sys._getframe()
+        current_sampler.track(frame, owner)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_sampler.untrack(frame)
+    return followed
+
+
+class ProfilerMiddleware(object):
+    """Write the stack samples of some requests to directory.
+
+    Every sample_rate-th request and all requests that take at least
+    slow_threshold seconds, including sending the response, are
+    written to a file in the folded format. 0 disables either. Only
+    the newest max_files files are kept.
+    """
+    def __init__(self, app, sampler, directory, sample_rate=0,
+                 slow_threshold=0, max_files=100):
+        self.app = app
+        self.sampler = sampler
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        self.counter = itertools.count(1)
+
+    def __call__(self, environ, start_response):
+        profiled = ProfiledRequest(environ)
+        frame = sys._getframe()
+        self.sampler.track(frame, profiled)
+        try:
+            response = self.app(environ, start_response)
+        except:
+            self.finish(profiled)
+            raise
+        finally:
+            self.sampler.untrack(frame)
+        if is_file_wrapper(environ, response):
+            # the server sends it without running Python code
+            return call_on_close(response, lambda: self.finish(profiled))
+        return ProfiledResponse(response, self.sampler, profiled,
+                                self.finish)
+
+    def finish(self, profiled):
+        duration = time.time() - profiled.start
+        number = next(self.counter)
+        if not profiled.samples:
+            return
+        if ((self.slow_threshold > 0 and duration >= self.slow_threshold) or
+                (self.sample_rate > 0 and number % self.sample_rate == 0)):
+            try:
+                self.write(profiled, duration, number)
+            except (IOError, OSError):
+                logger.error('writing the profile of %s %s failed',
+                             profiled.method, profiled.path, exc_info=True)
+
+    def write(self, profiled, duration, number):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        # sorted by time, the rest only tells the files apart
+        name = '%s-%d-%d-%dms-%s-%s.folded' % (
+            time.strftime('%Y%m%d%H%M%S'), os.getpid(), number,
+            duration * 1000, profiled.method,
+            re.sub('[^A-Za-z0-9.]+', '_', profiled.path)[:60])
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write(format_folded(profiled.samples))
+
+        names = sorted(n for n in os.listdir(self.directory)
+                       if n.endswith('.folded'))
+        for old in names[:-self.max_files]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                # removed by another worker
+                pass
+
+
+class ProfiledResponse(object):
+    """Keep sampling a request while its response is sent."""
+    def __init__(self, response, sampler, profiled, on_close):
+        self.response = response
+        self.sampler = sampler
+        self.profiled = profiled
+        self.on_close = on_close
+
+    def __iter__(self):
+        frame = sys._getframe()
+        self.sampler.track(frame, self.profiled)
+        try:
+            for chunk in self.response:
+                yield chunk
+        finally:
+            self.sampler.untrack(frame)
+
+    def close(self):
+        try:
+            if hasattr(self.response, 'close'):
+                self.response.close()
+        finally:
+            self.on_close(self.profiled)
+
+
+def folded_response(samples):
+    return Response(format_folded(samples), mimetype='text/plain')
+
+
+def show_flamegraph():
+    """Return the samples of all requests since the start."""
+    return folded_response(sampler.get_aggregate())
+
+
+# only one capture runs at a time, each keeps the sampler busy
+_capture_lock = threading.Lock()
+
+
+def capture():
+    """Sample all threads for ?seconds=, at most PROFILER_MAX_CAPTURE.
+
+    Only one capture runs at a time, others are answered with 429.
+    """
+    from eudat_http_api.http_storage.executor import cooperative_sleep
+
+    seconds = request.args.get('seconds', 10, type=float)
+    if seconds <= 0:
+        abort(400)
+    seconds = min(seconds, current_app.config.get('PROFILER_MAX_CAPTURE',
+                                                  60))
+    if not _capture_lock.acquire(False):
+        abort(429)
+    try:
+        # the sleep must neither block the other requests of a gevent
+        # worker nor hold one of the storage threads
+        samples = sampler.capture(seconds, sleep=cooperative_sleep)
+    finally:
+        _capture_lock.release()
+    return folded_response(samples)
+
+
+def init_app(app):
+    """Profile the requests of app with the PROFILER_* settings.
+
+    The samples are also served at PROFILER_URL/flamegraph and
+    PROFILER_URL/capture, to authenticated users.
+    """
+    app.wsgi_app = ProfilerMiddleware(
+        app.wsgi_app, get_sampler(app.config.get('PROFILER_INTERVAL', 0.02)),
+        app.config.get('PROFILER_DIR', '/tmp/http_profiles'),
+        sample_rate=app.config.get('PROFILER_SAMPLE_RATE', 0),
+        slow_threshold=app.config.get('PROFILER_SLOW_THRESHOLD', 1.0),
+        max_files=app.config.get('PROFILER_MAX_FILES', 100))
+
+    url = app.config.get('PROFILER_URL', '/profiler').rstrip('/')
+    app.add_url_rule(url + '/flamegraph', 'profiler_flamegraph',
+                     login_required(show_flamegraph))
+    app.add_url_rule(url + '/capture', 'profiler_capture',
+                     login_required(capture))
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import base64
+
+from cryptography.fernet import Fernet, InvalidToken
+
+
+class InvalidCredentialsException(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+
+def _to_bytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def get_fernet(key):
+    """Return the Fernet of key, a key of Fernet.generate_key().
+
+    Raises InvalidCredentialsException if there is no key or it is
+    not a Fernet key, e.g. a SECRET_KEY that was put there.
+    """
+    if not key:
+        raise InvalidCredentialsException(
+            'REGISTRATION_CREDENTIALS_KEY is not set')
+    try:
+        return Fernet(_to_bytes(key))
+    except (TypeError, ValueError):
+        raise InvalidCredentialsException(
+            'REGISTRATION_CREDENTIALS_KEY is not a Fernet key')
+
+
+def encrypt_credentials(key, username, password):
+    """Encrypt username and password for storing them in the database.
+
+    The registration workers need the credentials of the user to
+    copy the data, possibly long after the request was made and in
+    another process. They are encrypted and authenticated with
+    Fernet (AES-128-CBC and HMAC-SHA256) of the cryptography package,
+    under the dedicated REGISTRATION_CREDENTIALS_KEY.
+    """
+    plain = '%s:%s' % (base64.b64encode(_to_bytes(username)),
+                       base64.b64encode(_to_bytes(password)))
+    return get_fernet(key).encrypt(plain)
+
+
+def decrypt_credentials(key, token):
+    """Return (username, password) of a token of encrypt_credentials."""
+    fernet = get_fernet(key)
+    try:
+        plain = fernet.decrypt(_to_bytes(token))
+    except (InvalidToken, TypeError):
+        raise InvalidCredentialsException(
+            'credentials were modified or encrypted with another key')
+    username, password = plain.split(':', 1)
+    return base64.b64decode(username), base64.b64decode(password)
@@ -10,32 +10,146 @@ from werkzeug.utils import redirect
 from eudat_http_api.common import request_wants, ContentTypes, is_local
 from eudat_http_api.epicclient import EpicClient
 
+from eudat_http_api.registration.credentials import \
+    InvalidCredentialsException
 from eudat_http_api.registration.models import db, RegistrationRequest, \
     RegistrationRequestSerializer
+from eudat_http_api.registration.pidcache import resolve_handle
+from eudat_http_api.registration.replicas import replica_selector, \
+    configure_selector_from
 from eudat_http_api.registration.registration_worker import add_task, \
-    start_workers, set_config
+    check_credentials_key, start_workers, set_config, Context
 
+import base64
 from datetime import datetime
+import requests
 from requests.auth import HTTPBasicAuth
+from sqlalchemy import or_
+from urlparse import urlparse
 
 registration = Blueprint('registration', __name__,
                          template_folder='templates')
 
 
-class Context():
-    pass
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
+# query parameters of the request list that filter the requests
+FILTER_ARGS = ['status', 'state', 'src_prefix']
 
-def get_hal_links(reg_requests, page):
+
+class RequestPage(object):
+    """A page of the request list, the newest requests first."""
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0])
+
+
+def encode_cursor(r):
+    """Return the position of a request in the list as url parameter."""
+    return base64.urlsafe_b64encode(
+        '%s|%d' % (r.timestamp.strftime(CURSOR_TIME_FORMAT), r.id))
+
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) of a cursor, raise ValueError if invalid."""
+    try:
+        timestamp, request_id = \
+            base64.urlsafe_b64decode(str(cursor)).split('|')
+    except (TypeError, UnicodeEncodeError):
+        raise ValueError('invalid cursor %r' % cursor)
+    return (datetime.strptime(timestamp, CURSOR_TIME_FORMAT),
+            int(request_id))
+
+
+def get_prefix_end(prefix):
+    """Return the smallest string after all strings that start with prefix.
+
+    None if there is none, i.e. prefix consists of the last code point
+    only.
+    """
+    while prefix:
+        try:
+            return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+        except ValueError:
+            # the last code point, all strings with prefix[:-1] qualify
+            prefix = prefix[:-1]
+    return None
+
+
+def filter_requests(query, filters):
+    """Filter the requests in the database.
+
+    status and state match exactly. src_prefix is a range on src_url,
+    unlike LIKE it can use the index.
+    """
+    if filters.get('status'):
+        query = query.filter(
+            RegistrationRequest.status_description == filters['status'])
+    if filters.get('state'):
+        query = query.filter(RegistrationRequest.state == filters['state'])
+    prefix = filters.get('src_prefix')
+    if prefix:
+        query = query.filter(RegistrationRequest.src_url >= prefix)
+        end = get_prefix_end(prefix)
+        if end is not None:
+            query = query.filter(RegistrationRequest.src_url < end)
+    return query
+
+
+def get_request_page(query, per_page, after=None, before=None):
+    """Return the page of requests after or before a cursor.
+
+    The requests are ordered by (timestamp, id), newest first. A page
+    is found with the index on these columns, so it takes the same
+    time anywhere in the list, unlike OFFSET. There is no total count.
+    Requests without a timestamp have no place in the list and are
+    left out.
+    """
+    timestamp = RegistrationRequest.timestamp
+    request_id = RegistrationRequest.id
+    query = query.filter(timestamp != None)  # noqa
+    if before is not None:
+        ts, rid = before
+        query = query.filter(timestamp >= ts,
+                             or_(timestamp > ts, request_id > rid))
+        items = query.order_by(timestamp.asc(), request_id.asc()).limit(
+            per_page + 1).all()
+        has_prev = len(items) > per_page
+        return RequestPage(list(reversed(items[:per_page])), True, has_prev)
+
+    if after is not None:
+        ts, rid = after
+        query = query.filter(timestamp <= ts,
+                             or_(timestamp < ts, request_id < rid))
+    items = query.order_by(timestamp.desc(), request_id.desc()).limit(
+        per_page + 1).all()
+    has_next = len(items) > per_page
+    return RequestPage(items[:per_page], has_next, after is not None)
+
+
+def get_hal_links(reg_requests, filters):
     """returns links in json hal format"""
+    args = dict(flask.request.args.items())
     navi = dict()
-    navi['self'] = {'href': url_for('.get_requests', page=page)}
+    navi['self'] = {'href': url_for('.get_requests', **args)}
+    navi['first'] = {'href': url_for('.get_requests', **filters)}
     if reg_requests.has_next:
         navi['next'] = {
-            'href': url_for('.get_requests', page=reg_requests.next_num)}
+            'href': url_for('.get_requests', after=reg_requests.next_cursor,
+                            **filters)}
     if reg_requests.has_prev:
         navi['prev'] = {
-            'href': url_for('.get_requests', page=reg_requests.prev_num)}
+            'href': url_for('.get_requests', before=reg_requests.prev_cursor,
+                            **filters)}
 
     return navi
 
@@ -43,49 +157,44 @@ def get_hal_links(reg_requests, page):
 @registration.route('/request/', methods=['GET'])
 @login_required
 def get_requests():
-    """Get a requests list."""
-    page = int(request.args.get('page', '1'))
-    reg_requests = RegistrationRequest.query.order_by(
-        RegistrationRequest.timestamp.desc()).paginate(page,
-                                                       current_app.config[
-                                                           'REQUESTS_PER_PAGE'],
-                                                       False)
+    """Get a requests list.
+
+    The list is paged with the cursors after and before, as in the
+    next and prev links, and can be filtered by status, state and
+    src_prefix.
+    """
+    filters = dict((k, request.args[k]) for k in FILTER_ARGS
+                   if request.args.get(k))
+    try:
+        after = before = None
+        if 'after' in request.args:
+            after = decode_cursor(request.args['after'])
+        if 'before' in request.args:
+            before = decode_cursor(request.args['before'])
+    except ValueError:
+        return abort(400)
+
+    query = filter_requests(RegistrationRequest.query, filters)
+    reg_requests = get_request_page(query,
+                                    current_app.config['REQUESTS_PER_PAGE'],
+                                    after, before)
+    links = get_hal_links(reg_requests, filters)
 
     if request_wants(ContentTypes.json):
         return flask.jsonify(
             {"requests": RegistrationRequestSerializer(reg_requests.items,
                                                        many=True).data,
-             "_links": get_hal_links(reg_requests, page)})
+             "_links": links})
 
     src = request.args.get('src', '')
     return flask.render_template(
         'requests.html',
         scratch=current_app.config.get('SCRATCH_SPACE', None),
         requests=reg_requests,
+        links=links,
         src=src)
 
 
-def extract_urls(url):
-    """Extract data and metadata urls from cdmi url
-
-    The source URL should have no query string attached,
-    so we can also get it over plain HTTP and not in the
-    CDMI json format.
-
-    @param url:
-    @return:
-    """
-    return url, url + '?metadata'
-
-
-@registration.before_app_first_request
-def initialize():
-    current_app.logger.debug('Setting worker config')
-    set_config(current_app.config)
-    current_app.logger.debug('Starting workers')
-    start_workers(5)
-
-
 @registration.route('/request/', methods=['POST'])
 @login_required
 def post_request():
@@ -99,6 +208,12 @@ def post_request():
   The URL includes a request ID.
   """
     current_app.logger.debug('Entering post_request()')
+    try:
+        check_credentials_key()
+    except InvalidCredentialsException as e:
+        current_app.logger.error('Cannot queue registration requests: %s'
+                                 % e.msg)
+        abort(503)
 
     if flask.request.headers.get('Content-Type') == 'application/json':
         req_body = json.loads(flask.request.data)
@@ -175,42 +290,55 @@ def get_pids_by_prefix(pid_prefix):
 @registration.route('/registered/<pid_prefix>/<pid_suffix>', methods=['GET'])
 @login_required
 def get_pid_by_handle(pid_prefix, pid_suffix):
-    """Retrieves a data object by PID."""
+    """Retrieves a data object by PID.
 
-    handle_client = EpicClient(base_uri=current_app.config['HANDLE_URI'],
-                               credentials=None)
-    handle_record = handle_client.retrieve_handle(prefix=pid_prefix,
-                                                  suffix=pid_suffix)
-    if handle_record is None:
+    Redirects to the local copy if there is one, otherwise to a
+    replica chosen by replicas.replica_selector. Resolved handles are
+    cached, see pidcache.resolve_handle.
+    """
+    def get_client():
+        return EpicClient(base_uri=current_app.config['HANDLE_URI'],
+                          credentials=None)
+
+    try:
+        resolved = resolve_handle(get_client, pid_prefix, pid_suffix,
+                                  select_local_location, current_app.config)
+    except (requests.RequestException, ValueError) as e:
+        current_app.logger.warning('Resolving %s/%s failed: %s'
+                                   % (pid_prefix, pid_suffix, e))
         abort(404)
 
-    location = select_location(handle_record.get_all_locations())
-    if location:
-        return redirect(location)
+    if resolved.record is None:
+        abort(404)
+
+    if resolved.location:
+        return redirect(resolved.location)
+
+    auth_info = getattr(request, 'auth_info', None)
+    replica = replica_selector.choose(
+        resolved.replicas, getattr(auth_info, 'client_address', None))
+    if replica is not None:
+        return redirect(replica.href)
 
-    #remote location use-case: comes later
     return 'Requested content is currently not available\n', \
            204, {}
 
 
-def select_location(location_list):
-    """Selects optimal location from a given list
-
-    This is just a place-holder for a more sophisticated functionality.
-    Currently it only returns location if they are local.
+def select_local_location(location_list):
+    """Selects the local copy from a given list
 
-    More sophisticated solutions e.g. redirection to remote based on client
-    ip, could be implemented in the future.
+    Copies on other sites are chosen per client, see
+    replicas.ReplicaSelector.
 
     @param location_list: list of the possible locations
     @return: URL for redirection, or False if nothing found
     """
     for l in location_list:
+        if not l or urlparse(l).scheme != 'irods':
+            continue
         loc = is_local(l, current_app.config['RODSHOST'],
                        current_app.config['RODSPORT'],
                        current_app.config['RODSZONE'])
-        if loc and loc.startswith('http'):
-            return loc 
         if loc:
             return url_for('http_storage_read.get_obj', objpath=loc)
 
@@ -230,5 +358,6 @@ def extract_urls(url):
 def initialize():
     current_app.logger.debug('Setting worker config')
     set_config(current_app.config)
+    configure_selector_from(current_app.config)
     current_app.logger.debug('Starting workers')
-    start_workers(5)
+    start_workers(current_app.config.get('REGISTRATION_WORKERS', 5))
@@ -1,16 +1,55 @@
 from flask_sqlalchemy import SQLAlchemy
 from marshmallow import Serializer
+from sqlalchemy import event
 
 db = SQLAlchemy()
 
 
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    # readers do not block the writer and the other way round
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # a WAL database stays consistent with this, only the last
+    # transactions can be lost on power failure
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def configure_engine(app):
+    """Switch SQLite databases to write-ahead logging."""
+    engine = db.get_engine(app)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _set_sqlite_pragmas)
+
+
 class RegistrationRequest(db.Model):
+    # the request list is ordered by (timestamp, id), see
+    # registration.init.get_request_page
+    __table_args__ = (
+        db.Index('ix_registration_request_timestamp_id', 'timestamp', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    src_url = db.Column(db.String(2000), nullable=False)
-    status_description = db.Column(db.String(2000))
+    src_url = db.Column(db.String(2000), nullable=False, index=True)
+    status_description = db.Column(db.String(2000), index=True)
     timestamp = db.Column(db.DateTime)
-    checksum = db.Column(db.String(32))
-    pid = db.Column(db.String(2000))
+    # '<algorithm>:<hex digest>', see eudat_http_api.checksum
+    checksum = db.Column(db.String(80))
+    pid = db.Column(db.String(2000), index=True)
+
+    # job queue, see registration_worker
+    state = db.Column(db.String(16), index=True)
+    # index of the next workflow step and how often it failed
+    step = db.Column(db.Integer, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True)
+    # the worker that runs the request, until the lease expires
+    lease_owner = db.Column(db.String(128))
+    lease_expires = db.Column(db.DateTime)
+    # json of the values the workflow steps hand on to each other
+    context = db.Column(db.Text)
+    # encrypted, see credentials.py. Removed when the request ends.
+    credentials = db.Column(db.Text)
 
     @property
     def serialize(self):
@@ -27,4 +66,4 @@ class RegistrationRequest(db.Model):
 class RegistrationRequestSerializer(Serializer):
     class Meta:
         fields = ('id', 'src_url', 'status_description', 'timestamp',
-                  'checksum', 'pid')
+                  'checksum', 'pid', 'state')
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+import requests
+from urlparse import urlparse
+
+from eudat_http_api.cache import Cache
+from eudat_http_api.epicclient import HandleRecord
+
+
+class ResolvedHandle(object):
+    """A handle record and where its data can be downloaded.
+
+    record is None if the handle does not exist. location is the
+    local copy or False, replicas the epicclient.Locations of the
+    copies on other sites that clients can be redirected to.
+    """
+    def __init__(self, record, location, replicas):
+        self.record = record
+        self.location = location
+        self.replicas = replicas
+
+
+# resolved handles by (prefix, suffix), see resolve_handle
+pid_cache = Cache(max_size=10000)
+
+
+def resolve_handle(client, prefix, suffix, select_local, config):
+    """Return the ResolvedHandle of a PID, from the cache if possible.
+
+    Records are cached as long as the ttl of their values allows,
+    but at most PID_CACHE_TTL seconds. Handles that do not exist are
+    cached for PID_CACHE_NEGATIVE_TTL seconds. Other errors of the
+    PID service are not cached and raise requests.RequestException.
+    Concurrent lookups of the same handle are sent to the PID
+    service only once.
+
+    client is called to get the EpicClient only on a cache miss.
+    select_local(locations) returns the location of the local copy,
+    or False.
+    """
+    def compute():
+        response = client().retrieve_handle_response(prefix, suffix)
+        if response.status_code == requests.codes.not_found:
+            return (ResolvedHandle(None, False, []),
+                    config.get('PID_CACHE_NEGATIVE_TTL', 30))
+        if response.status_code != requests.codes.ok:
+            raise requests.HTTPError('PID service answered %d'
+                                     % response.status_code,
+                                     response=response)
+
+        record = HandleRecord.from_json(response.json())
+        ttl = config.get('PID_CACHE_TTL', 300)
+        if record.ttl is not None:
+            ttl = min(ttl, record.ttl)
+        location = select_local(record.get_all_locations())
+        replicas = [l for l in record.get_weighted_locations()
+                    if urlparse(l.href).scheme in ('http', 'https')]
+        return ResolvedHandle(record, location, replicas), ttl
+
+    return pid_cache.get_or_compute((prefix, suffix), compute)
@@ -1,61 +1,119 @@
-from Queue import Queue
-
+import atexit
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import socket
 import threading
 import uuid
 import requests
 from requests.auth import HTTPBasicAuth
+from sqlalchemy import and_, or_
 from urlparse import urljoin, urlparse, urlunparse
 
-from eudat_http_api.cdmiclient import CDMIClient
+from eudat_http_api.cdmiclient import CDMIClient, ResponseBodyStream
+from eudat_http_api.checksum import METADATA_KEY as CHECKSUM_KEY
+from eudat_http_api.registration.credentials import decrypt_credentials, \
+    encrypt_credentials, get_fernet, InvalidCredentialsException
 from eudat_http_api.registration.models import db, RegistrationRequest
+from eudat_http_api.registration.status_writer import StatusWriter
 from eudat_http_api.epicclient import EpicClient, HandleRecord, \
     extract_prefix_suffix
+from eudat_http_api.httpsession import get_session
+
+# the workers run without an app context, their messages reach the
+# handlers of the app logger through this child logger
+logger = logging.getLogger(__name__)
 
 
-def get_checksum(destination):
-    url_str = urlunparse(destination)
-    return 667
+def get_checksum(upload_response):
+    """Return the checksum of a copied object, or None.
+
+    The storage computes the checksum while it writes the data and
+    returns it in the user metadata of the CDMI response, so the
+    object does not have to be read again.
+    """
+    try:
+        user_meta = upload_response.json().get('metadata', None) or {}
+    except ValueError:
+        return None
+    return user_meta.get(CHECKSUM_KEY, None)
 
 
 config = dict()
+epic_client = None
+epic_client_lock = threading.Lock()
+status_writer = None
+status_writer_lock = threading.Lock()
 
 
 def set_config(new_config):
-    global config
+    global config, epic_client
     for k in new_config:
         config[k] = new_config[k]
+    epic_client = None
 
 
 def get_epic_client():
-    return EpicClient(base_uri=config['EPIC_URI'], credentials=HTTPBasicAuth(
-        config['EPIC_USER'], config['EPIC_PASS']), debug=False)
+    """Return the EPIC client that all workers share."""
+    global epic_client
+    with epic_client_lock:
+        if epic_client is None:
+            epic_client = EpicClient(
+                base_uri=config['EPIC_URI'],
+                credentials=HTTPBasicAuth(config['EPIC_USER'],
+                                          config['EPIC_PASS']),
+                debug=False)
+        return epic_client
+
+
+def get_status_writer():
+    """Return the status writer of this process, start it if needed."""
+    global status_writer
+    with status_writer_lock:
+        if status_writer is None:
+            status_writer = StatusWriter(
+                config.get('REGISTRATION_STATUS_INTERVAL', 0.5))
+            status_writer.start()
+            atexit.register(flush_status_writer)
+        return status_writer
+
+
+def flush_status_writer():
+    """Write the queued status changes of this process, if there are any.
+
+    Called at exit, and by servers that end their processes with
+    os._exit.
+    """
+    if status_writer is not None:
+        status_writer.flush()
 
 
 def stream_download(client, src_url, dst_url, chunk_size=4194304):
     """GET a file over HTTP and PUT it somewhere else.
 
-    This method has two drawbacks:
-    1. To make it a bit simpler (before we solve the CDMI streaming),
-       get and put with plain HTTP.
-       This is tolerable as all CDMI interfaces should support the plain
-       access and we can add metadata somewhere else.
-    2. The streaming does not work. Currently we have to read in the file as
-       a whole before giving it to PUT. This is an issue with our HTTP
-       interface that WSGI does not support the chunked encoding:
-       https://code.google.com/p/modwsgi/issues/detail?id=1
-       and this function should work with our HTTP interface :)
-       Without chunked, the file-like object that we can give to PUT must
-       support seek() to get the Content-Length, which won't work with the
-       generator input (or file-like .raw) we get from requests.get without
-       reading the whole input anyway.
-       This is how the code would look like:
-    put_response = client.put(dst_url, get_response.raw,
-                              headers={'transfer-encoding': 'chunked'})
+    To make it a bit simpler (before we solve the CDMI streaming),
+    get and put with plain HTTP.
+    This is tolerable as all CDMI interfaces should support the plain
+    access and we can add metadata somewhere else.
 
+    The body of the GET is handed to the PUT in chunks of chunk_size,
+    so the file is never read into memory as a whole. The PUT has
+    the Content-Length of the GET if there is one, and is chunked
+    otherwise. Our own HTTP interface accepts chunked uploads if the
+    WSGI server decodes them, see noncdmi.put_file_obj.
     """
 
     get_response = client.get(src_url, stream=True)
-    put_response = client.put(dst_url, get_response.content)
+    if get_response.status_code != requests.codes.ok:
+        return False
+
+    try:
+        put_response = client.put(dst_url,
+                                  ResponseBodyStream(get_response,
+                                                     chunk_size))
+    finally:
+        get_response.close()
 
     if put_response.status_code != requests.codes.created:
         return False
@@ -64,7 +122,7 @@ def stream_download(client, src_url, dst_url, chunk_size=4194304):
 
 
 def check_url(url, auth):
-    response = requests.head(url, auth=auth, allow_redirects=True)
+    response = get_session().head(url, auth=auth, allow_redirects=True)
     if response.status_code != requests.codes.ok:
         return False
 
@@ -148,9 +206,6 @@ def copy_data_object(context):
     username, password = extract_credentials(context.auth)
 
     context.destination = destination
-    # this is probably not the right place. the storage backend should
-    # create a checksum if required. let's check if that is possible.
-    context.checksum = get_checksum(destination)
 
     client = CDMIClient((username, password))
 
@@ -160,6 +215,7 @@ def copy_data_object(context):
         update_request(context, 'Unable to move the data to register space')
         return False
 
+    context.checksum = get_checksum(upload_response)
     return True
 
 
@@ -203,51 +259,361 @@ def start_replication(context):
     return True
 
 
-#execution-related stuff: workers, task queue & workflow definition
+#execution-related stuff: job queue, workers & workflow definition
 
 
 def update_request(context, status):
-    r = RegistrationRequest.query.get(context.request_id)
-    r.status_description = status
-    print 'Request %d advanced to %s' % (r.id, status)
-    #we could also add other properties from context to request (dst?)
-    if hasattr(context, 'pid'):
-        r.pid = context.pid
+    """Set the status of the request of context.
 
-    db.session.add(r)
-    db.session.commit()
+    The change is written by the status writer, the worker does not
+    wait for the database.
+    """
+    logger.debug('Request %d advanced to %s', context.request_id, status)
+    get_status_writer().update(context.request_id,
+                               _get_status_values(context, status))
     context.status = status
 
 
+def _get_status_values(context, status):
+    #we could also add other properties from context to request (dst?)
+    values = {'status_description': status}
+    if hasattr(context, 'pid'):
+        values['pid'] = context.pid
+    if getattr(context, 'checksum', None) is not None:
+        values['checksum'] = context.checksum
+    return values
+
+
 workflow = [check_src, check_metadata, copy_data_object, get_handle,
             start_replication]
 
-q = Queue()
+# states of a request in the job queue
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# the context values that are stored after each step, so that
+# another worker can resume the request with the next step
+CONTEXT_FIELDS = ['src_url', 'md_url', 'destination', 'storage_url',
+                  'checksum', 'pid', 'replication_destination']
+
+
+class Context(object):
+    pass
+
+
+def save_context(r, context):
+    values = dict((name, getattr(context, name)) for name in CONTEXT_FIELDS
+                  if hasattr(context, name))
+    if 'destination' in values:
+        values['destination'] = urlunparse(values['destination'])
+    r.context = json.dumps(values)
+
+
+def load_context(r):
+    """Rebuild the context of a request from the database.
+
+    Raises InvalidCredentialsException if the credentials cannot be
+    decrypted, e.g. because REGISTRATION_CREDENTIALS_KEY changed.
+    """
+    context = Context()
+    context.request_id = r.id
+    values = json.loads(r.context or '{}')
+    if 'destination' in values:
+        values['destination'] = urlparse(values['destination'])
+    for name, value in values.iteritems():
+        setattr(context, name, value)
+    if r.credentials is not None:
+        context.auth = HTTPBasicAuth(
+            *decrypt_credentials(config.get('REGISTRATION_CREDENTIALS_KEY'),
+                                 r.credentials))
+    return context
+
+
+def check_credentials_key():
+    """Raise InvalidCredentialsException if requests cannot be queued.
+
+    The credentials of queued requests are encrypted with
+    REGISTRATION_CREDENTIALS_KEY, a Fernet key used for nothing
+    else. Without one, no requests are queued.
+    """
+    key = config.get('REGISTRATION_CREDENTIALS_KEY')
+    if key and key == config.get('SECRET_KEY'):
+        raise InvalidCredentialsException(
+            'REGISTRATION_CREDENTIALS_KEY must not be the SECRET_KEY')
+    get_fernet(key)
+
+
+# set when a request is queued, to wake up the workers of this process
+new_job = threading.Event()
 
 
 def add_task(context):
-    q.put(context)
+    """Queue a registration request.
 
+    The context and the encrypted credentials are stored with the
+    request, so that the workers of any process can run it, also
+    after a restart.
 
-def executor():
-    while True:
-        context = q.get()
-        success = False
-        for step in workflow:
-            print('Request id = %s advanced to = %s' %
-                  (context.request_id, step.__name__))
-            success = step(context)
+    Raises InvalidCredentialsException if there is no usable
+    REGISTRATION_CREDENTIALS_KEY, see check_credentials_key.
+    """
+    check_credentials_key()
+    r = RegistrationRequest.query.get(context.request_id)
+    save_context(r, context)
+    r.credentials = encrypt_credentials(
+        config['REGISTRATION_CREDENTIALS_KEY'],
+        *extract_credentials(context.auth))
+    r.state = QUEUED
+    r.step = 0
+    r.attempts = 0
+    r.next_attempt = datetime.utcnow()
+    db.session.add(r)
+    db.session.commit()
+    new_job.set()
+
+
+def _get_lease_time():
+    return timedelta(seconds=config.get('REGISTRATION_LEASE_TIME', 300))
+
+
+def _claimable(now):
+    """Queued requests that are due and requests whose lease expired.
+
+    A lease expires if its worker died or lost the connection to
+    the database, the request is then resumed by another worker.
+    """
+    return or_(and_(RegistrationRequest.state == QUEUED,
+                    RegistrationRequest.next_attempt <= now),
+               and_(RegistrationRequest.state == RUNNING,
+                    RegistrationRequest.lease_expires < now))
+
+
+def claim_job(worker_id):
+    """Lease the next due request to worker_id.
+
+    Returns the id of the request, or None if there is none.
+    The lease is taken with a conditional UPDATE, so only one of
+    several workers that try at the same time succeeds.
+    """
+    now = datetime.utcnow()
+    candidates = db.session.query(RegistrationRequest.id).filter(
+        _claimable(now)).order_by(RegistrationRequest.next_attempt).limit(10)
+    for request_id, in candidates.all():
+        claimed = RegistrationRequest.query.filter(
+            RegistrationRequest.id == request_id,
+            _claimable(now)).update({
+                'state': RUNNING,
+                'lease_owner': worker_id,
+                'lease_expires': now + _get_lease_time(),
+            }, synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            return request_id
+    return None
+
+
+def _update_job(worker_id, request_id, values):
+    """Update a request if worker_id still holds its lease.
+
+    Returns False if the lease was lost.
+    """
+    updated = RegistrationRequest.query.filter(
+        RegistrationRequest.id == request_id,
+        RegistrationRequest.state == RUNNING,
+        RegistrationRequest.lease_owner == worker_id).update(
+            values, synchronize_session=False)
+    db.session.commit()
+    return updated == 1
+
+
+def renew_lease(worker_id, request_id):
+    return _update_job(worker_id, request_id, {
+        'lease_expires': datetime.utcnow() + _get_lease_time()})
+
+
+def _end_job(worker_id, request_id, state, values=None):
+    """Move a request to the final state, with values of its columns.
+
+    A request in a final state is never run again, so its final
+    status, pid and checksum are written here, in the same UPDATE.
+    Were they left to the status writer, a process that exits before
+    its next batch would leave the request done without its pid.
+    Status changes queued before are written first, so that they
+    cannot overwrite the final ones.
+    """
+    if status_writer is not None:
+        status_writer.flush()
+    end_values = dict(values or {})
+    end_values.update({
+        'state': state,
+        'lease_owner': None,
+        'lease_expires': None,
+        'credentials': None,
+    })
+    return _update_job(worker_id, request_id, end_values)
+
+
+def _end_request(worker_id, context, state, status):
+    logger.debug('Request %d ended with %s', context.request_id, status)
+    context.status = status
+    return _end_job(worker_id, context.request_id, state,
+                    _get_status_values(context, status))
+
+
+def purge_credentials():
+    """Remove the credentials of requests that have ended.
+
+    _end_job removes them when a request ends. This catches requests
+    that ended before that, or whose worker lost the lease just then.
+    """
+    RegistrationRequest.query.filter(
+        RegistrationRequest.state.in_([DONE, FAILED]),
+        RegistrationRequest.credentials != None).update(  # noqa
+            {'credentials': None}, synchronize_session=False)
+    db.session.commit()
+
+
+class LeaseKeeper(threading.Thread):
+    """Renew the lease of a request while a worker runs it.
+
+    Steps like the copy can take longer than the lease. lost is set
+    if the lease could not be renewed.
+    """
+    def __init__(self, worker_id, request_id):
+        super(LeaseKeeper, self).__init__()
+        self.daemon = True
+        self.worker_id = worker_id
+        self.request_id = request_id
+        self.interval = _get_lease_time().total_seconds() / 3
+        self.stopped = threading.Event()
+        self.lost = False
+
+    def run(self):
+        try:
+            while not self.stopped.wait(self.interval):
+                if not renew_lease(self.worker_id, self.request_id):
+                    self.lost = True
+                    return
+        finally:
+            db.session.remove()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def _retry_or_fail(worker_id, context, r, step):
+    """Schedule the failed step again, or fail the request.
+
+    A step is tried REGISTRATION_MAX_ATTEMPTS times, waiting
+    REGISTRATION_RETRY_BACKOFF seconds before the first retry and
+    twice as long before each further one.
+    """
+    attempts = (r.attempts or 0) + 1
+    if attempts >= config.get('REGISTRATION_MAX_ATTEMPTS', 3):
+        _end_request(worker_id, context, FAILED,
+                     'Failed during %s' % step.__name__)
+        return
+
+    delay = config.get('REGISTRATION_RETRY_BACKOFF', 30) * 2 ** (attempts - 1)
+    update_request(context, 'Failed during %s, retrying in %d seconds'
+                   % (step.__name__, delay))
+    _update_job(worker_id, r.id, {
+        'state': QUEUED,
+        'attempts': attempts,
+        'next_attempt': datetime.utcnow() + timedelta(seconds=delay),
+        'lease_owner': None,
+        'lease_expires': None,
+    })
+
+
+def run_job(worker_id, request_id):
+    """Run the workflow of a request leased to worker_id.
+
+    Starts with the first step that has not completed yet. After
+    each step, the context is stored so that the request can be
+    resumed from there.
+    """
+    r = RegistrationRequest.query.get(request_id)
+    try:
+        context = load_context(r)
+    except InvalidCredentialsException as e:
+        _end_job(worker_id, request_id, FAILED,
+                 {'status_description': 'Failed: %s' % e.msg})
+        return
+
+    keeper = LeaseKeeper(worker_id, request_id)
+    keeper.start()
+    try:
+        while r.step < len(workflow):
+            step = workflow[r.step]
+            logger.debug('Request %d runs %s', request_id, step.__name__)
+            try:
+                success = step(context)
+            except Exception:
+                logger.error('Request %d failed in %s', request_id,
+                             step.__name__, exc_info=True)
+                success = False
+
+            if keeper.lost:
+                logger.warning('Request %d: lost the lease', request_id)
+                return
             if not success:
-                update_request(context, 'Failed during %s' % step.__name__)
-                break
+                _retry_or_fail(worker_id, context, r, step)
+                return
 
-        if success:
-            update_request(context, 'Request finished pid = %s ' % context.pid)
-        q.task_done()
+            save_context(r, context)
+            if not _update_job(worker_id, request_id, {
+                    'step': r.step + 1,
+                    'attempts': 0,
+                    'context': r.context}):
+                return
+            db.session.refresh(r)
 
+        _end_request(worker_id, context, DONE,
+                     'Request finished pid = %s ' % context.pid)
+    finally:
+        keeper.stop()
+
+
+def worker(worker_id):
+    """Claim and run requests until the process ends."""
+    while True:
+        request_id = None
+        try:
+            request_id = claim_job(worker_id)
+            if request_id is not None:
+                run_job(worker_id, request_id)
+        except Exception:
+            logger.error('Worker %s failed on request %s', worker_id,
+                         request_id, exc_info=True)
+        finally:
+            db.session.remove()
+
+        if request_id is None:
+            new_job.wait(config.get('REGISTRATION_POLL_INTERVAL', 2))
+            new_job.clear()
+
+
+def start_workers(num_worker_thread=None, daemon=True):
+    """Start the worker threads of this process.
+
+    The number defaults to REGISTRATION_WORKERS. The workers of all
+    processes share the queue in the database.
+    """
+    if num_worker_thread is None:
+        num_worker_thread = config.get('REGISTRATION_WORKERS', 5)
+    if num_worker_thread > 0:
+        purge_credentials()
 
-def start_workers(num_worker_thread):
+    threads = []
     for i in range(num_worker_thread):
-        t = threading.Thread(target=executor)
-        t.daemon = True
+        worker_id = '%s:%d:%d:%s' % (socket.gethostname(), os.getpid(), i,
+                                     uuid.uuid4().hex[:8])
+        t = threading.Thread(target=worker, args=(worker_id,))
+        t.daemon = daemon
         t.start()
+        threads.append(t)
+    return threads
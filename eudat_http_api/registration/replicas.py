@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import with_statement
+
+from Queue import Full, Queue
+import random
+import socket
+from threading import Lock, Thread
+import time
+from urlparse import urlparse
+
+from eudat_http_api.cache import Cache
+from eudat_http_api.httpsession import get_session
+
+
+# latency in seconds assumed for sites that were not probed yet
+DEFAULT_LATENCY = 0.5
+# how much a measured latency counts in its running average
+LATENCY_SMOOTHING = 0.3
+# a replica in the same network as the client gets up to this many
+# times the score of a replica without common address prefix
+PROXIMITY_FACTOR = 3
+
+
+def ip_proximity(a, b):
+    """Return the common prefix of two IP addresses, between 0 and 1.
+
+    1 means the same address, 0 no common prefix or addresses of
+    different families or invalid addresses.
+    """
+    for family in [socket.AF_INET, socket.AF_INET6]:
+        try:
+            packed_a = socket.inet_pton(family, a)
+            packed_b = socket.inet_pton(family, b)
+        except (socket.error, TypeError, ValueError):
+            continue
+        bits = 0
+        for byte_a, byte_b in zip(packed_a, packed_b):
+            diff = ord(byte_a) ^ ord(byte_b)
+            if diff:
+                bits += 8 - diff.bit_length()
+                break
+            bits += 8
+        return float(bits) / (8 * len(packed_a))
+    return 0.0
+
+
+class SiteStats(object):
+    """What is known about a replica site (scheme://host:port)."""
+    def __init__(self):
+        self.address = None
+        self.latency = None
+        self.down_until = 0
+        self.probed_at = 0
+
+
+class ReplicaSelector(object):
+    """Choose the replica a client is redirected to.
+
+    A replica is chosen at random, each with a probability
+    proportional to its score:
+
+        weight * (1 + PROXIMITY_FACTOR * proximity) / (1 + latency)
+
+    weight is the 10320/LOC weight, replicas with weight 0 are not
+    used. proximity is the common prefix of the client address and
+    the address of the replica host, latency the running average of
+    the HEAD requests the selector sends to every site at most every
+    probe_interval seconds. Sites whose probe failed are skipped for
+    failure_cooldown seconds, unless all are down.
+
+    Probes are sent by probe_threads background threads, the first
+    choice for a new site uses the weight alone. At most
+    probe_queue_size probes wait for them, sites that do not fit are
+    probed with a later choice. probe_interval 0 disables probing.
+
+    What is known about a site is kept for site_ttl seconds, for at
+    most max_sites sites.
+    """
+    def __init__(self, probe_interval=300, failure_cooldown=60,
+                 max_sites=1000, site_ttl=3600, probe_threads=2,
+                 probe_queue_size=100):
+        self.probe_interval = probe_interval
+        self.failure_cooldown = failure_cooldown
+        self.site_ttl = site_ttl
+        self.sites = Cache(max_size=max_sites, ttl=site_ttl)
+        self.lock = Lock()
+        self.probe_threads = probe_threads
+        self.probes = Queue(maxsize=probe_queue_size)
+        self.probe_workers = []
+
+    def _get_stats(self, site):
+        return self.sites.get_or_compute(
+            site, lambda: (SiteStats(), self.site_ttl))
+
+    def record_latency(self, site, latency, address=None):
+        stats = self._get_stats(site)
+        with self.lock:
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += LATENCY_SMOOTHING * (latency -
+                                                      stats.latency)
+            if address is not None:
+                stats.address = address
+            stats.down_until = 0
+
+    def record_failure(self, site):
+        stats = self._get_stats(site)
+        with self.lock:
+            stats.down_until = time.time() + self.failure_cooldown
+
+    def score(self, location, client_address):
+        stats = self._get_stats(get_site(location.href))
+        latency = stats.latency
+        if latency is None:
+            latency = DEFAULT_LATENCY
+        proximity = 0.0
+        if client_address and stats.address:
+            proximity = ip_proximity(client_address, stats.address)
+        return (location.weight * (1 + PROXIMITY_FACTOR * proximity) /
+                (1 + latency))
+
+    def is_up(self, location):
+        stats = self._get_stats(get_site(location.href))
+        return stats.down_until <= time.time()
+
+    def choose(self, locations, client_address=None):
+        """Return one of locations for a client, or None.
+
+        locations is a list of epicclient.Location.
+        """
+        locations = [l for l in locations if l.weight > 0]
+        for l in locations:
+            self._probe_if_stale(l.href)
+
+        candidates = [l for l in locations if self.is_up(l)] or locations
+        scores = [self.score(l, client_address) for l in candidates]
+        total = sum(scores)
+        if total <= 0:
+            return None
+
+        point = random.random() * total
+        for location, score in zip(candidates, scores):
+            point -= score
+            if point < 0:
+                return location
+        return candidates[-1]
+
+    def _probe_if_stale(self, url):
+        if self.probe_interval <= 0:
+            return
+        stats = self._get_stats(get_site(url))
+        now = time.time()
+        with self.lock:
+            if stats.probed_at + self.probe_interval > now:
+                return
+            # also keeps other requests from starting the same probe
+            stats.probed_at = now
+
+        self._start_probe_workers()
+        try:
+            self.probes.put_nowait(url)
+        except Full:
+            with self.lock:
+                stats.probed_at = 0
+
+    def _start_probe_workers(self):
+        with self.lock:
+            while len(self.probe_workers) < self.probe_threads:
+                t = Thread(target=self._run_probes)
+                t.daemon = True
+                t.start()
+                self.probe_workers.append(t)
+
+    def _run_probes(self):
+        while True:
+            self.probe(self.probes.get())
+
+    def probe(self, url):
+        """Measure the latency of a HEAD request to url."""
+        site = get_site(url)
+        parsed = urlparse(url)
+        try:
+            address = socket.getaddrinfo(parsed.hostname, None)[0][4][0]
+            start = time.time()
+            response = get_session().head(url, allow_redirects=False)
+            latency = time.time() - start
+            response.close()
+        except Exception:
+            self.record_failure(site)
+            return
+
+        # any answer but a server error means the site is up
+        if response.status_code >= 500:
+            self.record_failure(site)
+        else:
+            self.record_latency(site, latency, address)
+
+
+def get_site(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc)
+
+
+replica_selector = ReplicaSelector()
+
+
+def configure_selector_from(config):
+    """Configure the shared selector from the REPLICA_* settings."""
+    replica_selector.probe_interval = config.get('REPLICA_PROBE_INTERVAL',
+                                                 300)
+    replica_selector.failure_cooldown = \
+        config.get('REPLICA_FAILURE_COOLDOWN', 60)
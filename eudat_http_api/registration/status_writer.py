@@ -0,0 +1,86 @@
+import logging
+import threading
+
+from sqlalchemy.exc import OperationalError
+
+from eudat_http_api.registration.models import db, RegistrationRequest
+
+logger = logging.getLogger(__name__)
+
+
+class StatusWriter(threading.Thread):
+    """Write status changes of requests in batches.
+
+    Workers hand their changes to update() and go on without waiting
+    for the database. Changes of the same request are merged, only
+    the latest value of a column is written. Every interval seconds,
+    all pending changes are written in one transaction. If the
+    database is locked, they are kept and written with the next
+    batch.
+    """
+    def __init__(self, interval=0.5):
+        super(StatusWriter, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        # a batch was taken from _pending and is being written
+        self._writing = False
+
+    def update(self, request_id, values):
+        """Queue new column values of a request."""
+        with self._lock:
+            self._pending.setdefault(request_id, dict()).update(values)
+
+    def flush(self):
+        """Wait until all queued changes are written."""
+        with self._lock:
+            while self._pending or self._writing:
+                self._wakeup.set()
+                self._written.wait()
+
+    def _take(self):
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            self._writing = bool(pending)
+            return pending
+
+    def _put_back(self, pending):
+        """Merge unwritten changes with the ones queued meanwhile."""
+        with self._lock:
+            for request_id, values in pending.iteritems():
+                values.update(self._pending.get(request_id, dict()))
+                self._pending[request_id] = values
+
+    def write(self, pending):
+        for request_id, values in pending.iteritems():
+            RegistrationRequest.query.filter(
+                RegistrationRequest.id == request_id).update(
+                    values, synchronize_session=False)
+        db.session.commit()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            pending = self._take()
+            if not pending:
+                continue
+            try:
+                self.write(pending)
+            except OperationalError:
+                # e.g. database is locked, try again with the next batch
+                db.session.rollback()
+                self._put_back(pending)
+            except Exception:
+                logger.error('Writing the status of requests failed',
+                             exc_info=True)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            with self._lock:
+                self._writing = False
+                self._written.notify_all()
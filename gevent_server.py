@@ -1,17 +1,256 @@
-from gevent.pywsgi import WSGIServer
-from eudat_http_api import create_app
+#!/usr/bin/env python
+"""Production server: a master process and preforked gevent workers.
 
-app = create_app('config')
+The master opens the listening socket and forks SERVER_WORKERS
+worker processes (one per core by default) that accept from it.
+Each worker creates its own app after the fork, so storage and HTTP
+connection pools, the registration workers and the storage thread
+pool are never shared between processes.
 
-ssl_args = {}
+Signals to the master:
+    HUP         graceful reload: the config is read again and new
+                workers are started, the old ones finish the
+                requests they are serving and exit
+    TERM, INT   graceful stop
+
+The app is never imported in the master, so new workers also run
+new code after a reload. SERVER_HOST, SERVER_PORT and SERVER_BACKLOG
+are only read at startup.
+"""
+import errno
+import multiprocessing
+from optparse import OptionParser
+import os
+import signal
+import socket
+import sys
+import time
+
+from flask import Config
+
+
+def load_config(config_name, reload_module=False):
+    """Read the config like create_app does, without creating an app."""
+    if reload_module:
+        parts = config_name.split('.')
+        for i in range(len(parts), 0, -1):
+            module = sys.modules.get('.'.join(parts[:i]))
+            if module is not None:
+                reload(module)
+                break
+
+    config = Config(os.path.dirname(os.path.abspath(__file__)))
+    config.from_object(config_name)
+    return config
+
+
+def get_ssl_args(config):
+    """Return the SSL arguments of WSGIServer, empty without SSL_KEY."""
+    if (config.get('SSL_KEY', None) is None or
+            config.get('SSL_CERT', None) is None):
+        return {}
 
-if (ssl_args['ssl_keyfile'] is not None and
-        ssl_args['ssl_certfile'] is not None):
     ssl_args = {
-        'ssl_keyfile': app.config.get('SSL_KEY', None),
-        'ssl_certfile': app.config.get('SSL_CERT', None),
-        'ca_certs': app.config.get('SSL_CACERTS', None),
+        'keyfile': config['SSL_KEY'],
+        'certfile': config['SSL_CERT'],
     }
+    if config.get('SSL_CACERTS', None) is not None:
+        ssl_args['ca_certs'] = config['SSL_CACERTS']
+    return ssl_args
+
+
+def get_address(config, port=None):
+    """Return the host and port to listen on, port overrides the config.
+
+    HOST and PORT are those of the development server in run.py.
+    """
+    return (config.get('SERVER_HOST', '0.0.0.0'),
+            port or config.get('SERVER_PORT', 5000))
+
+
+def create_listener(host, port, backlog):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def run_worker(listener, config_name):
+    """Serve requests from listener until SIGTERM. Runs in the child."""
+    # the master stops the workers, Ctrl-C in a terminal reaches all
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    import gevent
+    from gevent.pywsgi import WSGIHandler, WSGIServer
+    import gevent.socket
+
+    from eudat_http_api import create_app
+    from eudat_http_api.http_storage.executor import configure_executor_from
+    from eudat_http_api.registration.registration_worker import \
+        flush_status_writer
+
+    gevent.reinit()
+    app = create_app(config_name)
+    configure_executor_from(app.config)
+    keepalive = app.config.get('SERVER_KEEPALIVE', 60)
+
+    class KeepAliveHandler(WSGIHandler):
+        """Close idle keep-alive connections after keepalive seconds.
+
+        The timeout only applies while waiting for the next request.
+        With keepalive 0, every connection is closed after one
+        request.
+        """
+        def set_read_timeout(self, timeout):
+            # newer gevent versions read from a copy of the socket
+            getattr(self.rfile, '_sock', self.socket).settimeout(timeout)
+
+        def handle_one_request(self):
+            if keepalive > 0:
+                self.set_read_timeout(keepalive)
+            return WSGIHandler.handle_one_request(self)
+
+        def read_request(self, raw_requestline):
+            self.set_read_timeout(None)
+            result = WSGIHandler.read_request(self, raw_requestline)
+            if keepalive <= 0:
+                self.close_connection = True
+            return result
+
+    server = WSGIServer(gevent.socket.socket(_sock=listener._sock), app,
+                        handler_class=KeepAliveHandler,
+                        **get_ssl_args(app.config))
+
+    def stop():
+        server.stop(timeout=app.config.get('SERVER_GRACEFUL_TIMEOUT', 30))
+
+    signal_handler = getattr(gevent, 'signal_handler', None) or \
+        gevent.signal
+    signal_handler(signal.SIGTERM, stop)
+    server.serve_forever()
+    # the child leaves with os._exit, which skips the atexit handlers
+    flush_status_writer()
+
+
+class Arbiter(object):
+    """Keep the workers running, reload and stop them on signals."""
+
+    def __init__(self, config_name, num_workers=None, port=None):
+        self.config_name = config_name
+        self.num_workers = num_workers
+        self.port = port
+        self.config = load_config(config_name)
+        self.listener = None
+        # pid -> (generation, start time)
+        self.workers = dict()
+        self.generation = 0
+        self.signals = []
+
+    def get_num_workers(self):
+        num = self.num_workers or self.config.get('SERVER_WORKERS', 0)
+        return num or multiprocessing.cpu_count()
+
+    def run(self):
+        host, port = get_address(self.config, self.port)
+        self.listener = create_listener(
+            host, port, self.config.get('SERVER_BACKLOG', 1024))
+        for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, lambda signum, frame:
+                          self.signals.append(signum))
+
+        self.spawn_workers()
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+            self.reap_workers()
+            time.sleep(0.2)
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid != 0:
+            self.workers[pid] = (self.generation, time.time())
+            return pid
+
+        status = 0
+        try:
+            run_worker(self.listener, self.config_name)
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+
+    def spawn_workers(self):
+        running = len([g for g, _ in self.workers.itervalues()
+                       if g == self.generation])
+        for _ in range(self.get_num_workers() - running):
+            self.spawn_worker()
+
+    def kill_workers(self, signum, generation=None):
+        for pid, (g, _) in self.workers.items():
+            if generation is None or g == generation:
+                try:
+                    os.kill(pid, signum)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+
+    def reap_workers(self):
+        """Forget exited workers, replace the ones of this generation."""
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if pid == 0:
+                break
+            generation, started = self.workers.pop(pid, (None, 0))
+            if generation == self.generation:
+                print >>sys.stderr, 'worker %d exited, restarting' % pid
+                if time.time() - started < 1:
+                    # do not fork in a loop if the app does not start
+                    time.sleep(1)
+                self.spawn_worker()
+
+    def reload(self):
+        self.config = load_config(self.config_name, reload_module=True)
+        self.generation += 1
+        self.spawn_workers()
+        self.kill_workers(signal.SIGTERM, self.generation - 1)
+
+    def stop(self):
+        self.generation = None
+        self.kill_workers(signal.SIGTERM)
+        deadline = (time.time() +
+                    self.config.get('SERVER_GRACEFUL_TIMEOUT', 30) + 5)
+        while self.workers and time.time() < deadline:
+            self.reap_workers()
+            time.sleep(0.1)
+        self.kill_workers(signal.SIGKILL)
+        self.listener.close()
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-c', '--config', dest='config', default='config',
+                      help='Config object, default: config')
+    parser.add_option('-w', '--workers', dest='workers', type='int',
+                      help='Number of worker processes, default: '
+                           'SERVER_WORKERS or one per core')
+    parser.add_option('-p', '--port', dest='port', type='int',
+                      help='Port to listen on, default: SERVER_PORT')
 
-http_server = WSGIServer(('', 5000), app, **ssl_args)
-http_server.serve_forever()
+    (options, args) = parser.parse_args()
+    Arbiter(options.config, options.workers, options.port).run()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+"""Run registration workers without the web frontend.
+
+Workers of several processes and hosts share the job queue in the
+database. Set REGISTRATION_WORKERS = 0 in the config of the web
+frontends to run the registrations only here.
+"""
+from optparse import OptionParser
+import signal
+import sys
+
+from eudat_http_api import create_app
+from eudat_http_api.registration.registration_worker import set_config, \
+    start_workers
+
+parser = OptionParser()
+parser.add_option('-n', '--workers', dest='workers', type='int',
+                  help='Number of worker threads', default=5)
+
+(options, args) = parser.parse_args()
+
+app = create_app('config')
+set_config(app.config)
+
+
+def terminate(signum, frame):
+    # leave through sys.exit, so that atexit flushes the status writer
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, terminate)
+threads = start_workers(options.workers, daemon=True)
+for thread in threads:
+    # join with a timeout, the main thread does not see signals otherwise
+    while thread.is_alive():
+        thread.join(1)
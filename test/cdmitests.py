@@ -216,3 +216,86 @@ class TestCDMI:
             result_list = list(result)
             for field in self.cdmi_object_mandatory_list:
                 assert field in result_list
+
+    def parse_body(self, body, buffer_size=4):
+        from StringIO import StringIO
+        from eudat_http_api.http_storage import cdmi
+
+        fields, value_gen = cdmi._parse_cdmi_msg_body_fields(
+            StringIO(body), buffer_size=buffer_size)
+        if value_gen is not None:
+            value_gen = ''.join(value_gen)
+        return fields, value_gen
+
+    def test_parse_cdmi_msg_body_fields(self):
+        fields, value = self.parse_body(
+            '{"mimetype": "value", "metadata": {"value": "x"}, '
+            '"valuerange": "0-2", "value": "abc"}')
+        assert fields == {'mimetype': 'value', 'metadata': {'value': 'x'},
+                          'valuerange': '0-2'}
+        assert value == 'abc'
+
+        fields, value = self.parse_body('{"value": "abc"}')
+        assert fields == {}
+        assert value == 'abc'
+
+        fields, value = self.parse_body('{"copy": "http://foo.bar/x"}')
+        assert fields == {'copy': 'http://foo.bar/x'}
+        assert value is None
+
+        fields, value = self.parse_body('{"value": null}')
+        assert fields == {'value': None}
+        assert value is None
+
+    def test_parse_cdmi_msg_body_fields_escapes(self):
+        # small buffers cut the escape sequences in every possible place
+        for buffer_size in [1, 2, 3, 5, 4096]:
+            fields, value = self.parse_body(
+                '{"value": "a\\"b\\\\c\\/d\\ne\\u00e9\\ud83d\\ude00"}',
+                buffer_size=buffer_size)
+            assert value == 'a"b\\c/d\ne\xc3\xa9\xf0\x9f\x98\x80'
+
+    def test_parse_cdmi_msg_body_fields_base64(self):
+        from base64 import b64encode
+        content = ''.join(chr(i) for i in range(256)) * 3
+
+        # the JSON encoded line breaks are ignored
+        encoded = b64encode(content)
+        encoded = '\\n'.join(encoded[i:i + 76]
+                             for i in range(0, len(encoded), 76))
+        for buffer_size in [1, 7, 4096]:
+            fields, value = self.parse_body(
+                '{"valuetransferencoding": "base64", "value": "%s"}'
+                % encoded, buffer_size=buffer_size)
+            assert fields == {'valuetransferencoding': 'base64'}
+            assert value == content
+
+    def test_base64_stream_encoder(self):
+        from base64 import b64encode
+        from eudat_http_api.http_storage.common import Base64StreamEncoder
+        content = ''.join(chr(i) for i in range(256)) * 3
+
+        for chunk_size in [1, 2, 4, 5, 7, 4096]:
+            encoder = Base64StreamEncoder()
+            parts = []
+            for i in range(0, len(content), chunk_size):
+                parts.extend(encoder.encode(content[i:i + chunk_size]))
+            parts.append(encoder.flush())
+            assert ''.join(parts) == b64encode(content)
+
+    def test_parse_cdmi_msg_body_fields_invalid(self):
+        from eudat_http_api.http_storage import cdmi
+
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body, '')
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body, '["value"]')
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body, '{"mimetype": , "value": "abc"}')
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body, '{"value": "abc')
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body, '{"value": "a\\qb"}')
+        assert_raises(cdmi.MalformedMsgBodyException,
+                      self.parse_body,
+                      '{"valuetransferencoding": "base64", "value": "YWJ"}')
@@ -19,6 +19,10 @@ class Config(object):
     DB_FD, DB_FILENAME = tempfile.mkstemp()
     SQLALCHEMY_DATABASE_URI = '%s%s' % ('sqlite:///', DB_FILENAME)
     REQUESTS_PER_PAGE = 5
+    # every test creates an app, the tests run the workers themselves
+    REGISTRATION_WORKERS = 0
+    REGISTRATION_CREDENTIALS_KEY = \
+        'aYpR7TQ3Oemt8Swq6gG67ngA79w-0dacDec5VX_Qm4E='
 
 
 class MockConfig(Config):
@@ -1,6 +1,7 @@
 import json
 import unittest
-from eudat_http_api.epicclient import HandleRecord
+from eudat_http_api.epicclient import HandleRecord, Location, \
+    parse_locations
 
 
 class TestCase(unittest.TestCase):
@@ -105,6 +106,34 @@ class TestCase(unittest.TestCase):
         assert len(locations) == 1
         assert locations[0] == h.get_url_value()
 
+    def test_parse_locations(self):
+        loc = ('<locations>'
+               '<location id="0" href="http://a.eu/x" weight="0.5"/>'
+               '<location id="1" href="http://b.eu/x" view="html"/>'
+               '<location id="2" weight="1"/>'
+               '<location id="3" href="http://c.eu/x" weight="abc"/>'
+               '</locations>')
+        assert parse_locations(loc) == [
+            Location('http://a.eu/x', 0.5, None),
+            Location('http://b.eu/x', 1.0, 'html'),
+            Location('http://c.eu/x', 1.0, None)]
+        assert parse_locations(u'<locations><location href="\xe4"/>'
+                               u'</locations>') == [
+            Location('\xc3\xa4'.decode('utf-8'), 1.0, None)]
+
+    def test_parse_broken_locations(self):
+        loc = ('<locations><location href="http://a.eu/x"/>'
+               '<location href="http://b.eu/x"></locations>')
+        assert parse_locations(loc) == [Location('http://a.eu/x', 1.0, None)]
+        assert parse_locations('not xml') == []
+
+    def test_locations_parsed_once(self):
+        h = HandleRecord.from_json(json.loads(self.epic_str))
+        locations = h.get_locations()
+        assert len(locations) == 2
+        assert h.get_locations() is locations
+        h.add_value(HandleRecord.LOC, '<locations/>')
+        assert h.get_locations() is not locations
 
 
 if __name__ == '__main__':
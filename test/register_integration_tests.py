@@ -1,4 +1,9 @@
+from datetime import datetime, timedelta
+import json
+import sys
 import tempfile
+import urllib
+import uuid
 
 from test.test_common import TestApi
 
@@ -19,6 +24,101 @@ class TestHttpRegisterApi(TestApi):
         # make sure that the requests list is empty
         #assert re.search('<ul>\s*</ul>', rv.data) is not None
 
+    def add_requests(self, prefix, count):
+        from eudat_http_api.registration.models import db, \
+            RegistrationRequest
+        now = datetime.utcnow()
+        with self.app.app_context():
+            for i in range(count):
+                # pairs of requests with the same timestamp
+                db.session.add(RegistrationRequest(
+                    src_url='%s%d' % (prefix, i),
+                    status_description='done' if i % 3 else 'failed',
+                    timestamp=now + timedelta(seconds=i // 2)))
+            db.session.commit()
+
+    def get_json(self, url):
+        rv = self.open_with_auth(url, 'GET', 'testname', 'testpass',
+                                 headers={'Accept': 'application/json'})
+        assert rv.status_code == 200
+        return json.loads(rv.data)
+
+    def test_requestsdb_keyset_pages(self):
+        prefix = 'http://%s.eudat.eu/file' % uuid.uuid4().hex
+        self.add_requests(prefix, 12)
+
+        url = '/request/?src_prefix=' + prefix
+        pages = []
+        while url:
+            body = self.get_json(url)
+            pages.append([r['src_url'] for r in body['requests']])
+            url = body['_links'].get('next', {}).get('href')
+
+        # REQUESTS_PER_PAGE is 5, newest first
+        assert [len(p) for p in pages] == [5, 5, 2]
+        src_urls = sum(pages, [])
+        assert src_urls == ['%s%d' % (prefix, i) for i in range(11, -1, -1)]
+
+        # and back again
+        url = body['_links']['prev']['href']
+        assert ([r['src_url'] for r in self.get_json(url)['requests']] ==
+                pages[1])
+
+    def test_requestsdb_filter(self):
+        prefix = 'http://%s.eudat.eu/file' % uuid.uuid4().hex
+        self.add_requests(prefix, 6)
+
+        body = self.get_json('/request/?status=failed&src_prefix=' + prefix)
+        assert ([r['src_url'] for r in body['requests']] ==
+                [prefix + '3', prefix + '0'])
+        assert 'next' not in body['_links']
+
+    def test_requestsdb_filter_last_code_point(self):
+        prefix = u'http://%s.eudat.eu/file' % uuid.uuid4().hex
+        self.add_requests(prefix, 2)
+
+        last = unichr(sys.maxunicode)
+        for src_prefix, count in [(prefix, 2), (prefix + last, 0),
+                                  (last, 0)]:
+            body = self.get_json('/request/?src_prefix=' + urllib.quote(
+                src_prefix.encode('utf-8')))
+            assert len(body['requests']) == count
+
+    def test_requestsdb_without_timestamp(self):
+        from eudat_http_api.registration.models import db, \
+            RegistrationRequest
+        prefix = 'http://%s.eudat.eu/file' % uuid.uuid4().hex
+        self.add_requests(prefix, 4)
+        with self.app.app_context():
+            for suffix in 'xy':
+                db.session.add(RegistrationRequest(
+                    src_url=prefix + suffix, status_description='done'))
+            db.session.commit()
+
+        url = '/request/?src_prefix=' + prefix
+        src_urls = []
+        while url:
+            body = self.get_json(url)
+            src_urls.extend(r['src_url'] for r in body['requests'])
+            url = body['_links'].get('next', {}).get('href')
+        assert src_urls == ['%s%d' % (prefix, i) for i in range(3, -1, -1)]
+
+    def test_requestsdb_invalid_cursor(self):
+        rv = self.open_with_auth('/request/?after=xyz', 'GET',
+                                 'testname', 'testpass')
+        assert rv.status_code == 400
+
+    def test_post_without_credentials_key(self):
+        self.app.config['REGISTRATION_CREDENTIALS_KEY'] = None
+        src_url = 'http://%s.eudat.eu/file' % uuid.uuid4().hex
+        rv = self.open_with_auth('/request/', 'POST',
+                                 'testname', 'testpass',
+                                 data={'src_url': src_url})
+        assert rv.status_code == 503
+
+        body = self.get_json('/request/?src_prefix=' + src_url)
+        assert body['requests'] == []
+
     # the mocking does not work with thread dispatching of the
     # registration worker. Disable this test as we most likely
     # switch to another solution eventually
@@ -1,5 +1,8 @@
+import base64
+import os
 import re
 import tempfile
+from StringIO import StringIO
 
 from test.test_common import TestApi
 from test.test_common import ByteRange
@@ -30,6 +33,22 @@ class TestHttpApi(TestApi):
         for t in self.check_resource(self.check_html_del):
             yield t
 
+    def test_html_file_get_chunks(self):
+        """Files are sent in chunks of the storage, not of 8 KB."""
+        content = os.urandom(100000)
+        f = tempfile.NamedTemporaryFile(dir='/tmp')
+        f.write(content)
+        f.flush()
+
+        auth = 'Basic ' + base64.b64encode('testname:testpass')
+        rv = self.client.get(f.name, buffered=False,
+                             headers={'Authorization': auth})
+        assert rv.status_code == 200
+        chunks = list(rv.response)
+        rv.close()
+        f.close()
+        assert chunks == [content]
+
     def check_html_get(self, params):
         if params['resource'].is_dir() and params['resource'].exists:
             self.check_html_folder_get(**params)
@@ -46,6 +65,7 @@ class TestHttpApi(TestApi):
             self.check_html_folder_put(**params)
         elif params['resource'].is_file():
             self.check_html_file_put(**params)
+            self.check_html_file_put_chunked(**params)
 
     def check_html_del(self, params):
         if params['resource'].is_file():
@@ -75,6 +95,28 @@ class TestHttpApi(TestApi):
             assert re.search('<ul.*>.*(<li>.*</li>.*)*.*</ul>',
                              rv.data, re.DOTALL) is not None
 
+            self.check_html_folder_get_pages(resource, userinfo)
+
+    def check_html_folder_get_pages(self, resource, userinfo):
+        self.app.config['LISTING_PAGE_SIZE'] = 1
+        names, query, pages = [], '', 0
+        while query is not None:
+            rv = self.open_with_auth(resource.path + query, 'GET',
+                                     userinfo.name, userinfo.password)
+            assert rv.status_code == 200
+            pages += 1
+            page_names = re.findall(
+                'glyphicon-(?:folder-open|file)"></span>(?:&nbsp;)?([^<]*)</a>',
+                rv.data)
+            assert len(page_names) <= 1
+            names.extend(page_names)
+
+            next_link = re.search('href="(\?token=[^"]*)"', rv.data)
+            query = next_link.group(1) if next_link else None
+
+        assert sorted(names) == sorted(resource.objinfo['children_names'])
+        assert pages == max(1, len(names))
+
     def check_html_folder_get_404(self, resource, userinfo):
         url = resource.path
         rv = self.open_with_auth(url, 'GET',
@@ -254,6 +296,43 @@ class TestHttpApi(TestApi):
             assert rv.status_code == 201
         self.assert_html_response(rv)
 
+    def check_html_file_put_chunked(self, resource, userinfo):
+        """A chunked PUT has no Content-Length.
+
+        The input stream is what the WSGI server hands over after
+        decoding the chunks.
+        """
+        if resource.exists or not resource.parent_exists:
+            return
+
+        url = resource.path + '.chunked'
+        content = resource.objinfo['content']
+        rv = self.client.open(
+            url, method='PUT',
+            input_stream=StringIO(content),
+            environ_overrides={'CONTENT_LENGTH': ''},
+            headers={
+                'Authorization': 'Basic ' + base64.b64encode(
+                    userinfo.name + ':' + userinfo.password),
+                'Transfer-Encoding': 'chunked',
+            })
+
+        if not userinfo.valid:
+            assert rv.status_code == 401
+            return
+
+        assert rv.status_code == 201
+        self.assert_html_response(rv)
+
+        rv = self.open_with_auth(url, 'GET',
+                                 userinfo.name, userinfo.password, {})
+        assert rv.status_code == 200
+        assert rv.data == content
+
+        rv = self.open_with_auth(url, 'DELETE',
+                                 userinfo.name, userinfo.password, {})
+        assert rv.status_code == 204
+
     def check_html_folder_put(self, resource, userinfo):
         url = resource.path
         rv = self.open_with_auth(url, 'PUT',
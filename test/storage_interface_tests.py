@@ -1,7 +1,9 @@
+import hashlib
 from itertools import product
 from operator import add
 import os
 import tempfile
+import zlib
 
 from mock import patch
 from nose.tools import assert_raises
@@ -62,10 +64,18 @@ class TestStorageApi(TestApi):
         for t in self.check_storage(self.check_read):
             yield t
 
+    def test_checksum(self):
+        for t in self.check_storage(self.check_checksum):
+            yield t
+
     def test_ls(self):
         for t in self.check_storage(self.check_ls):
             yield t
 
+    def test_ls_with_stat(self):
+        for t in self.check_storage(self.check_ls_with_stat):
+            yield t
+
     def test_mkdir(self):
         for t in self.check_storage(self.check_mkdir):
             yield t
@@ -246,6 +256,55 @@ class TestStorageApi(TestApi):
                               storage.read,
                               resource.path)
 
+    def check_checksum(self, params):
+        if (params['resource'].exists and params['resource'].is_file() and
+                params['userinfo'].valid):
+            self.check_checksum_good(**params)
+        else:
+            self.check_checksum_except(**params)
+
+    def check_checksum_good(self, resource, userinfo):
+        with self.app.test_request_context(), \
+                patch(
+                'eudat_http_api.http_storage.'
+                + 'storage_common._get_authentication',
+                return_value=self.get_auth(userinfo.name, userinfo.password)):
+
+            from eudat_http_api.http_storage import storage
+
+            expected = 'md5:%s' % hashlib.md5(
+                resource.objinfo['content']).hexdigest()
+            assert storage.checksum(resource.path, 'md5') == expected
+            # the second time, it comes from the cache or the catalog
+            assert storage.checksum(resource.path, 'md5',
+                                    compute=False) == expected
+
+            expected = 'adler32:%08x' % (
+                zlib.adler32(resource.objinfo['content']) & 0xffffffff)
+            assert storage.checksum(resource.path, 'adler32') == expected
+
+    def check_checksum_except(self, resource, userinfo):
+        with self.app.test_request_context(), \
+                patch(
+                'eudat_http_api.http_storage.'
+                + 'storage_common._get_authentication',
+                return_value=self.get_auth(userinfo.name, userinfo.password)):
+
+            from eudat_http_api.http_storage import storage
+
+            if resource.is_dir() and resource.exists and userinfo.valid:
+                assert_raises(storage.IsDirException,
+                              storage.checksum,
+                              resource.path)
+            elif not resource.exists and userinfo.valid:
+                assert_raises(storage.NotFoundException,
+                              storage.checksum,
+                              resource.path)
+            elif not userinfo.valid:
+                assert_raises(storage.NotAuthorizedException,
+                              storage.checksum,
+                              resource.path)
+
     def check_ls(self, params):
         if (params['resource'].exists and params['userinfo'].valid and
                 params['resource'].is_dir()):
@@ -269,6 +328,23 @@ class TestStorageApi(TestApi):
             ls_names = map(lambda x: x.name, ls_res)
             assert set(ls_names) == set(resource.objinfo['children_names'])
 
+            # parts of the listing
+            for offset, limit in [(0, 1), (1, 1), (1, None), (0, 0),
+                                  (len(ls_names), 2)]:
+                part = list(storage.ls(resource.path, offset, limit))
+                end = None if limit is None else offset + limit
+                assert map(lambda x: x.name, part) == ls_names[offset:end]
+
+            # continue the listing page by page
+            token, names = None, []
+            while True:
+                part = list(storage.ls(resource.path, limit=1, token=token))
+                if not part:
+                    break
+                names.extend(map(lambda x: x.name, part))
+                token = storage.make_ls_token(part[-1])
+            assert names == ls_names
+
     def check_ls_except(self, resource, userinfo):
         with self.app.test_request_context(), \
                 patch(
@@ -288,6 +364,56 @@ class TestStorageApi(TestApi):
                 assert_raises(storage.IsFileException,
                               storage.ls, resource.path)
 
+    def check_ls_with_stat(self, params):
+        if (params['resource'].exists and params['userinfo'].valid and
+                params['resource'].is_dir()):
+            self.check_ls_with_stat_good(**params)
+        else:
+            self.check_ls_with_stat_except(**params)
+
+    def check_ls_with_stat_good(self, resource, userinfo):
+        with self.app.test_request_context(), \
+                patch(
+                'eudat_http_api.http_storage.'
+                + 'storage_common._get_authentication',
+                return_value=self.get_auth(userinfo.name, userinfo.password)):
+
+            from eudat_http_api.http_storage import storage
+
+            ls_res = list(storage.ls_with_stat(resource.path))
+            assert len(ls_res) == resource.objinfo['children']
+            ls_names = map(lambda (x, _): x.name, ls_res)
+            assert set(ls_names) == set(resource.objinfo['children_names'])
+
+            for obj, obj_info in ls_res:
+                rv = storage.stat(obj.path)
+                assert obj_info['type'] == rv['type']
+                if rv['type'] == storage.FILE:
+                    assert obj_info['size'] == rv['size']
+                assert 'user_metadata' not in obj_info
+
+            for obj, obj_info in storage.ls_with_stat(resource.path, True):
+                assert 'user_metadata' in obj_info
+
+    def check_ls_with_stat_except(self, resource, userinfo):
+        with self.app.test_request_context(), \
+                patch(
+                'eudat_http_api.http_storage.'
+                + 'storage_common._get_authentication',
+                return_value=self.get_auth(userinfo.name, userinfo.password)):
+
+            from eudat_http_api.http_storage import storage
+
+            if not userinfo.valid:
+                assert_raises(storage.NotAuthorizedException,
+                              storage.ls_with_stat, resource.path)
+            elif not resource.exists:
+                assert_raises(storage.NotFoundException,
+                              storage.ls_with_stat, resource.path)
+            elif not resource.is_dir():
+                assert_raises(storage.IsFileException,
+                              storage.ls_with_stat, resource.path)
+
     def check_mkdir(self, params):
         # there is no distinction between files and dirs.
         # filenames are also used to create directories.
@@ -0,0 +1,86 @@
+import unittest
+
+from mock import patch
+
+from eudat_http_api import create_app
+from eudat_http_api.auth.common import AuthMethod, UserInfo
+from eudat_http_api.auth.common import auth_cache, invalidate_auth
+
+
+class TestCheckAuth(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('test.config.LocalConfig')
+        self.app.config['AUTH_CACHE_TTL'] = 60
+        self.app.config['AUTH_CACHE_NEGATIVE_TTL'] = 60
+        auth_cache.clear()
+
+    def tearDown(self):
+        auth_cache.clear()
+
+    def get_auth(self, username, password, check_auth_func=None):
+        u = UserInfo(check_auth_func)
+        u.method = AuthMethod.Pass
+        u.username = username
+        u.password = password
+        return u
+
+    def test_result_is_cached(self):
+        from eudat_http_api.auth.auth import check_auth
+        with self.app.test_request_context(), \
+                patch('eudat_http_api.http_storage.storage.authenticate',
+                      return_value=True) as authenticate:
+            assert check_auth(self.get_auth('testname', 'testpass'))
+            assert check_auth(self.get_auth('testname', 'testpass'))
+            assert authenticate.call_count == 1
+
+            # another password is another cache entry
+            authenticate.return_value = False
+            assert not check_auth(self.get_auth('testname', 'other'))
+            assert not check_auth(self.get_auth('testname', 'other'))
+            assert authenticate.call_count == 2
+
+    def test_invalidate(self):
+        from eudat_http_api.auth.auth import check_auth
+        with self.app.test_request_context(), \
+                patch('eudat_http_api.http_storage.storage.authenticate',
+                      return_value=True) as authenticate:
+            auth = self.get_auth('testname', 'testpass')
+            assert check_auth(auth)
+            invalidate_auth(auth)
+            authenticate.return_value = False
+            assert not check_auth(auth)
+            assert authenticate.call_count == 2
+
+    def test_cache_disabled(self):
+        from eudat_http_api.auth.auth import check_auth
+        self.app.config['AUTH_CACHE_TTL'] = 0
+        with self.app.test_request_context(), \
+                patch('eudat_http_api.http_storage.storage.authenticate',
+                      return_value=True) as authenticate:
+            assert check_auth(self.get_auth('testname', 'testpass'))
+            assert check_auth(self.get_auth('testname', 'testpass'))
+            assert authenticate.call_count == 2
+
+    def test_gsi_is_not_cached(self):
+        from eudat_http_api.auth.auth import check_auth
+        with self.app.test_request_context(), \
+                patch('eudat_http_api.http_storage.storage.authenticate',
+                      return_value=True) as authenticate:
+            auth = UserInfo(None)
+            auth.method = AuthMethod.Gsi
+            auth.userdn = '/CN=test'
+            assert check_auth(auth)
+            assert check_auth(auth)
+            assert authenticate.call_count == 2
+
+    def test_memoized_per_request(self):
+        calls = []
+        auth = self.get_auth('a', 'b', lambda u: calls.append(u) or True)
+        assert auth.is_authenticated()
+        assert auth.is_active()
+        assert len(calls) == 1
+
+    def test_auth_hash_separates_fields(self):
+        assert (self.get_auth('ab', 'c').get_auth_hash() !=
+                self.get_auth('a', 'bc').get_auth_hash())
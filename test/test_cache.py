@@ -0,0 +1,89 @@
+import threading
+import time
+import unittest
+
+from nose.tools import assert_raises
+
+from eudat_http_api.cache import Cache
+
+
+class TestCache(unittest.TestCase):
+
+    def test_get_set(self):
+        c = Cache()
+        assert c.get('a') is None
+        assert c.get('a', 'default') == 'default'
+        c.set('a', 1)
+        assert c.get('a') == 1
+        assert c.stats == {'hits': 1, 'misses': 2}
+
+    def test_expiry(self):
+        c = Cache(ttl=0.01)
+        c.set('a', 1)
+        c.set('b', 2, ttl=60)
+        time.sleep(0.02)
+        assert c.get('a') is None
+        assert c.get('b') == 2
+
+    def test_zero_ttl_is_not_stored(self):
+        c = Cache()
+        c.set('a', 1, ttl=0)
+        assert c.get('a') is None
+        assert len(c) == 0
+
+    def test_lru_eviction(self):
+        c = Cache(max_size=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+        assert c.get('b') is None
+        assert c.get('a') == 1
+        assert c.get('c') == 3
+
+    def test_delete(self):
+        c = Cache()
+        c.set('a', 1)
+        c.delete('a')
+        c.delete('not there')
+        assert c.get('a') is None
+
+    def test_get_or_compute(self):
+        c = Cache()
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'value', 60
+
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(c.get_or_compute('a', compute)))
+            for _ in range(5)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        release.set()
+        for t in threads:
+            t.join()
+
+        # one computation for all concurrent misses
+        assert calls == [1]
+        assert results == ['value'] * 5
+        assert c.get_or_compute('a', compute) == 'value'
+        assert calls == [1]
+
+    def test_get_or_compute_error(self):
+        c = Cache()
+
+        def compute():
+            raise ValueError('failed')
+
+        assert_raises(ValueError, c.get_or_compute, 'a', compute)
+        assert len(c) == 0
+        assert c.get_or_compute('a', lambda: (1, 60)) == 1
@@ -0,0 +1,72 @@
+import unittest
+from httmock import all_requests, HTTMock
+import requests
+
+from eudat_http_api.cdmiclient import CDMIClient, ResponseBodyStream
+from eudat_http_api.registration.registration_worker import stream_download
+
+content = ''.join(chr(i % 256) for i in range(10000))
+uploads = dict()
+
+
+@all_requests
+def my_mock(url, request):
+    if request.method == 'GET':
+        if url.path == '/src':
+            return {'status_code': requests.codes.ok,
+                    'headers': {'Content-Length': str(len(content))},
+                    'content': content}
+        return {'status_code': requests.codes.not_found,
+                'content': ''}
+
+    if request.method == 'PUT':
+        if hasattr(request.body, 'read'):
+            body = ''.join(iter(lambda: request.body.read(100), ''))
+        else:
+            body = ''.join(request.body)
+        uploads[url.path] = (body, request.headers.get('Content-Length'))
+        return {'status_code': requests.codes.created,
+                'content': ''}
+
+
+class TestCDMIClient(unittest.TestCase):
+
+    def setUp(self):
+        uploads.clear()
+        self.client = CDMIClient(('user', 'pass'))
+
+    def get_stream(self, chunk_size):
+        with HTTMock(my_mock):
+            response = self.client.get('http://localhost/src', stream=True)
+        return ResponseBodyStream(response, chunk_size)
+
+    def test_response_body_stream_read(self):
+        body = self.get_stream(3000)
+        assert body.len == len(content)
+
+        parts = []
+        data = body.read(1024)
+        while data:
+            assert len(data) <= 1024
+            parts.append(data)
+            data = body.read(1024)
+        assert ''.join(parts) == content
+        assert body.read(1024) == ''
+
+    def test_response_body_stream_iter(self):
+        body = self.get_stream(3000)
+        first = body.read(10)
+        assert first + ''.join(body) == content
+
+    def test_stream_download(self):
+        with HTTMock(my_mock):
+            assert stream_download(self.client,
+                                   'http://localhost/src',
+                                   'http://localhost/dst',
+                                   chunk_size=4096)
+            assert not stream_download(self.client,
+                                       'http://localhost/nonexisting',
+                                       'http://localhost/dst2')
+
+        assert uploads['/dst'] == (content, str(len(content)))
+        assert '/dst2' not in uploads
@@ -0,0 +1,148 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import xattr
+from mock import patch
+from nose.tools import assert_raises
+
+from eudat_http_api import create_app
+from eudat_http_api.checksum import Checksum, parse_checksum, \
+    UnknownAlgorithmException, make_digest_header, parse_want_digest
+
+
+class TestChecksum(unittest.TestCase):
+
+    def test_algorithms(self):
+        expected = {
+            'md5': '9e107d9d372bb6826bd81d3542a419d6',
+            'sha256': ('d7a8fbb307d7809469ca9abcb0082e4f'
+                       '8d5651e46d3cdb762d02d0bf37c9e592'),
+            'adler32': '5bdc0fda',
+        }
+        data = 'The quick brown fox jumps over the lazy dog'
+        for algorithm, digest in expected.iteritems():
+            checksum = Checksum(algorithm)
+            # chunks are added one after the other
+            assert ''.join(checksum.wrap(iter([data[:10], data[10:]]))) == data
+            assert checksum.hexdigest() == digest
+            assert checksum.value() == '%s:%s' % (algorithm, digest)
+            assert parse_checksum(checksum.value()) == (algorithm, digest)
+
+    def test_digest_header(self):
+        assert (make_digest_header('md5:9e107d9d372bb6826bd81d3542a419d6') ==
+                'MD5=nhB9nTcrtoJr2B01QqQZ1g==')
+        assert make_digest_header('adler32:024d0127') == 'ADLER32=024d0127'
+
+        assert parse_want_digest('SHA-256') == 'sha256'
+        assert parse_want_digest('md5;q=0.3, sha-256;q=0.5') == 'sha256'
+        assert parse_want_digest('SHA-512, unixsum') is None
+        assert parse_want_digest('') is None
+
+    def test_unknown_algorithm(self):
+        assert_raises(UnknownAlgorithmException, Checksum, 'crc16')
+        assert_raises(UnknownAlgorithmException, parse_checksum, 'abcdef')
+
+
+class TestStorageChecksum(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('test.config.LocalConfig')
+        self.app.config['CHECKSUM_ALGORITHM'] = 'adler32'
+        self.client = self.app.test_client()
+        self.tmpdir = tempfile.mkdtemp(dir='/tmp')
+        self.auth = {'Authorization': 'Basic ' +
+                     base64.b64encode('testname:testpass')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_put_stores_checksum(self):
+        path = os.path.join(self.tmpdir, 'file')
+        rv = self.client.put(path, headers=self.auth, data='abc')
+        assert rv.status_code == 201
+        assert xattr.xattr(path)['user.checksum'] == 'adler32:024d0127'
+
+        rv = self.client.get(path, headers=self.auth)
+        assert rv.headers['ETag'] == '"024d0127"'
+        assert rv.headers['Digest'] == 'ADLER32=024d0127'
+
+        headers = {'Want-Digest': 'MD5'}
+        headers.update(self.auth)
+        rv = self.client.get(path, headers=headers)
+        assert rv.headers['ETag'] == '"024d0127"'
+        assert rv.headers['Digest'] == 'MD5=kAFQmDzST7DWlj99KOF/cg=='
+
+    def test_want_digest_keeps_the_stored_checksum(self):
+        path = os.path.join(self.tmpdir, 'file')
+        rv = self.client.put(path, headers=self.auth, data='abc')
+        assert rv.status_code == 201
+
+        headers = {'Want-Digest': 'SHA-256'}
+        headers.update(self.auth)
+        rv = self.client.get(path, headers=headers)
+        assert rv.headers['Digest'].startswith('SHA-256=')
+
+        rv = self.client.get(path, headers=self.auth)
+        assert rv.headers['ETag'] == '"024d0127"'
+        assert rv.headers['Digest'] == 'ADLER32=024d0127'
+        assert xattr.xattr(path)['user.checksum'] == 'adler32:024d0127'
+
+    def test_get_uses_the_metadata_cache(self):
+        path = os.path.join(self.tmpdir, 'file')
+        rv = self.client.put(path, headers=self.auth, data='abc')
+        assert rv.status_code == 201
+
+        with self.app.test_request_context():
+            from eudat_http_api.http_storage import storage
+            checksum = storage.checksum
+        calls = []
+
+        def counting_checksum(*args, **kwargs):
+            calls.append(args)
+            return checksum(*args, **kwargs)
+
+        with patch('eudat_http_api.http_storage.storage.checksum',
+                   counting_checksum):
+            for _ in range(3):
+                rv = self.client.get(path, headers=self.auth)
+                assert rv.headers['ETag'] == '"024d0127"'
+        assert len(calls) == 1
+
+    def test_cached_checksum(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as f:
+            f.write('abc')
+
+        with self.app.test_request_context():
+            from eudat_http_api.http_storage import storage
+            assert storage.checksum(path, 'adler32', compute=False) is None
+            assert storage.checksum(path, 'adler32') == 'adler32:024d0127'
+            assert (storage.checksum(path, 'adler32', compute=False) ==
+                    'adler32:024d0127')
+
+            # the cached value is not used for a modified file
+            with open(path, 'ab') as f:
+                f.write('d')
+            os.utime(path, (0, 0))
+            assert storage.checksum(path, 'adler32', compute=False) is None
+            assert storage.checksum(path, 'adler32') == 'adler32:03d8018b'
+
+    def test_cdmi_hash(self):
+        path = os.path.join(self.tmpdir, 'file')
+        with open(path, 'wb') as f:
+            f.write('abc')
+
+        headers = {'X-CDMI-Specification-Version': '1.0.2',
+                   'Accept': 'application/cdmi-object'}
+        headers.update(self.auth)
+        rv = self.client.get(path + '?metadata', headers=headers)
+        assert 'cdmi_hash' not in json.loads(rv.data)['metadata']
+
+        rv = self.client.get(path + '?metadata:cdmi_hash', headers=headers)
+        user_meta = json.loads(rv.data)['metadata']
+        assert user_meta['cdmi_hash'] == '024d0127'
+        assert user_meta['cdmi_value_hash'] == 'ADLER32'
@@ -0,0 +1,118 @@
+import thread
+import time
+import unittest
+
+import gevent
+from flask import current_app, request
+from nose.tools import assert_raises
+
+from eudat_http_api import create_app
+from eudat_http_api.auth.common import AuthMethod, UserInfo
+from eudat_http_api.http_storage.executor import configure_executor, \
+    is_offloading, run_blocking
+
+
+class TestExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('test.config.LocalConfig')
+
+    def tearDown(self):
+        configure_executor(0)
+
+    def test_direct(self):
+        assert not is_offloading()
+        assert run_blocking(thread.get_ident) == thread.get_ident()
+
+    def test_hub_keeps_running(self):
+        configure_executor(2)
+        ticks = []
+
+        def tick():
+            while True:
+                ticks.append(1)
+                gevent.sleep(0.01)
+
+        ticker = gevent.spawn(tick)
+        start = time.time()
+        # time.sleep is not patched, it blocks the calling thread
+        readers = [gevent.spawn(run_blocking, time.sleep, 0.2)
+                   for _ in range(2)]
+        gevent.joinall(readers)
+        ticker.kill()
+
+        assert time.time() - start < 0.35
+        assert len(ticks) > 5
+
+    def test_context_and_errors(self):
+        configure_executor(1)
+        with self.app.test_request_context('/tmp/'):
+            assert run_blocking(thread.get_ident) != thread.get_ident()
+            assert (run_blocking(lambda: current_app.name) ==
+                    self.app.name)
+            assert_raises(ValueError, run_blocking, int, 'abc')
+
+    def test_wrap_generator(self):
+        from eudat_http_api.http_storage.storage_common import \
+            wrap_generator
+
+        class Pool(object):
+            released = []
+
+            def release_connection(self, conn):
+                self.released.append(conn)
+
+        closed = []
+
+        def gen():
+            try:
+                yield thread.get_ident()
+                yield thread.get_ident()
+            finally:
+                closed.append(1)
+
+        configure_executor(1)
+        with self.app.test_request_context('/tmp/'):
+            idents = list(wrap_generator(gen(), Pool(), 'a'))
+            assert thread.get_ident() not in idents
+            assert Pool.released == ['a']
+
+            # the generator is closed before the connection is released
+            g = wrap_generator(gen(), Pool(), 'b')
+            next(g)
+            g.close()
+            assert closed == [1, 1]
+            assert Pool.released == ['a', 'b']
+
+    def test_waiting_for_a_connection_keeps_the_pool_free(self):
+        from eudat_http_api.http_storage.storage_common import \
+            ConnectionPool, get_connection
+        from test.test_storage_common import FakeConnection
+
+        configure_executor(2)
+        auth = UserInfo(None)
+        auth.method = AuthMethod.Pass
+        auth.username = 'a'
+        auth.password = 'testpass'
+
+        with self.app.app_context():
+            pool = ConnectionPool(FakeConnection, max_user_pool_size=1,
+                                  wait_timeout=3)
+
+        @get_connection(pool)
+        def read(conn=None):
+            def gen():
+                time.sleep(0.1)
+                yield 'x'
+            return gen()
+
+        def send_request():
+            with self.app.test_request_context('/tmp/'):
+                request.auth_info = auth
+                return list(read())
+
+        start = time.time()
+        greenlets = [gevent.spawn(send_request) for _ in range(3)]
+        gevent.joinall(greenlets, raise_error=True)
+        assert [g.value for g in greenlets] == [['x']] * 3
+        assert time.time() - start < 1
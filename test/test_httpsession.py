@@ -0,0 +1,78 @@
+import unittest
+from httmock import all_requests, HTTMock
+import requests
+
+from eudat_http_api.httpsession import RetrySession
+
+calls = []
+
+
+def answer_with(*status_codes):
+    @all_requests
+    def mock(url, request):
+        calls.append(request.method)
+        status_code = status_codes[min(len(calls), len(status_codes)) - 1]
+        if status_code is None:
+            raise requests.ConnectionError('connection refused')
+        return {'status_code': status_code, 'content': ''}
+    return mock
+
+
+class TestRetrySession(unittest.TestCase):
+
+    def setUp(self):
+        del calls[:]
+        self.session = RetrySession(pool_size=2, retries=2, backoff=0)
+
+    def test_retry_on_status(self):
+        with HTTMock(answer_with(503, 502, 200)):
+            r = self.session.get('http://localhost/obj')
+        assert r.status_code == 200
+        assert calls == ['GET'] * 3
+
+    def test_retry_gives_up(self):
+        with HTTMock(answer_with(503)):
+            r = self.session.head('http://localhost/obj')
+        assert r.status_code == 503
+        assert len(calls) == 3
+
+    def test_retry_on_connection_error(self):
+        with HTTMock(answer_with(None, 201)):
+            r = self.session.put('http://localhost/obj', data='abc')
+        assert r.status_code == 201
+        assert len(calls) == 2
+
+        del calls[:]
+        with HTTMock(answer_with(None)):
+            self.assertRaises(requests.ConnectionError,
+                              self.session.delete, 'http://localhost/obj')
+        assert len(calls) == 3
+
+    def test_no_retry(self):
+        with HTTMock(answer_with(503, 201)):
+            r = self.session.post('http://localhost/obj', data='abc')
+        assert r.status_code == 503
+        assert len(calls) == 1
+
+        # a streamed body cannot be sent again
+        del calls[:]
+        with HTTMock(answer_with(503, 201)):
+            r = self.session.put('http://localhost/obj',
+                                 data=iter(['a', 'b']))
+        assert r.status_code == 503
+        assert len(calls) == 1
+
+    def test_cookies_are_not_kept(self):
+        sent_cookies = []
+
+        @all_requests
+        def mock(url, request):
+            sent_cookies.append(request.headers.get('Cookie'))
+            return {'status_code': 200, 'content': '',
+                    'headers': {'Set-Cookie': 'session=user-a; Path=/'}}
+
+        with HTTMock(mock):
+            self.session.get('http://localhost/obj', auth=('a', 'pass'))
+            self.session.get('http://localhost/obj', auth=('b', 'pass'))
+        assert sent_cookies == [None, None]
+        assert len(self.session.cookies) == 0
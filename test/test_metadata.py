@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from flask import request
+from mock import patch
+from nose.tools import assert_raises
+
+from eudat_http_api import create_app
+from eudat_http_api.auth.common import AuthMethod, UserInfo
+from eudat_http_api.http_storage.storage_common import metadata_cache
+
+
+class TestMetadataCache(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('test.config.LocalConfig')
+        self.app.config['METADATA_CACHE_TTL'] = 60
+        metadata_cache.clear()
+        self.tmpdir = tempfile.mkdtemp(dir='/tmp')
+
+    def tearDown(self):
+        metadata_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def request_context(self, username='testname'):
+        ctx = self.app.test_request_context()
+        ctx.push()
+        auth = UserInfo(None)
+        auth.method = AuthMethod.Pass
+        auth.username = username
+        auth.password = 'testpass'
+        request.auth_info = auth
+        return ctx
+
+    def test_stat_is_cached(self):
+        from eudat_http_api import metadata
+        ctx = self.request_context()
+        try:
+            with patch('eudat_http_api.http_storage.storage.stat',
+                       return_value={'type': 'file'}) as stat:
+                assert metadata.stat('/tmp/a/', True) == {'type': 'file'}
+                assert metadata.stat('/tmp/a', True) == {'type': 'file'}
+                assert stat.call_count == 1
+
+                # other arguments are other entries
+                metadata.stat('/tmp/a', ['objectID'])
+                assert stat.call_count == 2
+        finally:
+            ctx.pop()
+
+        # and so are other users
+        ctx = self.request_context('other')
+        try:
+            with patch('eudat_http_api.http_storage.storage.stat',
+                       return_value={'type': 'file'}) as stat:
+                metadata.stat('/tmp/a', True)
+                assert stat.call_count == 1
+        finally:
+            ctx.pop()
+
+    def test_not_found_is_cached(self):
+        from eudat_http_api import metadata
+        from eudat_http_api.http_storage import storage
+        ctx = self.request_context()
+        try:
+            with patch('eudat_http_api.http_storage.storage.get_user_metadata',
+                       side_effect=storage.NotFoundException('nope')) as meta:
+                for _ in range(2):
+                    assert_raises(storage.NotFoundException,
+                                  metadata.get_user_metadata, '/tmp/x')
+                assert meta.call_count == 1
+        finally:
+            ctx.pop()
+
+    def test_modification_invalidates(self):
+        from eudat_http_api import metadata
+        from eudat_http_api.http_storage import storage
+        ctx = self.request_context()
+        try:
+            dirpath = os.path.join(self.tmpdir, 'dir')
+            assert metadata.stat(self.tmpdir)['children'] == 0
+            assert_raises(storage.NotFoundException, metadata.stat, dirpath)
+
+            storage.mkdir(dirpath)
+            assert metadata.stat(self.tmpdir)['children'] == 1
+            assert metadata.stat(dirpath)['type'] == storage.DIR
+
+            storage.rmdir(dirpath + '/')
+            assert metadata.stat(self.tmpdir)['children'] == 0
+            assert_raises(storage.NotFoundException, metadata.stat, dirpath)
+        finally:
+            ctx.pop()
+
+    def test_cache_disabled(self):
+        from eudat_http_api import metadata
+        self.app.config['METADATA_CACHE_TTL'] = 0
+        ctx = self.request_context()
+        try:
+            with patch('eudat_http_api.http_storage.storage.stat',
+                       return_value={'type': 'file'}) as stat:
+                metadata.stat('/tmp/a')
+                metadata.stat('/tmp/a')
+                assert stat.call_count == 2
+        finally:
+            ctx.pop()
@@ -0,0 +1,128 @@
+from StringIO import StringIO
+import unittest
+
+from flask import Flask, request, Response
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper, wrap_file
+
+from eudat_http_api import metrics as metrics_module
+from eudat_http_api.metrics import Histogram, Metrics, metrics
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_buckets(self):
+        h = Histogram(buckets=(0.1, 1.0))
+        for value in [0.05, 0.1, 0.5, 2]:
+            h.observe(value)
+        assert h.counts == [2, 1, 1]
+        assert h.count == 4
+        assert h.sum == 2.65
+
+    def test_render(self):
+        m = Metrics()
+        m.inc('http_response_size_bytes_total', 10, endpoint='a')
+        m.inc('http_response_size_bytes_total', 5, endpoint='a')
+        m.observe('auth_duration_seconds', 0.02)
+        m.observe('auth_duration_seconds', 20)
+        text = m.render()
+
+        assert '# TYPE http_response_size_bytes_total counter' in text
+        assert 'http_response_size_bytes_total{endpoint="a"} 15\n' in text
+        assert '# TYPE auth_duration_seconds histogram' in text
+        assert 'auth_duration_seconds_bucket{le="0.01"} 0\n' in text
+        assert 'auth_duration_seconds_bucket{le="0.025"} 1\n' in text
+        assert 'auth_duration_seconds_bucket{le="30.0"} 2\n' in text
+        assert 'auth_duration_seconds_bucket{le="+Inf"} 2\n' in text
+        assert 'auth_duration_seconds_sum 20.02\n' in text
+        assert 'auth_duration_seconds_count 2\n' in text
+
+    def test_label_escaping(self):
+        m = Metrics()
+        m.inc('x', endpoint='a"b\\c\n')
+        assert 'x{endpoint="a\\"b\\\\c\\n"} 1' in m.render()
+
+    def test_timer_records_exceptions(self):
+        m = Metrics()
+        try:
+            with m.timer('t', call='ls'):
+                raise ValueError()
+        except ValueError:
+            pass
+        assert m.histograms[('t', (('call', 'ls'),))].count == 1
+
+
+class TestMetricsMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        metrics.clear()
+        self.app = Flask(__name__)
+
+        @self.app.route('/upload', methods=['PUT'])
+        def upload():
+            from flask import request
+            request.stream.read()
+            return 'ok'
+
+        @self.app.route('/download')
+        def download():
+            return Response(iter(['abc', 'de']))
+
+        @self.app.route('/file')
+        def send_file():
+            return Response(wrap_file(request.environ, StringIO('abcde')),
+                            headers={'Content-Length': '5'},
+                            direct_passthrough=True)
+
+        metrics_module.init_app(self.app)
+        self.client = self.app.test_client()
+
+    def get_series(self, name, labels):
+        return metrics.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def test_latency_and_bytes(self):
+        self.client.put('/upload', data='12345', buffered=True)
+        self.client.get('/download', buffered=True)
+
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'upload', 'method': 'PUT', 'status': '200'}).count == 1
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'download', 'method': 'GET',
+            'status': '200'}).count == 1
+        assert metrics.counters[('http_request_size_bytes_total',
+                                 (('endpoint', 'upload'),))] == 5
+        assert metrics.counters[('http_response_size_bytes_total',
+                                 (('endpoint', 'download'),))] == 5
+
+    def test_file_wrapper_is_passed_on(self):
+        environ = EnvironBuilder('/file').get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+        response = self.app.wsgi_app(environ, lambda *args: None)
+        assert isinstance(response, FileWrapper)
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'send_file', 'method': 'GET',
+            'status': '200'}) is None
+
+        response.close()
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'send_file', 'method': 'GET',
+            'status': '200'}).count == 1
+        assert metrics.counters[('http_response_size_bytes_total',
+                                 (('endpoint', 'send_file'),))] == 5
+
+    def test_unknown_route_and_method(self):
+        self.client.get('/nothing', buffered=True)
+        self.client.open('/download', method='PATCH', buffered=True)
+
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'none', 'method': 'GET', 'status': '404'})
+        assert self.get_series('http_request_duration_seconds', {
+            'endpoint': 'none', 'method': 'other', 'status': '405'})
+
+    def test_metrics_endpoint(self):
+        self.client.get('/download', buffered=True)
+        rv = self.client.get('/metrics')
+        assert rv.status_code == 200
+        assert rv.content_type.startswith('text/plain; version=0.0.4')
+        assert ('http_request_duration_seconds_count{endpoint="download",'
+                'method="GET",status="200"} 1') in rv.data
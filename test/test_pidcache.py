@@ -0,0 +1,80 @@
+import json
+import unittest
+
+from httmock import all_requests, HTTMock
+from nose.tools import assert_raises
+import requests
+
+from eudat_http_api.epicclient import EpicClient
+from eudat_http_api.registration.pidcache import pid_cache, resolve_handle
+
+LOC = ('<locations><location id="0" href="http://a.eu/x"/>'
+       '<location id="1" href="http://b.eu/x"/></locations>')
+
+handles = {
+    '/11858/ttl': {'values': [
+        {'type': 'URL', 'data': 'http://a.eu/x', 'ttl': 10},
+        {'type': '10320/LOC', 'data': LOC, 'ttl': 86400}]},
+    '/11858/nottl': [{'type': 'URL', 'parsed_data': 'http://a.eu/y'}],
+}
+calls = []
+
+
+@all_requests
+def handle_service(url, request):
+    calls.append(url.path)
+    if url.path == '/11858/broken':
+        return {'status_code': 500, 'content': ''}
+    if url.path in handles:
+        return {'status_code': requests.codes.ok,
+                'content': json.dumps(handles[url.path])}
+    return {'status_code': requests.codes.not_found, 'content': ''}
+
+
+class TestPidCache(unittest.TestCase):
+
+    def setUp(self):
+        pid_cache.clear()
+        del calls[:]
+        self.config = {'PID_CACHE_TTL': 300, 'PID_CACHE_NEGATIVE_TTL': 30}
+        self.selected = []
+
+    def client(self):
+        return EpicClient(base_uri='http://hdl.eu', credentials=None)
+
+    def select_local(self, locations):
+        self.selected.append(locations)
+        return False
+
+    def resolve(self, suffix):
+        with HTTMock(handle_service):
+            return resolve_handle(self.client, '11858', suffix,
+                                  self.select_local, self.config)
+
+    def test_cached(self):
+        resolved = self.resolve('ttl')
+        assert resolved.location is False
+        assert [l.href for l in resolved.replicas] == ['http://a.eu/x',
+                                                       'http://b.eu/x']
+        assert resolved.record.ttl == 10
+        assert self.resolve('ttl') is resolved
+        assert calls == ['/11858/ttl']
+        assert self.selected == [['http://a.eu/x', 'http://a.eu/x',
+                                  'http://b.eu/x']]
+
+    def test_ttl(self):
+        self.resolve('ttl')
+        self.resolve('nottl')
+        # the smallest ttl of the values, or PID_CACHE_TTL
+        expires = dict((k[1], v[0]) for k, v in pid_cache.entries.items())
+        assert 289 < expires['nottl'] - expires['ttl'] < 291
+
+    def test_not_found(self):
+        assert self.resolve('missing').record is None
+        assert self.resolve('missing').record is None
+        assert calls == ['/11858/missing']
+
+    def test_error_not_cached(self):
+        assert_raises(requests.HTTPError, self.resolve, 'broken')
+        assert_raises(requests.HTTPError, self.resolve, 'broken')
+        assert calls == ['/11858/broken', '/11858/broken']
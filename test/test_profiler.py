@@ -0,0 +1,194 @@
+import os
+import shutil
+from StringIO import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import Flask, request, Response
+from mock import patch
+from nose.tools import assert_raises
+from werkzeug.exceptions import HTTPException
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import FileWrapper, wrap_file
+
+from eudat_http_api import profiler
+from eudat_http_api.profiler import format_folded, follow_request, \
+    ProfiledRequest, ProfilerMiddleware, StackSampler
+
+
+def wait_in_thread(event, sampler=None, owner=None):
+    if sampler is not None:
+        sampler.track(sys._getframe(), owner)
+    try:
+        event.wait()
+    finally:
+        if sampler is not None:
+            sampler.untrack(sys._getframe())
+
+
+class TestStackSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.sampler = StackSampler()
+        self.event = threading.Event()
+
+    def tearDown(self):
+        self.event.set()
+
+    def start_thread(self, **kwargs):
+        t = threading.Thread(target=wait_in_thread,
+                             args=(self.event,), kwargs=kwargs)
+        t.start()
+        time.sleep(0.05)
+        return t
+
+    def test_samples_tracked_frames(self):
+        owner = ProfiledRequest({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'})
+        self.start_thread(sampler=self.sampler, owner=owner)
+        self.sampler.sample()
+        self.sampler.sample()
+
+        stacks = [s for s in owner.samples
+                  if 'test.test_profiler.wait_in_thread' in s]
+        assert len(stacks) == 1
+        assert owner.samples[stacks[0]] == 2
+        assert stacks[0].startswith('threading.')
+        assert self.sampler.get_aggregate() == dict(owner.samples)
+
+    def test_untracked_threads_are_only_captured(self):
+        self.start_thread()
+        self.sampler.sample()
+        assert self.sampler.get_aggregate() == {}
+
+        samples = self.sampler.capture(
+            0, sleep=lambda seconds: self.sampler.sample())
+        assert any('test.test_profiler.wait_in_thread' in s
+                   for s in samples)
+        assert self.sampler.captures == []
+
+    def test_follow_request(self):
+        owner = ProfiledRequest({})
+        self.sampler.track(sys._getframe(), owner)
+        result = []
+
+        def in_other_thread():
+            result.append(self.sampler.find_owner(sys._getframe()))
+
+        with patch.object(profiler, 'sampler', self.sampler):
+            func = follow_request(in_other_thread)
+        self.sampler.untrack(sys._getframe())
+        t = threading.Thread(target=func)
+        t.start()
+        t.join()
+        assert result == [owner]
+
+    def test_format_folded(self):
+        assert format_folded({'a;b': 2, 'a': 1}) == 'a 1\na;b 2\n'
+
+
+class TestProfilerMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sampler = StackSampler(interval=0.005)
+        self.sampler.start()
+
+        self.app = Flask(__name__)
+
+        @self.app.route('/slow')
+        def slow():
+            time.sleep(0.1)
+            return 'slow'
+
+        @self.app.route('/fast')
+        def fast():
+            return 'fast'
+
+        @self.app.route('/file')
+        def send_file():
+            time.sleep(0.1)
+            return Response(wrap_file(request.environ, StringIO('abc')),
+                            direct_passthrough=True)
+
+    def tearDown(self):
+        self.sampler.stop()
+        shutil.rmtree(self.directory)
+
+    def get_files(self):
+        return sorted(os.listdir(self.directory))
+
+    def wrap(self, **kwargs):
+        self.app.wsgi_app = ProfilerMiddleware(
+            self.app.wsgi_app, self.sampler, self.directory, **kwargs)
+        return self.app.test_client()
+
+    def test_slow_requests_are_written(self):
+        client = self.wrap(slow_threshold=0.05)
+        client.get('/fast', buffered=True)
+        client.get('/slow', buffered=True)
+
+        files = self.get_files()
+        assert len(files) == 1
+        assert '-GET-_slow.folded' in files[0]
+        with open(os.path.join(self.directory, files[0])) as f:
+            assert 'test.test_profiler.slow' in f.read()
+        assert self.sampler.owners == {}
+
+    def test_file_wrapper_is_passed_on(self):
+        self.wrap(slow_threshold=0.05)
+        environ = EnvironBuilder('/file').get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+        response = self.app.wsgi_app(environ, lambda *args: None)
+        assert isinstance(response, FileWrapper)
+        assert self.get_files() == []
+
+        response.close()
+        assert len(self.get_files()) == 1
+
+    def test_write_errors_are_logged(self):
+        # the directory cannot be created below a file
+        self.directory = os.path.join(self.directory, 'file')
+        open(self.directory, 'w').close()
+        client = self.wrap(sample_rate=1)
+        with patch.object(profiler, 'logger') as logger:
+            assert client.get('/slow', buffered=True).data == 'slow'
+        assert logger.error.call_count == 1
+        assert logger.error.call_args[1] == {'exc_info': True}
+        self.directory = os.path.dirname(self.directory)
+
+    def test_rotation(self):
+        client = self.wrap(sample_rate=1, max_files=2)
+        for _ in range(3):
+            client.get('/slow', buffered=True)
+        assert len(self.get_files()) == 2
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.sampler = StackSampler()
+        self.sleeps = []
+
+    def capture(self, seconds):
+        with self.app.test_request_context('/?seconds=%s' % seconds), \
+                patch.object(profiler, 'sampler', self.sampler), \
+                patch('eudat_http_api.http_storage.executor.'
+                      'cooperative_sleep', self.sleeps.append):
+            return profiler.capture()
+
+    def test_capture(self):
+        rv = self.capture(100)
+        assert rv.status_code == 200
+        assert self.sleeps == [60]
+        assert not profiler._capture_lock.locked()
+
+    def test_one_capture_at_a_time(self):
+        with profiler._capture_lock:
+            with assert_raises(HTTPException) as cm:
+                self.capture(1)
+        assert cm.exception.code == 429
+        assert self.sleeps == []
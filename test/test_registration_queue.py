@@ -0,0 +1,213 @@
+from datetime import datetime, timedelta
+import unittest
+
+from mock import patch
+from nose.tools import assert_raises
+from requests.auth import HTTPBasicAuth
+
+from eudat_http_api import create_app
+from eudat_http_api.registration import registration_worker as worker
+from eudat_http_api.registration.credentials import decrypt_credentials, \
+    encrypt_credentials, InvalidCredentialsException
+from eudat_http_api.registration.models import db, RegistrationRequest
+from eudat_http_api.registration.status_writer import StatusWriter
+
+
+KEY = 'aYpR7TQ3Oemt8Swq6gG67ngA79w-0dacDec5VX_Qm4E='
+OTHER_KEY = 'nDCQ2wkKkWWjwgwDLqeid40jT9b9z82ta6LM1r45U-A='
+
+
+class TestCredentials(unittest.TestCase):
+
+    def test_roundtrip(self):
+        token = encrypt_credentials(KEY, 'user', u'p\xe4ss:word')
+        assert 'user' not in token
+        assert (decrypt_credentials(KEY, token) ==
+                ('user', u'p\xe4ss:word'.encode('utf-8')))
+        # a new IV every time
+        assert token != encrypt_credentials(KEY, 'user', u'p\xe4ss:word')
+
+    def test_invalid(self):
+        token = encrypt_credentials(KEY, 'user', 'pass')
+        assert_raises(InvalidCredentialsException,
+                      decrypt_credentials, OTHER_KEY, token)
+        assert_raises(InvalidCredentialsException,
+                      decrypt_credentials, KEY, token[:-8] + 'AAAAAAA=')
+        assert_raises(InvalidCredentialsException,
+                      decrypt_credentials, KEY, 'short')
+
+    def test_invalid_key(self):
+        for key in [None, '', 'vroneneravinjvnaov;d']:
+            assert_raises(InvalidCredentialsException,
+                          encrypt_credentials, key, 'user', 'pass')
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.app = create_app('test.config.LocalConfig')
+        self.app.config['REGISTRATION_RETRY_BACKOFF'] = 0
+        self.app.config['REGISTRATION_MAX_ATTEMPTS'] = 2
+        worker.set_config(self.app.config)
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def add_request(self):
+        r = RegistrationRequest(src_url='http://localhost/tmp/file',
+                                status_description='created',
+                                timestamp=datetime.utcnow())
+        db.session.add(r)
+        db.session.commit()
+
+        context = worker.Context()
+        context.request_id = r.id
+        context.auth = HTTPBasicAuth('testname', 'testpass')
+        context.src_url = r.src_url
+        context.md_url = r.src_url + '?metadata'
+        worker.add_task(context)
+        return r.id
+
+    def get_request(self, request_id):
+        db.session.expire_all()
+        return RegistrationRequest.query.get(request_id)
+
+    def test_claim(self):
+        request_id = self.add_request()
+        assert self.get_request(request_id).credentials is not None
+
+        assert worker.claim_job('a') == request_id
+        assert worker.claim_job('b') is None
+        assert worker.renew_lease('a', request_id)
+        assert not worker.renew_lease('b', request_id)
+
+        # the lease of a dead worker expires
+        r = self.get_request(request_id)
+        r.lease_expires = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+        assert worker.claim_job('b') == request_id
+        assert not worker.renew_lease('a', request_id)
+
+    def test_retry_and_resume(self):
+        calls = []
+
+        def first(context):
+            calls.append('first')
+            assert context.auth.username == 'testname'
+            context.pid = '123/456'
+            return True
+
+        def second(context):
+            calls.append('second')
+            # resumed with the context of the first step
+            assert context.pid == '123/456'
+            return calls.count('second') > 1
+
+        request_id = self.add_request()
+        with patch.object(worker, 'workflow', [first, second]):
+            assert worker.claim_job('a') == request_id
+            worker.run_job('a', request_id)
+
+            r = self.get_request(request_id)
+            assert r.state == worker.QUEUED
+            assert (r.step, r.attempts) == (1, 1)
+
+            assert worker.claim_job('b') == request_id
+            worker.run_job('b', request_id)
+
+        assert calls == ['first', 'second', 'second']
+        worker.get_status_writer().flush()
+        r = self.get_request(request_id)
+        assert r.state == worker.DONE
+        assert r.pid == '123/456'
+        assert r.credentials is None
+        assert r.lease_owner is None
+
+    def test_end_writes_pid_and_checksum(self):
+        def register(context):
+            context.pid = '123/456'
+            context.checksum = 'md5:abc'
+            return True
+
+        request_id = self.add_request()
+        # the queued status changes are lost, e.g. at a process exit
+        with patch.object(worker, 'workflow', [register]), \
+                patch.object(StatusWriter, 'flush'):
+            assert worker.claim_job('a') == request_id
+            worker.run_job('a', request_id)
+
+        r = self.get_request(request_id)
+        assert r.state == worker.DONE
+        assert (r.pid, r.checksum) == ('123/456', 'md5:abc')
+        assert r.status_description == 'Request finished pid = 123/456 '
+
+    def test_fail(self):
+        def failing(context):
+            raise ValueError('broken')
+
+        request_id = self.add_request()
+        with patch.object(worker, 'workflow', [failing]), \
+                patch.object(worker, 'logger') as logger:
+            for _ in range(2):
+                assert worker.claim_job('a') == request_id
+                worker.run_job('a', request_id)
+        assert logger.error.call_count == 2
+        assert logger.error.call_args[1] == {'exc_info': True}
+
+        worker.get_status_writer().flush()
+        r = self.get_request(request_id)
+        assert r.state == worker.FAILED
+        assert r.status_description == 'Failed during failing'
+        assert r.credentials is None
+        assert worker.claim_job('a') is None
+
+    def test_no_credentials_key(self):
+        self.app.config['REGISTRATION_CREDENTIALS_KEY'] = None
+        worker.set_config(self.app.config)
+        assert_raises(InvalidCredentialsException, self.add_request)
+
+        # not the key of the sessions either
+        self.app.config['REGISTRATION_CREDENTIALS_KEY'] = KEY
+        self.app.config['SECRET_KEY'] = KEY
+        worker.set_config(self.app.config)
+        assert_raises(InvalidCredentialsException, self.add_request)
+
+    def test_invalid_credentials_fail_the_request(self):
+        request_id = self.add_request()
+        self.app.config['REGISTRATION_CREDENTIALS_KEY'] = OTHER_KEY
+        worker.set_config(self.app.config)
+
+        assert worker.claim_job('a') == request_id
+        worker.run_job('a', request_id)
+        r = self.get_request(request_id)
+        assert r.state == worker.FAILED
+        assert r.credentials is None
+
+    def test_purge_credentials(self):
+        request_id = self.add_request()
+        r = self.get_request(request_id)
+        r.state = worker.DONE
+        db.session.commit()
+
+        worker.purge_credentials()
+        assert self.get_request(request_id).credentials is None
+
+    def test_status_writer(self):
+        request_id = self.add_request()
+        writer = StatusWriter(interval=60)
+        writer.start()
+        writer.update(request_id, {'status_description': 'first'})
+        writer.update(request_id, {'pid': '123/456'})
+        writer.update(request_id, {'status_description': 'second'})
+        assert self.get_request(request_id).status_description == 'created'
+
+        writer.flush()
+        r = self.get_request(request_id)
+        assert (r.status_description, r.pid) == ('second', '123/456')
+
+    def test_wal(self):
+        mode = db.session.execute('PRAGMA journal_mode').scalar()
+        assert mode == 'wal'
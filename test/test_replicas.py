@@ -0,0 +1,110 @@
+import threading
+import unittest
+
+from httmock import all_requests, HTTMock
+from mock import patch
+
+from eudat_http_api.epicclient import Location
+from eudat_http_api.registration.replicas import ip_proximity, \
+    ReplicaSelector
+
+
+class TestReplicaSelector(unittest.TestCase):
+
+    def setUp(self):
+        self.selector = ReplicaSelector(probe_interval=0)
+        self.a = Location('http://a.eu/x', 1.0, None)
+        self.b = Location('http://b.eu/x', 1.0, None)
+
+    def choose_all(self, locations, client_address=None):
+        chosen = set()
+        for point in [0.0, 0.25, 0.5, 0.75, 0.999]:
+            with patch('random.random', return_value=point):
+                chosen.add(self.selector.choose(locations, client_address))
+        return chosen
+
+    def test_ip_proximity(self):
+        assert ip_proximity('10.0.0.1', '10.0.0.1') == 1.0
+        assert ip_proximity('10.0.0.1', '10.0.1.1') == 23 / 32.0
+        assert ip_proximity('10.0.0.1', '138.0.0.1') == 0.0
+        assert ip_proximity('10.0.0.1', '::1') == 0.0
+        assert ip_proximity('::1', '::1') == 1.0
+        assert ip_proximity(None, '10.0.0.1') == 0.0
+
+    def test_weights(self):
+        assert self.choose_all([self.a, self.b]) == set([self.a, self.b])
+        unused = Location('http://c.eu/x', 0.0, None)
+        assert self.choose_all([self.a, unused]) == set([self.a])
+        assert self.selector.choose([unused]) is None
+        assert self.selector.choose([]) is None
+
+    def test_down_sites_are_skipped(self):
+        self.selector.record_failure('http://a.eu')
+        assert self.choose_all([self.a, self.b]) == set([self.b])
+        # better than nothing
+        self.selector.record_failure('http://b.eu')
+        assert self.choose_all([self.a, self.b]) == set([self.a, self.b])
+
+    def test_latency_and_proximity(self):
+        self.selector.record_latency('http://a.eu', 0.0, '10.0.0.1')
+        self.selector.record_latency('http://b.eu', 3.0, '138.0.0.1')
+        score_a = self.selector.score(self.a, '10.0.0.2')
+        score_b = self.selector.score(self.b, '10.0.0.2')
+        assert score_a > 10 * score_b
+
+        # the running average moves towards new measurements
+        self.selector.record_latency('http://b.eu', 0.0)
+        assert self.selector.sites.get('http://b.eu').latency < 3.0
+
+    def test_probe(self):
+        @all_requests
+        def site(url, request):
+            assert request.method == 'HEAD'
+            status = 200 if url.netloc == 'localhost' else 500
+            return {'status_code': status, 'content': ''}
+
+        with HTTMock(site):
+            self.selector.probe('http://localhost/x')
+            self.selector.probe('http://127.0.0.1:1/x')
+
+        up = self.selector.sites.get('http://localhost')
+        assert up.latency is not None and up.address is not None
+        assert not self.selector.is_up(Location('http://127.0.0.1:1/y',
+                                                1.0, None))
+
+    def test_sites_are_bounded(self):
+        selector = ReplicaSelector(probe_interval=0, max_sites=2)
+        for site in ['http://a.eu', 'http://b.eu', 'http://c.eu']:
+            selector.record_failure(site)
+        assert len(selector.sites) == 2
+        assert selector.sites.get('http://a.eu') is None
+
+    def test_probes_are_bounded(self):
+        selector = ReplicaSelector(probe_interval=300, probe_queue_size=2)
+        locations = [Location('http://%s.eu/x' % name, 1.0, None)
+                     for name in 'abcd']
+        with patch.object(selector, '_start_probe_workers'):
+            selector.choose(locations)
+        assert selector.probes.qsize() == 2
+        # the others are probed with a later choice
+        assert [selector.sites.get('http://%s.eu' % name).probed_at == 0
+                for name in 'abcd'] == [False, False, True, True]
+
+    def test_probe_workers(self):
+        selector = ReplicaSelector(probe_interval=300, probe_threads=1)
+        probed = []
+        done = threading.Event()
+
+        def probe(url):
+            probed.append(url)
+            if len(probed) == 3:
+                done.set()
+
+        locations = [Location('http://%s.eu/x' % name, 1.0, None)
+                     for name in 'abc']
+        with patch.object(selector, 'probe', probe):
+            selector.choose(locations)
+            selector.choose(locations)
+            assert done.wait(5)
+        assert sorted(probed) == [l.href for l in locations]
+        assert len(selector.probe_workers) == 1
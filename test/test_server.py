@@ -0,0 +1,131 @@
+import base64
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from flask import Config
+
+from gevent_server import get_address
+from test.config import LocalConfig
+
+
+class ServerConfig(LocalConfig):
+    SERVER_HOST = '127.0.0.1'
+    SERVER_WORKERS = 2
+    SERVER_KEEPALIVE = 1
+    SERVER_GRACEFUL_TIMEOUT = 5
+
+
+REQUEST = ('GET /tmp/ HTTP/1.1\r\nHost: localhost\r\n'
+           'Authorization: Basic %s\r\n\r\n'
+           % base64.b64encode('testname:testpass'))
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def get_children(pid):
+    children = set()
+    for name in os.listdir('/proc'):
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                # pid (comm) state ppid ...
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, ValueError, IndexError):
+            continue
+        if ppid == pid:
+            children.add(int(name))
+    return children
+
+
+class TestGetAddress(unittest.TestCase):
+
+    def test_get_address(self):
+        config = Config('.')
+        # the address the server always listened on
+        assert get_address(config) == ('0.0.0.0', 5000)
+        # not that of the development server
+        config.update(HOST='127.0.0.1', PORT=8080)
+        assert get_address(config) == ('0.0.0.0', 5000)
+
+        config.update(SERVER_HOST='127.0.0.1', SERVER_PORT=8000)
+        assert get_address(config) == ('127.0.0.1', 8000)
+        assert get_address(config, 9000) == ('127.0.0.1', 9000)
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        self.port = get_free_port()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        with open(os.devnull, 'w') as devnull:
+            self.master = subprocess.Popen(
+                [sys.executable, os.path.join(root, 'gevent_server.py'),
+                 '-c', 'test.test_server.ServerConfig',
+                 '-p', str(self.port)],
+                cwd=root, stdout=devnull, stderr=devnull)
+        self.wait_for(lambda: len(get_children(self.master.pid)) == 2)
+        self.wait_for(self.can_connect)
+
+    def tearDown(self):
+        if self.master.poll() is None:
+            self.master.kill()
+            self.master.wait()
+
+    def wait_for(self, condition, timeout=20):
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            time.sleep(0.1)
+
+    def can_connect(self):
+        try:
+            socket.create_connection(('127.0.0.1', self.port)).close()
+            return True
+        except socket.error:
+            return False
+
+    def request(self, sock):
+        sock.sendall(REQUEST)
+        data = ''
+        while 'HTTP/1.1 200' not in data or '</html>' not in data:
+            chunk = sock.recv(65536)
+            assert chunk
+            data += chunk
+        return data
+
+    def test_reload_and_stop(self):
+        workers = get_children(self.master.pid)
+        self.master.send_signal(signal.SIGHUP)
+        self.wait_for(
+            lambda: not workers & get_children(self.master.pid) and
+            len(get_children(self.master.pid)) == 2)
+
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.request(sock)
+        sock.close()
+
+        self.master.send_signal(signal.SIGTERM)
+        self.wait_for(lambda: self.master.poll() is not None)
+        assert self.master.returncode == 0
+
+    def test_keepalive(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        self.request(sock)
+        # the connection is kept open for the next request
+        self.request(sock)
+        # and closed once it was idle for SERVER_KEEPALIVE seconds
+        start = time.time()
+        sock.settimeout(5)
+        while sock.recv(65536):
+            pass
+        assert 0.5 < time.time() - start < 3
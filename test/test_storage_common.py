@@ -0,0 +1,383 @@
+import os
+from StringIO import StringIO
+import tempfile
+import threading
+import time
+import unittest
+
+from flask import Flask
+from nose.tools import assert_raises
+
+from eudat_http_api.auth.common import AuthMethod, UserInfo
+from eudat_http_api.http_storage.storage_common import Connection
+from eudat_http_api.http_storage.storage_common import ConnectionPool
+from eudat_http_api.http_storage.storage_common import FileRangeStream
+from eudat_http_api.http_storage.storage_common import InternalException
+from eudat_http_api.http_storage.storage_common import MalformedPathException
+from eudat_http_api.http_storage.storage_common import MalformedTokenException
+from eudat_http_api.http_storage.storage_common import StorageDir
+from eudat_http_api.http_storage.storage_common import StorageFile
+from eudat_http_api.http_storage.storage_common import make_ls_token
+from eudat_http_api.http_storage.storage_common import parse_ls_token
+from eudat_http_api.http_storage.storage_common import plan_range_reads
+from eudat_http_api.http_storage.storage_common import quote_query_value
+from eudat_http_api.http_storage.storage_common import read_ahead
+from eudat_http_api.http_storage.storage_common import read_stream_generator
+
+
+class TestFileRangeStream(unittest.TestCase):
+    content = 'abcdefghijklmnopqrstuvwxyz'
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def open_stream(self, start, length, buffer_size=4):
+        return FileRangeStream(open(self.filename, 'rb'), len(self.content),
+                               start, length, buffer_size=buffer_size)
+
+    def test_iterate_whole_file(self):
+        stream = self.open_stream(0, len(self.content))
+        chunks = list(stream)
+        assert ''.join(d for _, _, _, d in chunks) == self.content
+        assert all(len(d) <= 4 for _, _, _, d in chunks)
+        assert chunks[0][:3] == (False, 0, len(self.content))
+        assert stream.file_handle.closed
+
+    def test_iterate_range(self):
+        stream = self.open_stream(5, 6)
+        chunks = list(stream)
+        assert ''.join(d for _, _, _, d in chunks) == self.content[5:11]
+        assert chunks[0][:3] == (False, 5, 10)
+
+    def test_read_stops_at_range_end(self):
+        stream = self.open_stream(5, 6)
+        assert stream.tell() == 5
+        assert stream.read() == self.content[5:11]
+        assert stream.read() == ''
+        stream.close()
+
+        stream = self.open_stream(20, 6)
+        assert stream.read(4) == 'uvwx'
+        assert stream.read(4) == 'yz'
+        assert stream.read(4) == ''
+        stream.close()
+
+    def test_read_negative_length(self):
+        stream = self.open_stream(10, -3)
+        assert stream.read() == ''
+        assert list(stream) == []
+
+    def test_fileno(self):
+        stream = self.open_stream(0, 3)
+        assert stream.fileno() == stream.file_handle.fileno()
+        stream.close()
+
+
+class FakeConnection(Connection):
+    def __init__(self):
+        self.connection = self
+        self.valid = True
+        self.connected = False
+
+    def connect(self, auth_info):
+        self.connected = auth_info.password == 'testpass'
+        return self.connected
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_valid(self):
+        return self.valid
+
+
+class FailingConnection(FakeConnection):
+    def connect(self, auth_info):
+        raise InternalException('storage is down')
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.ctx = Flask(__name__).app_context()
+        self.ctx.push()
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def get_auth(self, username, password='testpass'):
+        u = UserInfo(None)
+        u.method = AuthMethod.Pass
+        u.username = username
+        u.password = password
+        return u
+
+    def test_reuse(self):
+        pool = ConnectionPool(FakeConnection)
+        auth = self.get_auth('a')
+        conn = pool.get_connection(auth)
+        pool.release_connection(conn)
+        assert pool.get_connection(auth) is conn
+        assert pool.get_connection(auth) is not conn
+
+        stats = pool.get_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 2
+        assert stats['open'] == 2
+        assert stats['idle'] == 0
+
+    def test_invalid_credentials(self):
+        pool = ConnectionPool(FakeConnection, max_pool_size=1)
+        assert pool.get_connection(self.get_auth('a', 'wrong')) is None
+        assert pool.get_stats()['open'] == 0
+        assert pool.get_connection(self.get_auth('a')) is not None
+
+    def test_validate_on_checkout(self):
+        pool = ConnectionPool(FakeConnection)
+        auth = self.get_auth('a')
+        conn = pool.get_connection(auth)
+        pool.release_connection(conn)
+        conn.valid = False
+
+        new_conn = pool.get_connection(auth)
+        assert new_conn is not conn
+        assert not conn.connected
+        assert pool.get_stats()['open'] == 1
+
+    def test_user_limit(self):
+        pool = ConnectionPool(FakeConnection, max_user_pool_size=1,
+                              wait_timeout=0.01)
+        pool.get_connection(self.get_auth('a'))
+        assert_raises(InternalException,
+                      pool.get_connection, self.get_auth('a'))
+        assert pool.get_connection(self.get_auth('b')) is not None
+        assert pool.get_stats()['waits'] >= 1
+
+    def test_global_limit_evicts_idle(self):
+        pool = ConnectionPool(FakeConnection, max_pool_size=1,
+                              wait_timeout=0.01)
+        conn_a = pool.get_connection(self.get_auth('a'))
+        assert_raises(InternalException,
+                      pool.get_connection, self.get_auth('b'))
+
+        pool.release_connection(conn_a)
+        assert pool.get_connection(self.get_auth('b')) is not None
+        assert not conn_a.connected
+        assert pool.get_stats()['evictions'] == 1
+
+    def test_failed_connect_frees_the_slot(self):
+        pool = ConnectionPool(FailingConnection, max_pool_size=2,
+                              max_user_pool_size=2, wait_timeout=0)
+        auth = self.get_auth('a')
+        for _ in range(3):
+            assert_raises(InternalException, pool.get_connection, auth)
+        stats = pool.get_stats()
+        assert stats['open'] == 0
+        assert stats['misses'] == 0
+
+        pool.conn_constructor = FakeConnection
+        assert pool.get_connection(auth) is not None
+
+    def test_failed_constructor_frees_the_slot(self):
+        def constructor():
+            raise InternalException('no memory')
+
+        pool = ConnectionPool(constructor, max_pool_size=1, wait_timeout=0)
+        auth = self.get_auth('a')
+        assert_raises(InternalException, pool.get_connection, auth)
+        assert pool.get_stats()['open'] == 0
+
+        pool.conn_constructor = FakeConnection
+        assert pool.get_connection(auth) is not None
+
+    def test_release_wakes_the_waiter_of_the_user(self):
+        pool = ConnectionPool(FakeConnection, max_pool_size=2,
+                              max_user_pool_size=1, wait_timeout=2)
+        conn_a = pool.get_connection(self.get_auth('a'))
+        conn_b = pool.get_connection(self.get_auth('b'))
+        waited = dict()
+
+        def wait_for(username):
+            start = time.time()
+            pool.get_connection(self.get_auth(username))
+            waited[username] = time.time() - start
+
+        app = Flask(__name__)
+
+        def in_context(username):
+            with app.app_context():
+                wait_for(username)
+
+        threads = [threading.Thread(target=in_context, args=(u,))
+                   for u in ['b', 'a']]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        pool.release_connection(conn_a)
+        threads[1].join()
+        assert waited['a'] < 1
+        pool.release_connection(conn_b)
+        threads[0].join()
+
+    def test_evicted_connections_are_closed_without_the_lock(self):
+        locked = []
+
+        class CheckingConnection(FakeConnection):
+            def disconnect(self):
+                free = pool.cond.acquire(False)
+                if free:
+                    pool.cond.release()
+                locked.append(not free)
+                FakeConnection.disconnect(self)
+
+        pool = ConnectionPool(CheckingConnection, max_pool_size=1)
+        conn = pool.get_connection(self.get_auth('a'))
+        pool.release_connection(conn)
+        # the oldest idle connection makes room
+        assert pool.get_connection(self.get_auth('b')) is not None
+        assert not conn.connected
+
+        pool.idle_timeout = 0
+        pool.max_pool_size = 2
+        conn = pool.get_connection(self.get_auth('a'))
+        pool.release_connection(conn)
+        time.sleep(0.01)
+        # the idle connection expired
+        assert pool.get_connection(self.get_auth('a')) is not conn
+        assert not conn.connected
+        assert locked == [False, False]
+
+    def test_idle_timeout(self):
+        pool = ConnectionPool(FakeConnection, idle_timeout=0)
+        auth = self.get_auth('a')
+        conn = pool.get_connection(auth)
+        pool.release_connection(conn)
+        time.sleep(0.01)
+
+        assert pool.get_connection(auth) is not conn
+        assert pool.get_stats()['evictions'] == 1
+
+
+class TestLsToken(unittest.TestCase):
+    def test_roundtrip(self):
+        token = make_ls_token(StorageFile('a:b c', '/x/a:b c'))
+        assert parse_ls_token(token) == ('file', 'a:b c')
+        token = make_ls_token(StorageDir('d', '/x/d'))
+        assert parse_ls_token(token) == ('dir', 'd')
+
+    def test_malformed(self):
+        for token in ['', 'abc', u'\xe9', 'Zm9vOmJhcg==']:
+            assert_raises(MalformedTokenException, parse_ls_token, token)
+
+
+class TestQueryValue(unittest.TestCase):
+    def test_quote(self):
+        assert quote_query_value('/zone/home/a b') == "'/zone/home/a b'"
+
+    def test_quoted_name(self):
+        for value in ["/zone/home/O'Brien", "x' or '1' = '1"]:
+            assert_raises(MalformedPathException, quote_query_value, value)
+
+
+class TestRangeReads(unittest.TestCase):
+    content = ''.join(chr(ord('a') + i % 26) for i in range(100))
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.calls = []
+
+    def tearDown(self):
+        self.ctx.pop()
+
+    def read(self, ranges, buffer_size=4194304):
+        def read_func(f, size):
+            self.calls.append(('read', size))
+            return f.read(size)
+
+        def seek_func(f, position):
+            self.calls.append(('seek', position))
+            return f.seek(position)
+
+        def close_func(f):
+            self.calls.append(('close', ))
+            return f.close()
+
+        return list(read_stream_generator(StringIO(self.content),
+                                          len(self.content),
+                                          sorted(ranges),
+                                          read_func, seek_func, close_func,
+                                          buffer_size=buffer_size))
+
+    def test_plan(self):
+        ranges = [(0, 9), (5, 14), (20, 29), (80, 89)]
+        assert plan_range_reads(ranges, 100, max_gap=0) == [
+            (0, 14, [(0, 9), (5, 14)]),
+            (20, 29, [(20, 29)]),
+            (80, 89, [(80, 89)])]
+        assert plan_range_reads(ranges, 100, max_gap=5) == [
+            (0, 29, [(0, 9), (5, 14), (20, 29)]),
+            (80, 89, [(80, 89)])]
+        assert plan_range_reads(ranges, 100, max_gap=100, max_span=20) == [
+            (0, 14, [(0, 9), (5, 14)]),
+            (20, 29, [(20, 29)]),
+            (80, 89, [(80, 89)])]
+        # ranges to the end of the file
+        assert plan_range_reads([(90, 100)], 100) == [(90, 99, [(90, 100)])]
+
+    def test_overlapping_ranges_are_read_once(self):
+        self.app.config['RANGE_MERGE_GAP'] = 10
+        chunks = self.read([(0, 9), (5, 14), (20, 29), (80, 89)])
+        assert [(d, a, b) for d, a, b, _ in chunks] == [
+            (10, 0, 9), (10, 5, 14), (10, 20, 29), (10, 80, 89)]
+        for _, a, b, data in chunks:
+            assert data == self.content[a:b + 1]
+        assert self.calls == [('seek', 0), ('read', 30),
+                              ('seek', 80), ('read', 10), ('close', )]
+
+    def test_large_range_in_chunks(self):
+        chunks = self.read([(0, 49), (60, 99)], buffer_size=16)
+        assert ''.join(data for _, _, _, data in chunks) == (
+            self.content[0:50] + self.content[60:100])
+        assert [d for d, _, _, _ in chunks if d] == [50, 40]
+        assert all(len(data) <= 16 for _, _, _, data in chunks)
+
+    def test_whole_file(self):
+        chunks = self.read([], buffer_size=16)
+        assert ''.join(data for _, _, _, data in chunks) == self.content
+        assert not any(d for d, _, _, _ in chunks)
+
+    def test_read_ahead(self):
+        self.app.config['RANGE_READ_AHEAD'] = True
+        chunks = self.read([(0, 9), (50, 59)])
+        assert [data for _, _, _, data in chunks] == [self.content[0:10],
+                                                      self.content[50:60]]
+        assert self.calls[-1] == ('close', )
+
+    def test_read_ahead_error(self):
+        def gen():
+            yield 1
+            raise ValueError('broken')
+
+        ahead = read_ahead(gen())
+        assert ahead.next() == 1
+        assert_raises(ValueError, ahead.next)
+
+    def test_read_ahead_stop_early(self):
+        closed = []
+
+        def gen():
+            try:
+                for i in range(100):
+                    yield i
+            finally:
+                closed.append(True)
+
+        ahead = read_ahead(gen())
+        assert ahead.next() == 0
+        ahead.close()
+        assert closed == [True]